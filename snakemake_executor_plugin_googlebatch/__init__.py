@@ -1,4 +1,4 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from typing import Optional
 
 from snakemake_interface_executor_plugins.settings import (
@@ -127,7 +127,6 @@ class ExecutorSettings(ExecutorSettingsBase):
         },
     )
 
-    # Note that additional disks can be added, but this is not exposed yet
     boot_disk_gb: Optional[int] = field(
         default=None,
         metadata={
@@ -212,6 +211,59 @@ class ExecutorSettings(ExecutorSettingsBase):
         },
     )
 
+    reference_volumes: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Comma separated reference data of each job, read-only "
+            "disks made from a bucket prefix: gs://<bucket>/<prefix>:<path>"
+            "[:<size GB>]",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    reference_poll_seconds: Optional[int] = field(
+        default=30,
+        metadata={
+            "help": "Seconds between checks of a job building a reference image",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    mount_profile: Optional[str] = field(
+        default="default",
+        metadata={
+            "help": "gcsfuse options of mounted buckets (default, read-heavy, "
+            "write-heavy or streaming)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    volumes: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Comma separated volumes of each job: local-ssd:<count>:<path>"
+            "[:raid0], <disk type>:<size GB>:<path> (pd-* or hyperdisk-*) or "
+            "gcs:<bucket>:<path>[:<mount profile>]. TMPDIR points at the fastest "
+            "disk",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    shared_fs: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "NFS share (<server>:<path>, e.g., of a Filestore instance) "
+            "mounted at the workflow directory of every job, which then runs "
+            "there with the --shared-fs-usage of the workflow",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
     retry_count: Optional[int] = field(
         default=1,
         metadata={
@@ -239,6 +291,346 @@ class ExecutorSettings(ExecutorSettingsBase):
         },
     )
 
+    status_concurrency: Optional[int] = field(
+        default=50,
+        metadata={
+            "help": "Maximum number of job status requests in flight at once",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    status_mode: Optional[str] = field(
+        default="get",
+        metadata={
+            "help": "How to refresh job status: get (one request per job) or "
+            "list (paged list_jobs filtered on the workflow run label)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    api_timeout: Optional[float] = field(
+        default=60,
+        metadata={
+            "help": "Seconds before a single Google Cloud API call times out",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    api_deadline: Optional[float] = field(
+        default=300,
+        metadata={
+            "help": "Seconds to keep retrying a Google Cloud API call on "
+            "transient errors",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    api_breaker_threshold: Optional[int] = field(
+        default=5,
+        metadata={
+            "help": "Transient API errors in a row before submissions are held back",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    api_breaker_cooldown: Optional[float] = field(
+        default=30,
+        metadata={
+            "help": "Seconds to hold back submissions when the API is degraded",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    submit_concurrency: Optional[int] = field(
+        default=20,
+        metadata={
+            "help": "Maximum number of job submissions in flight at once",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    submit_qps: Optional[float] = field(
+        default=10,
+        metadata={
+            "help": "Maximum number of job submissions per second",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    cancel_concurrency: Optional[int] = field(
+        default=50,
+        metadata={
+            "help": "Maximum number of job deletions in flight when cancelling",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    cancel_timeout: Optional[int] = field(
+        default=300,
+        metadata={
+            "help": "Seconds to wait for all jobs to be deleted when cancelling",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    array_size: Optional[int] = field(
+        default=1,
+        metadata={
+            "help": "Pack up to this many ready jobs with the same resources "
+            "as tasks of one Google Batch job (1 to disable)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    bin_pack: Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": "Pack ready jobs with the same resources onto shared VMs, "
+            "as many per VM as fit by CPU and memory",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    auto_machine_type: Optional[str] = field(
+        default="off",
+        metadata={
+            "help": "Pick the cheapest fitting machine type for each job from its "
+            "threads, mem_mb, disk_mb and nvidia_gpu resources (on), only log and "
+            "report the choices (report), or use machine_type for all jobs (off)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    machine_catalog: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "JSON catalog of machine families (vCPUs, memory and spot "
+            "prices) to add to or replace those shipped with the plugin",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    runtime_bundle: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Bucket prefix (gs://bucket/prefix) for a prebuilt Snakemake "
+            "runtime, saved by the first job and unpacked by the others",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    source_prefix: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Bucket prefix (gs://bucket/prefix) to upload the Snakefile "
+            "to once, by its hash, instead of sending it with every job",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    pilot_workers: Optional[int] = field(
+        default=0,
+        metadata={
+            "help": "Run jobs on up to this many warm workers per kind of job, "
+            "instead of a Batch job each (0 to disable)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    pilot_queue: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Queue for the commands of warm workers, a gs://bucket/prefix "
+            "(or a directory shared with the workers)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    pilot_idle_ttl: Optional[int] = field(
+        default=300,
+        metadata={
+            "help": "Seconds a warm worker waits for new jobs before it stops",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    pilot_poll_seconds: Optional[int] = field(
+        default=10,
+        metadata={
+            "help": "Seconds between checks of a warm worker for new jobs",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    adaptive_polling: Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": "Check running jobs less often the longer they run",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    max_status_interval: Optional[int] = field(
+        default=600,
+        metadata={
+            "help": "Maximum seconds between status checks of a job with "
+            "adaptive polling",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    notification_topic: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Pub/Sub topic Google Batch publishes job state changes to",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    notification_subscription: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Pub/Sub subscription to the notification topic, to receive "
+            "job state changes instead of polling",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    log_workers: Optional[int] = field(
+        default=2,
+        metadata={
+            "help": "Number of background workers downloading job logs",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    log_requests_per_minute: Optional[int] = field(
+        default=60,
+        metadata={
+            "help": "Cloud Logging read requests per minute shared by log workers "
+            "(the default entries.list quota is 60 per project)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    log_batch_size: Optional[int] = field(
+        default=50,
+        metadata={
+            "help": "Maximum number of finished jobs whose logs are fetched with "
+            "a single Cloud Logging query",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    log_tail: Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": "Append new logs of running jobs to their logfiles",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    log_tail_seconds: Optional[int] = field(
+        default=60,
+        metadata={
+            "help": "Minimum seconds between log tails of a running job",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    metrics_format: Optional[str] = field(
+        default="json",
+        metadata={
+            "help": "Format of the metrics file written to "
+            ".snakemake/googlebatch_logs at the end of the run "
+            "(json or prometheus)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    metrics_summary_seconds: Optional[int] = field(
+        default=0,
+        metadata={
+            "help": "Log a summary of the API call metrics every this many seconds "
+            "(0 to disable)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    prefetch_inputs: Optional[int] = field(
+        default=0,
+        metadata={
+            "help": "Download the inputs of each job from Cloud Storage, this many "
+            "at a time (large ones in slices), before Snakemake starts (0 to "
+            "disable)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    verify_outputs: Optional[int] = field(
+        default=0,
+        metadata={
+            "help": "Check the outputs of each job in Cloud Storage against their "
+            "local copies (crc32c), this many at a time, and upload those that "
+            "differ again as parallel composite uploads (0 to disable)",
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+    def __post_init__(self):
+        # Snakemake reads whether the plugin implies no shared file system
+        # from its registration, before any executor exists, so this one
+        # flag follows the settings of the run (either way)
+        common_settings.implies_no_shared_fs = not self.shared_fs
+
+    @property
+    def common_settings(self):
+        """
+        The common settings of a run with these settings. Jobs on a shared
+        file system do not need the workflow staged.
+        """
+        if not self.shared_fs:
+            return replace(common_settings, implies_no_shared_fs=True)
+        return replace(
+            common_settings,
+            implies_no_shared_fs=False,
+            job_deploy_sources=False,
+            auto_deploy_default_storage_provider=False,
+        )
+
 
 # Required:
 # Common settings shared by various executors.
@@ -0,0 +1,195 @@
+# Resilient calls to the Google Cloud APIs
+
+import asyncio
+import contextlib
+import threading
+import time
+
+from google.api_core import retry, retry_async
+
+import snakemake_executor_plugin_googlebatch.metrics as metricsutil
+import snakemake_executor_plugin_googlebatch.utils as utils
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker tracks whether an API is degraded.
+
+    After threshold failed calls in a row the circuit opens for cooldown
+    seconds. Callers that should back off when the API is degraded (e.g.,
+    job submissions) wait for it to close again. Any successful call
+    closes the circuit.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return time.monotonic() < self.opened_until
+
+    def remaining(self):
+        """
+        Seconds until the circuit closes (0 if it is closed).
+        """
+        return max(self.opened_until - time.monotonic(), 0)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_until = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_until = time.monotonic() + self.cooldown
+
+    def wait(self):
+        """
+        Wait until the circuit is closed.
+        """
+        while self.is_open:
+            time.sleep(self.remaining())
+
+    async def wait_async(self):
+        while self.is_open:
+            await asyncio.sleep(self.remaining())
+
+
+class ResilientApi:
+    """
+    A resilient API wraps calls to Google Cloud with retries and deadlines.
+
+    Calls that fail with an error that utils.google_cloud_retry considers
+    transient are retried with jittered exponential backoff, for up to
+    deadline seconds in total. Each attempt of a Google API client method
+    is limited to timeout seconds. Every transient failure counts toward
+    the circuit breaker, and every successful call resets it.
+
+    The latency of every call (with its retries) is recorded in the
+    metrics by method name, as are retried and failed attempts.
+    """
+
+    def __init__(
+        self,
+        timeout=60,
+        deadline=300,
+        initial=1.0,
+        maximum=60.0,
+        multiplier=2.0,
+        breaker=None,
+        metrics=None,
+    ):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = metrics or metricsutil.Metrics()
+
+    def on_error(self, callback=None, method=None):
+        """
+        Get an error hook that records the failure (and calls callback).
+        """
+
+        def on_error(ex):
+            self.breaker.record_failure()
+            self.metrics.increment(
+                "api_retries_total", method=method, error=type(ex).__name__
+            )
+            if callback is not None:
+                callback(ex)
+
+        return on_error
+
+    def retry(self, on_error=None, deadline=None, method=None):
+        """
+        Get a retry policy for a sync call.
+        """
+        return retry.Retry(
+            predicate=utils.google_cloud_retry,
+            initial=self.initial,
+            maximum=self.maximum,
+            multiplier=self.multiplier,
+            timeout=self.deadline if deadline is None else deadline,
+            on_error=self.on_error(on_error, method),
+        )
+
+    def async_retry(self, on_error=None, deadline=None, method=None):
+        """
+        Get a retry policy for an async call.
+        """
+        return retry_async.AsyncRetry(
+            predicate=utils.google_cloud_retry,
+            initial=self.initial,
+            maximum=self.maximum,
+            multiplier=self.multiplier,
+            timeout=self.deadline if deadline is None else deadline,
+            on_error=self.on_error(on_error, method),
+        )
+
+    @contextlib.contextmanager
+    def measure(self, method):
+        """
+        Record the latency of a call, and its error if it fails.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.metrics.increment(
+                "api_errors_total", method=method, error=type(e).__name__
+            )
+            raise
+        finally:
+            self.metrics.observe(
+                "api_call_seconds", time.monotonic() - start, method=method
+            )
+
+    def call(self, method, *args, deadline=None, **kwargs):
+        """
+        Call a Google API client method with retries and a per-call timeout.
+        """
+        name = method_name(method)
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs["retry"] = self.retry(deadline=deadline, method=name)
+        with self.measure(name):
+            result = method(*args, **kwargs)
+        self.breaker.record_success()
+        return result
+
+    async def call_async(self, method, *args, deadline=None, **kwargs):
+        """
+        Call an async Google API client method with retries and a timeout.
+        """
+        name = method_name(method)
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs["retry"] = self.async_retry(deadline=deadline, method=name)
+        with self.measure(name):
+            result = await method(*args, **kwargs)
+        self.breaker.record_success()
+        return result
+
+    def run(self, func, *args, on_error=None, deadline=None, **kwargs):
+        """
+        Run any function with retries (e.g., one iterating over API pages).
+        """
+        name = method_name(func)
+        wrapped = self.retry(on_error=on_error, deadline=deadline, method=name)(func)
+        with self.measure(name):
+            result = wrapped(*args, **kwargs)
+        self.breaker.record_success()
+        return result
+
+
+def method_name(method):
+    """
+    The name of a client method (or function) to label its metrics with.
+    """
+    return getattr(method, "__name__", None) or type(method).__name__
@@ -1,15 +1,47 @@
 # Templates for the command writer
 
+import hashlib
+import importlib.metadata
+import json
+import re
+import shlex
+
+import snakemake
+from snakemake_interface_common.exceptions import WorkflowError
+
 import snakemake_executor_plugin_googlebatch.snippet as sniputil
 
+# The quoted delimiter keeps the Snakefile as is (no $ expansion)
 write_snakefile = """
 #!/bin/bash
-snakefile_path=$(realpath %s)
+snakefile_path=$(realpath %(path)s)
 snakefile_dir=$(dirname $snakefile_path)
 mkdir -p $snakefile_dir || true
-cat <<EOF > $snakefile_path
-%s
-EOF
+cat <<'%(delimiter)s' > $snakefile_path
+%(snakefile)s
+%(delimiter)s
+echo "Snakefile is at $snakefile_path"
+cat $snakefile_path
+"""
+
+# The Snakefile is downloaded once per VM, and checked against its hash
+fetch_snakefile = """
+#!/bin/bash
+snakefile_path=$(realpath %(path)s)
+snakefile_dir=$(dirname $snakefile_path)
+mkdir -p $snakefile_dir || true
+cache=/tmp/snakemake-snakefiles/%(digest)s
+if ! echo "%(digest)s  ${cache}" | sha256sum --check --status 2>/dev/null; then
+    mkdir -p /tmp/snakemake-snakefiles
+    download=$(mktemp /tmp/snakemake-snakefiles/download.XXXXXX)
+    gsutil -q cp %(url)s ${download}
+    if ! echo "%(digest)s  ${download}" | sha256sum --check --status; then
+        echo "The Snakefile %(url)s does not match its hash %(digest)s"
+        exit 1
+    fi
+    mv ${download} ${cache}
+fi
+cp ${cache} $snakefile_path
 echo "Snakefile is at $snakefile_path"
 cat $snakefile_path
 """
@@ -29,6 +61,138 @@ chmod +x /tmp/workdir/entrypoint.sh
 cat /tmp/workdir/entrypoint.sh
 """
 
+write_array_command = """
+case ${BATCH_TASK_INDEX} in
+%s*)
+echo "There is no Snakemake command for batch index ${BATCH_TASK_INDEX}"
+exit 1
+;;
+esac
+"""
+
+# Inputs in storage are downloaded in parallel (large ones in slices), to
+# where Snakemake keeps its local copies, so it finds them up to date. The
+# manifest has the url and the local path of each input, one per line.
+prefetch_inputs = """
+prefetch_input() {
+    mkdir -p "$(dirname "$2")"
+    gsutil -q -o "GSUtil:sliced_object_download_threshold=%(slice_threshold)s" \\
+        -o "GSUtil:sliced_object_download_max_components=%(slices)s" cp "$1" "$2"
+}
+export -f prefetch_input
+prefetch_start=$(date +%%s)
+if xargs -d '\\n' -n 2 -P %(concurrency)s bash -c 'prefetch_input "$0" "$1"' \\
+    <<'%(delimiter)s'
+%(manifest)s
+%(delimiter)s
+then
+    echo "Prefetched %(count)s inputs in $(( $(date +%%s) - prefetch_start ))s"
+else
+    echo "Some inputs were not prefetched, Snakemake retrieves them"
+fi
+"""
+
+# Outputs Snakemake stored are checked against the local copies (by crc32c),
+# and those missing or different are uploaded again, large ones as parallel
+# composite uploads. The manifest is the same as for prefetching.
+verify_outputs = """
+verify_output() {
+    [ -f "$2" ] || return 0
+    local_hash=$(gsutil hash -c -h "$2" | awk '/crc32c/ {print $NF}')
+    remote_hash=$(gsutil ls -L "$1" 2>/dev/null | awk '/Hash \\(crc32c\\)/ {print $NF}')
+    if [ "${local_hash}" = "${remote_hash}" ]; then
+        return 0
+    fi
+    echo "Uploading $2 to $1, its checksum in storage does not match"
+    gsutil -q -o "GSUtil:parallel_composite_upload_threshold=%(composite_threshold)s" \\
+        -o "GSUtil:check_hashes=always" cp "$2" "$1"
+}
+export -f verify_output
+verify_start=$(date +%%s)
+verify_bytes=0
+while IFS= read -r url && IFS= read -r path; do
+    if [ -f "${path}" ]; then
+        verify_bytes=$((verify_bytes + $(stat -c %%s "${path}")))
+    fi
+done <<'%(delimiter)s'
+%(manifest)s
+%(delimiter)s
+xargs -d '\\n' -n 2 -P %(concurrency)s bash -c 'verify_output "$0" "$1"' \\
+    <<'%(delimiter)s' || exit 1
+%(manifest)s
+%(delimiter)s
+verify_seconds=$(( $(date +%%s) - verify_start ))
+verify_rate=$(( verify_bytes / (verify_seconds > 0 ? verify_seconds : 1) / 1048576 ))
+echo "Verified %(count)s outputs (${verify_bytes} bytes) in ${verify_seconds}s," \\
+    "checked at ${verify_rate} MiB/s"
+"""
+
+# Snakemake removes the local copies of outputs right after storing them,
+# so the check runs in its process, in between, and only if all jobs finished.
+# This hooks into Snakemake internals, so the job fails if the hook is missing
+# or was never called.
+verify_launcher = """
+import inspect, os, subprocess, sys
+from snakemake.cli import main
+import snakemake.dag
+from snakemake_interface_common.exceptions import WorkflowError
+
+cleanup_storage_objects = getattr(snakemake.dag.DAG, "cleanup_storage_objects", None)
+if not inspect.iscoroutinefunction(cleanup_storage_objects):
+    raise WorkflowError(
+        "Outputs cannot be verified with Snakemake " + snakemake.__version__
+        + ", it has no DAG.cleanup_storage_objects coroutine."
+    )
+called = []
+
+async def verify_storage_outputs(self):
+    called.append(True)
+    code = 0
+    if not any(self.needrun_jobs()):
+        script = os.environ["SNAKEMAKE_VERIFY_SCRIPT"]
+        code = subprocess.run(["bash", script]).returncode
+    await cleanup_storage_objects(self)
+    if code:
+        raise WorkflowError("The outputs could not be verified in storage.")
+
+snakemake.dag.DAG.cleanup_storage_objects = verify_storage_outputs
+sys.argv[0] = "snakemake"
+try:
+    main()
+except SystemExit as e:
+    if e.code or called:
+        raise
+if not called:
+    sys.exit("Outputs were not verified, Snakemake never cleaned up storage objects.")
+"""
+
+# The Snakemake versions whose internals the launcher was checked against
+verify_snakemake_versions = ["8"]
+
+verify_command = """
+mkdir -p /tmp/snakemake-verify
+export SNAKEMAKE_VERIFY_SCRIPT=$(mktemp /tmp/snakemake-verify/verify.XXXXXX)
+cat <<'%(delimiter)s' > ${SNAKEMAKE_VERIFY_SCRIPT}
+%(script)s
+%(delimiter)s
+%(command)s
+"""
+
+# Tasks sharing a VM run a step once, while the others wait for it
+run_once = """
+mkdir -p /tmp/snakemake-once
+(
+flock 9
+if [ -e /tmp/snakemake-once/%(digest)s.done ]; then
+echo "This step already ran on this VM"
+exit 0
+fi
+bash <<'%(delimiter)s' && touch /tmp/snakemake-once/%(digest)s.done
+%(script)s
+%(delimiter)s
+) 9>/tmp/snakemake-once/%(digest)s.lock
+"""
+
 snakemake_base_environment = """export HOME=/root
 export PATH=/opt/conda/bin:${PATH}
 export LANG=C.UTF-8
@@ -75,6 +239,24 @@ which python
 cd ${workdir}
 """
 
+runtime_bundle = """
+bundle=%(bundle)s
+if gsutil -q cp ${bundle} /tmp/snakemake-runtime.tar.gz \\
+    && mkdir -p /opt/conda \\
+    && tar -xzf /tmp/snakemake-runtime.tar.gz -C /opt/conda; then
+echo "Using the Snakemake runtime bundle ${bundle}"
+else
+echo "The Snakemake runtime bundle ${bundle} is not available, installing Snakemake"
+rm -rf /opt/conda
+%(install)s
+tar -czf /tmp/snakemake-runtime.tar.gz -C /opt/conda . \\
+    && gsutil -q -h "x-goog-if-generation-match:0" \\
+    cp /tmp/snakemake-runtime.tar.gz ${bundle} \\
+    || echo "The runtime bundle ${bundle} was not saved, it might exist already"
+fi
+rm -f /tmp/snakemake-runtime.tar.gz
+"""
+
 check_for_snakemake = (
     snakemake_base_environment
     + """
@@ -100,15 +282,26 @@ class CommandWriter:
         settings=None,
         resources=None,
         snakefile_path=None,
+        snakefile_url=None,
+        prefetch=None,
+        verify=None,
     ):
         self.command = command
 
+        # Downloads the job's inputs before Snakemake starts, and checks
+        # its outputs in storage after
+        self.prefetch = prefetch
+        self.verify = verify
+
         # This is the contents of the snakefile
         self.snakefile = snakefile
         self.resources = resources
         self.settings = settings
         self.snakefile_path = snakefile_path
 
+        # If the Snakefile was uploaded, it is downloaded instead of written
+        self.snakefile_url = snakefile_url
+
         # Prepare (and validate) any provided snippets for the job
         self.load_snippets(snippets)
 
@@ -140,6 +333,10 @@ class CommandWriter:
         # Don't include the main command twice
         if self.snippets.has_run_command_snippet:
             return command
+        if self.prefetch:
+            command += self.prefetch
+        if self.verify:
+            return command + verify_snakemake(self.command, self.verify)
         return command + "\n" + self.command
 
     def setup(self):
@@ -153,7 +350,18 @@ class CommandWriter:
         Return tempalted snakefile. We do this in a separate step so
         a later container step can use it.
         """
-        return write_snakefile % (self.snakefile_path, self.snakefile)
+        digest = snakefile_digest(self.snakefile)
+        if self.snakefile_url:
+            return fetch_snakefile % {
+                "path": self.snakefile_path,
+                "digest": digest,
+                "url": self.snakefile_url,
+            }
+        return write_snakefile % {
+            "path": self.snakefile_path,
+            "delimiter": f"SNAKEFILE_{digest[:16]}",
+            "snakefile": self.snakefile,
+        }
 
     def _template_setup(self, template, use_container=False):
         """
@@ -161,15 +369,44 @@ class CommandWriter:
         """
         command = template
 
+        # With a runtime bundle, the install only runs if it is not built yet
+        bundle = None if use_container else self.get_runtime_bundle(template)
+        if bundle is not None:
+            command = snakemake_base_environment
+
         # If we have a snippet group, add snippets before installing snakemake
         if self.snippets:
             command += self.snippets.render_setup(self.command)
 
+        if bundle is not None:
+            install = template + pinned_install(runtime_versions())
+            return command + runtime_bundle % {"bundle": bundle, "install": install}
+
         # If we don't use container, install snakemkae to VM
         if not use_container:
             command += install_snakemake
         return command
 
+    def get_runtime_bundle(self, template):
+        """
+        Get the runtime bundle for an install, named by a hash of its commands
+        and the local versions of Snakemake and the plugins it installs.
+
+        The first job that does not find it installs Snakemake (pinned to the
+        local version) and saves /opt/conda as the bundle, which later jobs
+        just unpack. A new local version thus builds a new bundle.
+        """
+        prefix = getattr(self.settings, "runtime_bundle", None)
+        if not prefix:
+            return
+        versions = runtime_versions()
+        install = template + pinned_install(versions)
+        digest = hashlib.sha256(
+            (install + json.dumps(versions, sort_keys=True)).encode("utf-8")
+        )
+        name = f"snakemake-runtime-{digest.hexdigest()[:16]}.tar.gz"
+        return f"{prefix.rstrip('/')}/{name}"
+
 
 class COSWriter(CommandWriter):
     """
@@ -204,6 +441,130 @@ class CentosWriter(CommandWriter):
         return self._template_setup(snakemake_centos_install)
 
 
+def runtime_versions():
+    """
+    Get the local versions of Snakemake, this plugin and the GCS storage
+    plugin (if installed), which name the runtime bundle.
+    """
+    versions = {"snakemake": snakemake.__version__}
+    for package in [
+        "snakemake-executor-plugin-googlebatch",
+        "snakemake-storage-plugin-gcs",
+    ]:
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    return versions
+
+
+def pinned_install(versions):
+    """
+    Install Snakemake and the storage plugin at their local versions.
+
+    Packages without a local version, or with one that is not released
+    (e.g., a development install), are installed from source as before.
+    """
+    install = install_snakemake
+    for package in ["snakemake-storage-plugin-gcs", "snakemake"]:
+        version = versions.get(package, "")
+        if not re.fullmatch(r"[0-9]+(\.[0-9]+)*", version):
+            continue
+        install = install.replace(
+            f"./install-snek.sh https://github.com/snakemake/{package}\n",
+            f"/opt/conda/bin/python -m pip install {package}=={version}\n",
+        )
+    return install
+
+
+def array_command(commands):
+    """
+    Combine the commands of packed jobs, each task running its own by index.
+    """
+    cases = "".join(
+        "%s)\n%s\n;;\n" % (index, command) for index, command in enumerate(commands)
+    )
+    return write_array_command % cases
+
+
+def prefetch_script(inputs, concurrency, slice_threshold="150M", slices=8):
+    """
+    Download (url, local path) inputs, concurrency at a time.
+    """
+    manifest = "\n".join(f"{url}\n{path}" for url, path in inputs)
+    digest = hashlib.sha256(manifest.encode("utf-8")).hexdigest()[:16]
+    return prefetch_inputs % {
+        "manifest": manifest,
+        "delimiter": f"INPUTS_{digest}",
+        "count": len(inputs),
+        "concurrency": concurrency,
+        "slice_threshold": slice_threshold,
+        "slices": slices,
+    }
+
+
+def verify_script(outputs, concurrency=8, composite_threshold="150M"):
+    """
+    Check (url, local path) outputs in storage, concurrency at a time.
+    """
+    manifest = "\n".join(f"{url}\n{path}" for url, path in outputs)
+    digest = hashlib.sha256(manifest.encode("utf-8")).hexdigest()[:16]
+    return verify_outputs % {
+        "manifest": manifest,
+        "delimiter": f"OUTPUTS_{digest}",
+        "count": len(outputs),
+        "concurrency": concurrency,
+        "composite_threshold": composite_threshold,
+    }
+
+
+def check_verify_version(version=snakemake.__version__):
+    """
+    Make sure the Snakemake version has the internals the launcher hooks into.
+    """
+    if version.split(".")[0] not in verify_snakemake_versions:
+        supported = ", ".join(f"{v}.x" for v in verify_snakemake_versions)
+        raise WorkflowError(
+            f"Outputs can only be verified with Snakemake {supported}, "
+            f"found {version}"
+        )
+
+
+def verify_snakemake(command, script):
+    """
+    Run the Snakemake command of a job, checking its outputs with the script
+    after Snakemake stored them, before it removes their local copies.
+    """
+    if " -m snakemake " not in command:
+        raise WorkflowError(f"No Snakemake command to verify the outputs of: {command}")
+    digest = hashlib.sha256(script.encode("utf-8")).hexdigest()[:16]
+    launcher = f" -c {shlex.quote(verify_launcher)} "
+    return verify_command % {
+        "delimiter": f"VERIFY_{digest}",
+        "script": script,
+        "command": command.replace(" -m snakemake ", launcher, 1),
+    }
+
+
+def once_per_vm(script):
+    """
+    Wrap a step script so it runs once per VM, however many tasks share it.
+    """
+    digest = hashlib.sha256(script.encode("utf-8")).hexdigest()[:16]
+    return run_once % {
+        "digest": digest,
+        "delimiter": f"RUN_ONCE_{digest}",
+        "script": script,
+    }
+
+
+def snakefile_digest(snakefile):
+    """
+    The sha256 digest of the content of a Snakefile.
+    """
+    return hashlib.sha256(snakefile.encode("utf-8")).hexdigest()
+
+
 def get_writer(family):
     """
     Instantiate a writer based on a family.
@@ -1,4 +1,10 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+import hashlib
+import json
 import os
+import shlex
+import threading
 import time
 import uuid
 
@@ -9,35 +15,295 @@ from snakemake_interface_executor_plugins.executors.remote import RemoteExecutor
 from snakemake_interface_executor_plugins.jobs import (
     JobExecutorInterface,
 )
+import snakemake_executor_plugin_googlebatch.api as apiutil
 import snakemake_executor_plugin_googlebatch.utils as utils
 import snakemake_executor_plugin_googlebatch.command as cmdutil
-
-from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted
-from google.cloud import batch_v1, logging
+import snakemake_executor_plugin_googlebatch.logs as logutil
+import snakemake_executor_plugin_googlebatch.machines as machines
+import snakemake_executor_plugin_googlebatch.metrics as metricsutil
+import snakemake_executor_plugin_googlebatch.notify as notifyutil
+import snakemake_executor_plugin_googlebatch.pilot as pilotutil
+import snakemake_executor_plugin_googlebatch.references as refutil
+import snakemake_executor_plugin_googlebatch.status as statusutil
+import snakemake_executor_plugin_googlebatch.volumes as volumeutil
+
+from google.api_core.exceptions import (
+    AlreadyExists,
+    NotFound,
+    PreconditionFailed,
+    RetryError,
+)
+from google.cloud import batch_v1, storage
 
 
 class GoogleBatchExecutor(RemoteExecutor):
+    # Parameters the allocation policy is built from
+    policy_params = [
+        "machine_type",
+        "image_family",
+        "image_project",
+        "boot_disk_image",
+        "boot_disk_gb",
+        "boot_disk_type",
+        "network",
+        "subnetwork",
+        "service_account",
+        "volumes",
+        "reference_volumes",
+    ]
+
     def __post_init__(self):
         # Attach variables for easy access
         self.workdir = os.path.realpath(os.path.dirname(self.workflow.persistence.path))
 
-        # There is an async client but I'm not sure we'd get much benefit
         try:
             self.batch = batch_v1.BatchServiceClient()
         except Exception as e:
             raise WorkflowError("Unable to connect to Google Batch.", e)
 
+        # Spec templates shared by jobs of the same kind
+        self.spec_cache = {}
+
+        # Reference images (and the jobs building them) by bucket prefix
+        self.references = {}
+        self.reference_lock = threading.Lock()
+
+        # The Snakefile is read (and uploaded) once
+        self.snakefile = None
+        self.staged = set()
+        self.storage = None
+
+        # Every job of this workflow run is labeled with the run id
+        self.run_id = str(uuid.uuid4())
+
+        status_modes = ["get", "list"]
+        if self.executor_settings.status_mode not in status_modes:
+            raise WorkflowError(
+                f"Status mode must be one of {status_modes}, "
+                f"found {self.executor_settings.status_mode}"
+            )
+
+        sizing_modes = ["off", "on", "report"]
+        if self.executor_settings.auto_machine_type not in sizing_modes:
+            raise WorkflowError(
+                f"Automatic machine type must be one of {sizing_modes}, "
+                f"found {self.executor_settings.auto_machine_type}"
+            )
+
+        # Buckets are mounted with the gcsfuse options of a profile
+        volumeutil.mount_options(self.executor_settings.mount_profile)
+
+        # Jobs can share the workflow directory over NFS, and then do not
+        # deploy the sources of the workflow
+        if self.get_shared_fs() is not None:
+            self.workflow.remote_execution_settings.job_deploy_sources = False
+
+        # Jobs can be right-sized from their resources, with a report of
+        # the machine type picked for each. A given catalog is also used to
+        # know how many tasks fit on a VM when bin packing.
+        self.machine_catalog = None
+        self.machine_sizes = {}
+        self.machine_report = []
+        if (
+            self.executor_settings.auto_machine_type != "off"
+            or self.executor_settings.machine_catalog
+        ):
+            self.machine_catalog = machines.MachineCatalog.load(
+                self.executor_settings.machine_catalog
+            )
+
+        metrics_formats = ["json", "prometheus"]
+        if self.executor_settings.metrics_format not in metrics_formats:
+            raise WorkflowError(
+                f"Metrics format must be one of {metrics_formats}, "
+                f"found {self.executor_settings.metrics_format}"
+            )
+
+        # Latency and errors of API calls, and the executor's own metrics
+        self.metrics = metricsutil.Metrics()
+        self.last_summary = time.monotonic()
+
+        # All calls to Google Cloud are retried on transient errors
+        breaker = apiutil.CircuitBreaker(
+            threshold=self.executor_settings.api_breaker_threshold,
+            cooldown=self.executor_settings.api_breaker_cooldown,
+        )
+        self.api = apiutil.ResilientApi(
+            timeout=self.executor_settings.api_timeout,
+            deadline=self.executor_settings.api_deadline,
+            breaker=breaker,
+            metrics=self.metrics,
+        )
+
+        # Rate limits must let requests through
+        for name in ["submit_qps", "log_requests_per_minute"]:
+            rate = getattr(self.executor_settings, name)
+            if rate is None or rate <= 0:
+                flag = "--googlebatch-" + name.replace("_", "-")
+                raise WorkflowError(f"{flag} must be greater than 0, found {rate}")
+
+        # Jobs are created concurrently, within a rate limit
+        self.submit_limiter = utils.TokenBucket(self.executor_settings.submit_qps)
+        self.submit_pool = ThreadPoolExecutor(
+            max_workers=max(1, self.executor_settings.submit_concurrency),
+            thread_name_prefix="googlebatch-submit",
+        )
+
+        # Logs of finished jobs are downloaded in the background
+        self.log_harvester = logutil.LogHarvester(
+            project=self.executor_settings.project,
+            logger=self.logger,
+            workers=self.executor_settings.log_workers,
+            requests_per_minute=self.executor_settings.log_requests_per_minute,
+            tail_seconds=self.executor_settings.log_tail_seconds,
+            batch_size=self.executor_settings.log_batch_size,
+            api=self.api,
+        )
+
+        # The async client (for status checks) is bound to the event loop
+        # of the status thread, so it is created on first use there
+        self.async_batch = None
+        self.status_poller = None
+        self.status_index = None
+
+        # Only jobs that are due are checked in adaptive polling
+        self.poll_scheduler = None
+        if self.executor_settings.adaptive_polling:
+            settings = self.workflow.remote_execution_settings
+            self.poll_scheduler = statusutil.PollScheduler(
+                interval=settings.seconds_between_status_checks,
+                max_interval=self.executor_settings.max_status_interval,
+            )
+
+        # Jobs can push state changes through Pub/Sub instead
+        self.last_checked = {}
+        self.notifications = None
+        topic = self.executor_settings.notification_topic
+        subscription = self.executor_settings.notification_subscription
+        if bool(topic) != bool(subscription):
+            raise WorkflowError(
+                "Job notifications need both a notification topic and subscription."
+            )
+        if subscription:
+            self.notifications = notifyutil.NotificationListener(
+                notifyutil.subscription_path(
+                    self.executor_settings.project, subscription
+                ),
+                logger=self.logger,
+            )
+            self.notifications.start()
+
+        # Jobs can run on warm workers (pilots), one per kind of job
+        self.pilots = None
+        if self.executor_settings.pilot_workers:
+            if not self.executor_settings.pilot_queue:
+                raise WorkflowError("Warm workers need a pilot queue.")
+            self.pilots = {}
+
     def get_param(self, job, param):
         """
         Simple courtesy function to get a job resource and fall back to defaults.
 
         1. First preference goes to googlebatch_ directive in step
-        2. Second preference goes to command line flag
-        3. Third preference falls back to default
+        2. Second preference goes to the size picked from job resources
+           (with an automatic machine type)
+        3. Third preference goes to command line flag
+        4. Fourth preference falls back to default
+        """
+        value = job.resources.get(f"googlebatch_{param}")
+        if value:
+            return value
+        if (
+            param in machines.sized_params
+            and self.executor_settings.auto_machine_type == "on"
+        ):
+            value = self.get_machine_size(job).get(param)
+            if value:
+                return value
+        return getattr(self.executor_settings, param, None)
+
+    def get_machine_size(self, job):
+        """
+        Get the machine type and task resources fitting a job's resources.
+
+        Sizes are looked up once per combination of threads, mem_mb,
+        disk_mb and GPUs. A job that nothing fits keeps the defaults.
+        """
+        threads = max(1, int(getattr(job, "threads", 1) or 1))
+        mem_mb = job.resources.get("mem_mb")
+        disk_mb = job.resources.get("disk_mb")
+        gpus = len(self.get_accelerators(job)) > 0
+        key = (threads, mem_mb, disk_mb, gpus)
+        if key in self.machine_sizes:
+            return self.machine_sizes[key]
+
+        memory = int(mem_mb or self.executor_settings.memory or 0)
+        size = {"cpu_milli": threads * 1000, "memory": memory}
+        if disk_mb:
+            size["boot_disk_gb"] = machines.boot_disk_gb(int(disk_mb))
+        machine = self.machine_catalog.choose(threads, memory, gpus)
+        if machine is None:
+            self.logger.warning(
+                f"No machine type in the catalog fits {threads} threads and "
+                f"{memory} MiB of memory, using the default machine type"
+            )
+        else:
+            size["machine_type"] = machine.name
+            size["price"] = machine.price
+        self.machine_sizes[key] = size
+        return size
+
+    def report_machine_size(self, job):
         """
-        return job.resources.get(f"googlebatch_{param}") or getattr(
-            self.executor_settings, param, None
+        Log (and keep for the report) the machine type picked for a job.
+        """
+        if self.executor_settings.auto_machine_type == "off":
+            return
+        explicit = job.resources.get("googlebatch_machine_type")
+        size = {} if explicit else self.get_machine_size(job)
+        choice = (
+            size.get("machine_type") or explicit or self.executor_settings.machine_type
         )
+        entry = {
+            "job": job.name,
+            "rule": job.rule.name,
+            "threads": getattr(job, "threads", None),
+            "mem_mb": job.resources.get("mem_mb"),
+            "disk_mb": job.resources.get("disk_mb"),
+            "nvidia_gpu": job.resources.get("nvidia_gpu"),
+            "machine_type": choice,
+            "spot_price": size.get("price"),
+            "used": self.get_param(job, "machine_type"),
+        }
+        self.machine_report.append(entry)
+        message = f"Machine type for job {job.name}: {choice}"
+        if entry["spot_price"] is not None:
+            message += f" (${entry['spot_price']:.4f}/h spot)"
+        if self.executor_settings.auto_machine_type == "report":
+            self.logger.info(f"{message}, running on {entry['used']}")
+        else:
+            self.logger.debug(message)
+
+    def write_machine_report(self):
+        """
+        Write the machine types picked for the jobs of this run.
+        """
+        if not self.machine_report:
+            return
+        path = os.path.join(
+            self.workdir,
+            ".snakemake",
+            "googlebatch_logs",
+            f"machine-types-{self.run_id}.json",
+        )
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as fd:
+                json.dump(self.machine_report, fd, indent=4)
+            self.logger.info(f"Machine types of the jobs written to {path}")
+        except Exception as e:
+            self.logger.warning(f"Failed to write the machine type report: {e}")
+        return path
 
     def get_task_resources(self, job):
         """
@@ -57,7 +323,10 @@ class GoogleBatchExecutor(RemoteExecutor):
         """
         Derive default labels for the job (and add custom)
         """
-        labels = {"snakemake-job": self.fix_job_name(job.name)}
+        labels = {
+            "snakemake-job": self.fix_job_name(job.name),
+            "snakemake-run": self.run_id,
+        }
         for contender in self.get_param(job, "labels").split(","):
             if not contender:
                 continue
@@ -74,20 +343,248 @@ class GoogleBatchExecutor(RemoteExecutor):
         """
         return {}
 
-    def add_storage(self, job, task):
+    def get_volumes(self, job):
         """
-        Add storage for a task, which requires a bucket and mount path.
+        Get the volume specs of a job (local SSDs, disks and buckets).
+
+        Reference volumes come last, with the image of their disks.
         """
-        bucket = self.get_param(job, "bucket")
-        if not bucket:
+        volumes = volumeutil.parse_volumes(self.get_param(job, "volumes"))
+        references = refutil.parse_references(self.get_param(job, "reference_volumes"))
+        for reference in references:
+            reference.image, reference.size_gb = self.get_reference_image(
+                job, reference
+            )
+        return volumes + references
+
+    def get_shared_fs(self):
+        """
+        Get the NFS share mounted at the workflow directory (None without).
+        """
+        share = self.executor_settings.shared_fs
+        if not share:
             return
+        server, _, remote_path = share.partition(":")
+        if not server or not remote_path.startswith("/"):
+            raise WorkflowError(
+                f"The shared file system must be <server>:<path>, found {share}"
+            )
+        return volumeutil.VolumeSpec(
+            "nfs", self.workdir, remote_path=remote_path, server=server
+        )
+
+    @property
+    def common_settings(self):
+        """
+        The common settings of this run, which depend on its shared file system.
+        """
+        return self.executor_settings.common_settings
+
+    def get_job_exec_prefix(self, job):
+        """
+        Jobs on the shared file system run in the workflow directory.
+        """
+        if self.executor_settings.shared_fs:
+            return f"cd {shlex.quote(self.workdir)}"
+        return ""
+
+    def get_python_executable(self):
+        """
+        Jobs use the Python of their VM, even with shared software deployment.
+        """
+        return "python"
+
+    def get_reference_image(self, job, reference):
+        """
+        Get the image (and disk size) of a reference volume.
+
+        The image is named by a hash of the objects under the prefix, so
+        it is reused by later runs until the data changes. If it is not
+        marked as ready, a Batch job starts building it, and the jobs that
+        need it are held back until it is done (see waiting_references).
+        """
+        with self.reference_lock:
+            if reference.url not in self.references:
+                self.references[reference.url] = self.build_reference_image(
+                    job, reference
+                )
+            build = self.references[reference.url]
+            return build["image"], build["size_gb"]
+
+    def build_reference_image(self, job, reference):
+        """
+        Find the image of a reference volume, or start the job building it.
+        """
+        objects = self.api.run(self.list_reference_objects, reference.url)
+        if not objects:
+            raise WorkflowError(f"The reference volume {reference.url} is empty.")
+        size_gb = reference.size_gb or refutil.disk_size_gb(objects)
+        digest = refutil.content_digest(objects)
+        name = refutil.image_name(digest, size_gb)
+        image = f"projects/{self.get_param(job, 'project')}/global/images/{name}"
+        build = {"image": image, "size_gb": size_gb, "builder": None, "error": None}
+        marker = refutil.marker_url(reference.url, name)
+        if self.api.run(self.object_exists, marker):
+            self.logger.info(f"Using the reference image {name} for {reference.url}")
+            return build
+
+        create_request = self.build_reference_request(
+            job, reference.url, name, digest, size_gb, marker
+        )
+        createdjob = self.create_job(create_request)
+        self.logger.info(
+            f"Building the reference image {name} for {reference.url} "
+            f"with {createdjob.name}, jobs that need it wait for it"
+        )
+        build["builder"] = createdjob.name
+        build["checked"] = time.monotonic()
+        return build
+
+    def waiting_references(self, job):
+        """
+        Get the reference volumes of a job whose images are still building.
+        """
+        references = refutil.parse_references(self.get_param(job, "reference_volumes"))
+        with self.reference_lock:
+            return [
+                reference.url
+                for reference in references
+                if self.references.get(reference.url, {}).get("builder")
+            ]
+
+    def check_reference_builds(self, urls):
+        """
+        Check the jobs building reference images, at most every
+        reference_poll_seconds each.
+        """
+        state = batch_v1.JobStatus.State
+        now = time.monotonic()
+        with self.reference_lock:
+            builds = [
+                self.references[url]
+                for url in urls
+                if self.references[url]["builder"]
+                and not self.references[url]["error"]
+                and now - self.references[url]["checked"]
+                >= self.executor_settings.reference_poll_seconds
+            ]
+        for build in builds:
+            builder = build["builder"]
+            status = self.api.call(self.batch.get_job, name=builder).status
+            with self.reference_lock:
+                build["checked"] = now
+                if status.state == state.SUCCEEDED:
+                    self.logger.info(f"Built the reference image {build['image']}")
+                    build["builder"] = None
+                elif status.state in [state.FAILED, state.DELETION_IN_PROGRESS]:
+                    build["error"] = (
+                        f"Building the reference image {build['image']} failed, "
+                        f"see the logs of {builder}"
+                    )
+
+    def reference_builders(self):
+        """
+        Get the Batch jobs still building reference images.
+        """
+        with self.reference_lock:
+            return [
+                build["builder"]
+                for build in self.references.values()
+                if build["builder"] and not build["error"]
+            ]
+
+    def build_reference_request(self, job, url, name, digest, size_gb, marker):
+        """
+        Build the request of the Batch job that builds a reference image.
+        """
+        runnable = batch_v1.Runnable()
+        runnable.script = batch_v1.Runnable.Script()
+        runnable.script.text = refutil.builder_script % {
+            "image": name,
+            "url": url,
+            "digest": digest,
+            "size_gb": size_gb,
+            "marker": marker,
+        }
+        task = batch_v1.TaskSpec()
+        task.runnables = [runnable]
+        task.max_retry_count = self.get_param(job, "retry_count")
+        group = batch_v1.TaskGroup()
+        group.task_count = 1
+        group.task_spec = task
 
-        gcs_bucket = batch_v1.GCS()
-        gcs_bucket.remote_path = bucket
-        gcs_volume = batch_v1.Volume()
-        gcs_volume.gcs = gcs_bucket
-        gcs_volume.mount_path = self.get_param(job, "mount_path")
-        task.volumes = [gcs_volume]
+        policy = batch_v1.AllocationPolicy.InstancePolicy()
+        policy.machine_type = refutil.builder_machine_type
+        instances = batch_v1.AllocationPolicy.InstancePolicyOrTemplate()
+        instances.policy = policy
+        allocation_policy = batch_v1.AllocationPolicy()
+        allocation_policy.instances = [instances]
+        network_policy = self.get_network_policy(job)
+        if network_policy is not None:
+            allocation_policy.network = network_policy
+        allocation_policy.service_account = self.get_service_account(job)
+
+        batchjob = batch_v1.Job()
+        batchjob.task_groups = [group]
+        batchjob.allocation_policy = allocation_policy
+        batchjob.labels = {"snakemake-job": "reference", "snakemake-run": self.run_id}
+        batchjob.logs_policy = batch_v1.LogsPolicy()
+        batchjob.logs_policy.destination = batch_v1.LogsPolicy.Destination.CLOUD_LOGGING
+
+        create_request = batch_v1.CreateJobRequest()
+        create_request.job = batchjob
+        create_request.job_id = f"snakemake-reference-{str(uuid.uuid4())[0:8]}"
+        create_request.request_id = str(uuid.uuid4())
+        create_request.parent = self.project_parent(job)
+        return create_request
+
+    def list_reference_objects(self, url):
+        """
+        List the objects under a prefix, as (name, checksum, size).
+        """
+        bucket, prefix = utils.split_gcs_url(url)
+        prefix = f"{prefix}/" if prefix else ""
+        return [
+            (blob.name, blob.crc32c or blob.md5_hash, blob.size)
+            for blob in self.get_storage().list_blobs(bucket, prefix=prefix)
+            if not blob.name.startswith(refutil.marker_prefix + "/")
+            and not blob.name.endswith("/")
+        ]
+
+    def object_exists(self, url):
+        bucket, name = utils.split_gcs_url(url)
+        return self.get_storage().bucket(bucket).blob(name).exists()
+
+    def get_storage(self):
+        """
+        Get the Cloud Storage client, creating it on first use.
+        """
+        if self.storage is None:
+            self.storage = storage.Client(project=self.executor_settings.project)
+        return self.storage
+
+    def add_storage(self, job, task):
+        """
+        Add storage for a task: the bucket (at the mount path) and volumes.
+
+        Volumes are added to those the task already has, and buckets are
+        mounted with the options of the job's mount profile.
+        """
+        volumes = self.get_volumes(job)
+        shared_fs = self.get_shared_fs()
+        if shared_fs is not None:
+            volumes.insert(0, shared_fs)
+        bucket = self.get_param(job, "bucket")
+        if bucket:
+            mount_path = self.get_param(job, "mount_path")
+            volumes.insert(
+                0, volumeutil.VolumeSpec("gcs", mount_path, remote_path=bucket)
+            )
+        mounts = volumeutil.task_volumes(
+            volumes, self.get_param(job, "mount_profile") or "default"
+        )
+        if mounts:
+            task.volumes = list(task.volumes) + mounts
 
     def generate_jobid(self, job):
         """
@@ -123,6 +620,8 @@ class GoogleBatchExecutor(RemoteExecutor):
 
         # This will ensure the Snakefile is in the PWD of the COS container
         container.volumes = ["/tmp/workdir:/tmp/workdir"]
+        if self.executor_settings.shared_fs:
+            container.volumes.append(f"{self.workdir}:{self.workdir}")
         container.options = (
             "--network host --workdir /tmp/workdir -e PYTHONUNBUFFERED=1"
         )
@@ -169,18 +668,90 @@ class GoogleBatchExecutor(RemoteExecutor):
         # Any custom snippets
         snippets = self.get_param(job, "snippets")
 
+        # Container-Optimized OS has no gsutil, so the Snakefile is written
         snakefile_path = "./Snakefile"
+        snakefile_url = None
         if "batch-cos" in family:
             snakefile_path = "/tmp/workdir/Snakefile"
+        else:
+            snakefile_url = self.stage_snakefile(snakefile)
         return cmdutil.get_writer(family)(
             command=command,
             snakefile=snakefile,
             snippets=snippets,
             snakefile_path=snakefile_path,
+            snakefile_url=snakefile_url,
             settings=self.workflow.executor_settings,
             resources=job.resources,
+            prefetch=self.get_prefetch(job),
+            verify=self.get_verify(job),
         )
 
+    def get_prefetch(self, job):
+        """
+        Get the script downloading the inputs of a job before it runs.
+
+        Containers (COS) run Snakemake in their own file system, so their
+        inputs are not prefetched.
+        """
+        concurrency = self.get_param(job, "prefetch_inputs")
+        if not concurrency or "batch-cos" in self.get_param(job, "image_family"):
+            return
+        inputs = self.get_storage_manifest(job.input)
+        if not inputs:
+            return
+        script = cmdutil.prefetch_script(inputs, concurrency)
+        prefix = self.get_job_exec_prefix(job)
+        return f"{prefix}\n{script}" if prefix else script
+
+    def get_verify(self, job):
+        """
+        Get the script checking the outputs of a job in storage after it ran.
+
+        Snakemake stores the outputs itself, so the script only uploads those
+        missing or different in storage. It runs in the Snakemake process
+        (see verify_snakemake), while the local copies still exist. As for
+        prefetching, outputs of containers (COS) are not checked.
+        """
+        concurrency = self.get_param(job, "verify_outputs")
+        if not concurrency or "batch-cos" in self.get_param(job, "image_family"):
+            return
+        cmdutil.check_verify_version()
+        outputs = self.get_storage_manifest(job.output)
+        if not outputs:
+            return
+        return cmdutil.verify_script(outputs, concurrency)
+
+    def get_storage_manifest(self, files):
+        """
+        Get the url and local path (on the VM) of files in Cloud Storage.
+
+        The local path is where Snakemake on the VM keeps its local copy.
+        """
+        settings = self.workflow.storage_settings
+        remote_prefix = str(settings.remote_job_local_storage_prefix)
+        if "$" in remote_prefix:
+            self.logger.debug(
+                f"Local copies in {remote_prefix} are not handled, it needs expanding"
+            )
+            return []
+        manifest = []
+        for path in files:
+            if not path.is_storage:
+                continue
+            storage_object = path.storage_object
+            if not storage_object.query.startswith("gs://"):
+                continue
+            if not storage_object.retrieve:
+                continue
+            local = os.path.relpath(
+                storage_object.local_path(), settings.local_storage_prefix
+            )
+            entry = (storage_object.query, os.path.join(remote_prefix, local))
+            if entry not in manifest:
+                manifest.append(entry)
+        return manifest
+
     def fix_job_name(self, name):
         """
         Replace illegal symbols and fix the job name length to adhere to
@@ -188,15 +759,321 @@ class GoogleBatchExecutor(RemoteExecutor):
         """
         return name.replace("_", "-").replace(".", "")[:50]
 
+    def run_jobs(self, jobs: List[JobExecutorInterface]):
+        """
+        Run a list of jobs that are ready at the same time.
+
+        Job requests are built here, one after the other, and handed to the
+        submission pool, which sends create_job calls concurrently (limited
+        to submit_qps per second). Each job is reported as submitted as soon
+        as its call completes. With an array size above 1, jobs that only
+        differ in their command are packed into job arrays first.
+        """
+        requests = []
+        for job in jobs:
+            self.run_job_pre(job)
+            create_request, logfile = self.build_job_request(job)
+            waiting = self.waiting_references(job)
+            if waiting:
+                self.hold_job(job, create_request, logfile, waiting)
+                continue
+            if self.pilots is not None and self.can_pack(job):
+                self.submit_to_pilot(job, create_request, logfile)
+                continue
+            requests.append((job, create_request, logfile))
+
+        futures = {}
+        for packed in self.pack_requests(requests):
+            if len(packed) == 1:
+                create_request = packed[0][1]
+            else:
+                create_request = self.build_array_request(packed)
+            future = self.submit_pool.submit(self.create_job, create_request)
+            futures[future] = packed
+            self.metrics.set_gauge("submission_queue_depth", len(futures))
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            self.metrics.set_gauge("submission_queue_depth", len(futures) - done)
+            packed = futures[future]
+            try:
+                createdjob = future.result()
+            except Exception as e:
+                msg = f"Failed to submit Google Batch job: {e}. "
+                for job, _, _ in packed:
+                    self.report_job_error(SubmittedJobInfo(job), msg=msg)
+                continue
+            if len(packed) == 1:
+                job, _, logfile = packed[0]
+                self.report_created_job(job, createdjob, logfile)
+            else:
+                self.report_created_array(packed, createdjob)
+
+    def can_pack(self, job: JobExecutorInterface):
+        """
+        Determine if a job can be run as a task of a job array.
+
+        Containers run a fixed entrypoint, and snippets or multiple work
+        tasks expect the job to own the Batch job.
+        """
+        family = self.get_param(job, "image_family")
+        return (
+            "batch-cos" not in family
+            and self.get_param(job, "work_tasks") == 1
+            and not self.get_param(job, "snippets")
+        )
+
+    def array_signature(self, create_request: batch_v1.CreateJobRequest):
+        """
+        Everything about a job request but the Snakemake command.
+        """
+        job = batch_v1.Job.deserialize(batch_v1.Job.serialize(create_request.job))
+        job.task_groups[0].task_spec.runnables[-1].script.text = ""
+        job.labels["snakemake-job"] = ""
+        spec = batch_v1.Job.pb(job).SerializeToString(deterministic=True)
+        return create_request.parent, spec
+
+    def tasks_per_vm(self, job: JobExecutorInterface):
+        """
+        The number of tasks of a job that share a VM when bin packing.
+
+        As many as fit by CPU and memory on the machine type, and 1 without
+        bin packing, for jobs with GPUs, or unknown machine types.
+        """
+        if not self.executor_settings.bin_pack or self.get_accelerators(job):
+            return 1
+        return machines.tasks_per_vm(
+            self.get_param(job, "machine_type"),
+            self.get_param(job, "cpu_milli"),
+            self.get_param(job, "memory"),
+            self.machine_catalog,
+        )
+
+    def pack_requests(self, requests):
+        """
+        Group job requests with the same signature, up to array_size each.
+
+        With bin packing, a group holds at least as many jobs as fit on a VM.
+        """
+        size = self.executor_settings.array_size or 1
+        packed = []
+        arrays = {}
+        for request in requests:
+            job, create_request, _ = request
+            if not self.can_pack(job) or max(size, self.tasks_per_vm(job)) < 2:
+                packed.append([request])
+                continue
+            signature = self.array_signature(create_request)
+            arrays.setdefault(signature, []).append(request)
+
+        for array in arrays.values():
+            chunk = max(size, self.tasks_per_vm(array[0][0]))
+            packed += [array[i : i + chunk] for i in range(0, len(array), chunk)]
+        return packed
+
+    def build_array_request(self, packed):
+        """
+        Build one request running each packed job as a task, by task index.
+
+        The barrier is left out, since tasks of a job array do not wait for
+        each other. With bin packing, the tasks share VMs, and the setup and
+        Snakefile steps run once per VM.
+        """
+        create_request = packed[0][1]
+        group = create_request.job.task_groups[0]
+        commands = [
+            request.job.task_groups[0].task_spec.runnables[-1].script.text
+            for _, request, _ in packed
+        ]
+        runnables = [r for r in group.task_spec.runnables if "barrier" not in r]
+        runnables[-1].script.text = cmdutil.array_command(commands)
+        group.task_count = len(packed)
+
+        per_vm = min(self.tasks_per_vm(packed[0][0]), len(packed))
+        if per_vm > 1:
+            group.task_count_per_node = per_vm
+        if group.task_count_per_node > 1:
+            for runnable in runnables[:-1]:
+                if "script" in runnable:
+                    runnable.script.text = cmdutil.once_per_vm(runnable.script.text)
+        group.task_spec.runnables = runnables
+
+        message = f"Packing {len(packed)} jobs into Google Batch job"
+        if group.task_count_per_node > 1:
+            message += f", {group.task_count_per_node} per VM,"
+        self.logger.info(f"{message} {create_request.job_id}")
+        return create_request
+
     def run_job(self, job: JobExecutorInterface):
         """
         Run the Google Batch job.
+        """
+        create_request, logfile = self.build_job_request(job)
+        waiting = self.waiting_references(job)
+        if waiting:
+            return self.hold_job(job, create_request, logfile, waiting)
+        if self.pilots is not None and self.can_pack(job):
+            return self.submit_to_pilot(job, create_request, logfile)
+        createdjob = self.create_job(create_request)
+        self.report_created_job(job, createdjob, logfile)
+
+    def hold_job(self, job, create_request, logfile, references):
+        """
+        Report a job that waits for reference images as submitted.
+
+        Its request is created by the status checks once the images are
+        built, as a Batch job of its own (not packed or on warm workers).
+        """
+        name = f"{create_request.parent}/jobs/{create_request.job_id}"
+        self.logger.info(f"Job {name} waits for reference volumes {references}")
+        aux = {
+            "held": create_request,
+            "references": references,
+            "logfile": logfile,
+            "last_seen": None,
+        }
+        self.report_job_submission(SubmittedJobInfo(job, external_jobid=name, aux=aux))
+
+    def create_job(self, create_request: batch_v1.CreateJobRequest):
+        """
+        Create a Batch job, waiting for the submission rate limit first.
+
+        Submissions are held back while the circuit breaker reports the API
+        as degraded. The request id makes retried creations idempotent.
+        """
+        if self.api.breaker.is_open:
+            self.logger.warning(
+                "Google Batch API is degraded, "
+                f"holding back submissions for {self.api.breaker.remaining():.0f}s."
+            )
+        self.api.breaker.wait()
+        self.submit_limiter.acquire()
+        try:
+            return self.api.call(self.batch.create_job, create_request)
+        except AlreadyExists:
+            # An earlier attempt was created after all
+            name = f"{create_request.parent}/jobs/{create_request.job_id}"
+            return self.api.call(self.batch.get_job, name=name)
+
+    def report_created_job(self, job, createdjob, logfile):
+        """
+        Report a created Batch job as submitted.
+        """
+        print(createdjob)
+
+        # Save aux metadata
+        # Last seen will hold the timestamp of last recorded status
+        aux = {"batch_job": createdjob, "logfile": logfile, "last_seen": None}
+
+        # Record job info - the name is what we use to get a status later
+        self.report_job_submission(
+            SubmittedJobInfo(job, external_jobid=createdjob.name, aux=aux)
+        )
+
+    def get_pilot(self, create_request: batch_v1.CreateJobRequest):
+        """
+        Get the pilot for jobs with the same signature as a job request.
+        """
+        parent, spec = self.array_signature(create_request)
+        key = hashlib.sha256(parent.encode() + spec).hexdigest()[:16]
+        if key not in self.pilots:
+            url = (
+                f"{self.executor_settings.pilot_queue.rstrip('/')}/{self.run_id}/{key}"
+            )
+            self.pilots[key] = pilotutil.Pilot(
+                key,
+                pilotutil.get_queue(url),
+                create_request,
+                max_workers=self.executor_settings.pilot_workers,
+            )
+        return self.pilots[key]
+
+    def submit_to_pilot(self, job, create_request, logfile):
+        """
+        Queue the command of a job for the warm workers of its pilot.
+        """
+        pilot = self.get_pilot(create_request)
+        task = create_request.job_id
+        command = create_request.job.task_groups[0].task_spec.runnables[-1].script
+        pilot.queue.put(task, command.text)
+        with pilot.lock:
+            pilot.tasks.add(task)
+        self.scale_pilot(pilot)
+
+        aux = {"pilot": pilot.key, "task": task, "logfile": logfile, "last_seen": None}
+        self.report_job_submission(
+            SubmittedJobInfo(
+                job, external_jobid=f"{pilot.queue.url}/queue/{task}", aux=aux
+            )
+        )
+
+    def scale_pilot(self, pilot):
+        """
+        Create workers for the queued tasks of a pilot, up to its maximum.
+        """
+        with pilot.lock:
+            for _ in range(pilot.needed()):
+                create_request = self.build_worker_request(pilot)
+                createdjob = self.create_job(create_request)
+                self.logger.info(f"Started warm worker {createdjob.name}")
+                pilot.workers[createdjob.name] = create_request.job_id
+
+    def build_worker_request(self, pilot):
+        """
+        Build the request of a worker, running the worker loop as its command.
+
+        Workers run many jobs, so the run duration of a job does not apply.
+        """
+        create_request = batch_v1.CreateJobRequest.deserialize(
+            batch_v1.CreateJobRequest.serialize(pilot.template)
+        )
+        create_request.job_id = f"snakemake-pilot-{str(uuid.uuid4())[0:8]}"
+        create_request.request_id = str(uuid.uuid4())
+        create_request.job.labels["snakemake-job"] = "pilot"
+
+        task = create_request.job.task_groups[0].task_spec
+        runnables = [r for r in task.runnables if "barrier" not in r]
+        runnables[-1].script.text = pilotutil.worker_script(
+            pilot.queue,
+            create_request.job_id,
+            idle_ttl=self.executor_settings.pilot_idle_ttl,
+            poll_seconds=self.executor_settings.pilot_poll_seconds,
+        )
+        task.runnables = runnables
+        task.max_run_duration = None
+        return create_request
+
+    def report_created_array(self, packed, createdjob):
+        """
+        Report each job packed into a created Batch job as submitted.
+
+        The external job id of each is the name of its task.
+        """
+        print(createdjob)
+        group = createdjob.task_groups[0].name if createdjob.task_groups else ""
+        group = group or f"{createdjob.name}/taskGroups/group0"
+        for index, (job, _, logfile) in enumerate(packed):
+            aux = {
+                "batch_job": createdjob,
+                "logfile": logfile,
+                "last_seen": None,
+                "array": createdjob.name,
+                "task_group": group,
+                "task_index": index,
+            }
+            self.report_job_submission(
+                SubmittedJobInfo(job, external_jobid=f"{group}/tasks/{index}", aux=aux)
+            )
+
+    def build_job_request(self, job: JobExecutorInterface):
+        """
+        Build the request to create the Google Batch job, and its logfile.
 
         This involves creating one or more runnables that are packaged in
         a task, and the task is put into a group that is associated with a job.
         """
         logfile = job.logfile_suggestion(os.path.join(".snakemake", "googlebatch_logs"))
         os.makedirs(os.path.dirname(logfile), exist_ok=True)
+        self.report_machine_size(job)
 
         # This will create one simple runnable for a task
         task = batch_v1.TaskSpec()
@@ -206,10 +1083,10 @@ class GoogleBatchExecutor(RemoteExecutor):
         # The command writer prepares the final command, snippets, etc.
         writer = self.get_command_writer(job)
 
-        # Setup command
-        setup_command = writer.setup()
-        self.logger.info("\n🌟️ Setup Command:")
-        print(setup_command)
+        # Setup and Snakefile steps are shared by jobs of the same kind
+        setup, snakefile_step = self.cached_spec(
+            self.get_setup_key(job), lambda: self.get_setup_runnables(writer)
+        )
 
         # Add environment variables to the task
         envars = self.workflow.spawned_job_args_factory.envvars()
@@ -221,7 +1098,6 @@ class GoogleBatchExecutor(RemoteExecutor):
         container = self.get_container(job)
         if container is not None:
             runnable.container = container
-            snakefile_text = writer.write_snakefile()
         else:
             # Run command (not used for COS)
             run_command = writer.run()
@@ -230,21 +1106,15 @@ class GoogleBatchExecutor(RemoteExecutor):
 
             runnable.script = batch_v1.Runnable.Script()
             runnable.script.text = run_command
-            snakefile_text = writer.write_snakefile()
-
-        # Runnable to write Snakefile on the host
-        snakefile_step = batch_v1.Runnable()
-        snakefile_step.script = batch_v1.Runnable.Script()
-        snakefile_step.script.text = snakefile_text
 
         # Note that secret variables seem to require some
         # extra secret API enabled
         runnable.environment.variables = envars
 
-        # Snakemake setup must finish before snakemake is run
-        setup = batch_v1.Runnable()
-        setup.script = batch_v1.Runnable.Script()
-        setup.script.text = setup_command
+        # Temporary files go to the fastest disk
+        scratch = volumeutil.scratch_path(self.get_volumes(job))
+        if scratch is not None:
+            runnable.environment.variables["TMPDIR"] = scratch
 
         # Placement policy
         # https://cloud.google.com/python/docs/reference/batch/latest/google.cloud.batch_v1.types.AllocationPolicy.PlacementPolicy
@@ -255,6 +1125,12 @@ class GoogleBatchExecutor(RemoteExecutor):
         barrier.barrier.name = "wait-for-setup"
         task.runnables = [setup, snakefile_step, barrier, runnable]
 
+        # Local SSDs are striped before anything uses them
+        for script in reversed(volumeutil.raid0_steps(self.get_volumes(job))):
+            step = batch_v1.Runnable()
+            step.script = batch_v1.Runnable.Script(text=script)
+            task.runnables.insert(0, step)
+
         # Are we adding storage?
         self.add_storage(job, task)
 
@@ -274,7 +1150,9 @@ class GoogleBatchExecutor(RemoteExecutor):
 
         # This includes instances (machine type) boot disk and policy
         # Also preemtion
-        policy = self.get_allocation_policy(job)
+        policy = self.cached_spec(
+            self.get_policy_key(job), lambda: self.get_allocation_policy(job)
+        )
 
         # If we have preemption for the job and retry, update task retries with it
         retries = self.workflow.remote_execution_settings.preemptible_retries
@@ -287,6 +1165,8 @@ class GoogleBatchExecutor(RemoteExecutor):
         batchjob.allocation_policy = policy
         batchjob.labels = self.get_labels(job)
 
+        self.add_notifications(batchjob, job)
+
         # We use Cloud Logging as it's an out of the box available option
         batchjob.logs_policy = batch_v1.LogsPolicy()
         batchjob.logs_policy.destination = batch_v1.LogsPolicy.Destination.CLOUD_LOGGING
@@ -294,20 +1174,85 @@ class GoogleBatchExecutor(RemoteExecutor):
         create_request = batch_v1.CreateJobRequest()
         create_request.job = batchjob
         create_request.job_id = self.generate_jobid(job)
+        create_request.request_id = str(uuid.uuid4())
 
         # The job's parent is the region in which the job will run
         create_request.parent = self.project_parent(job)
-        createdjob = self.batch.create_job(create_request)
-        print(createdjob)
+        return create_request, logfile
 
-        # Save aux metadata
-        # Last seen will hold the timestamp of last recorded status
-        aux = {"batch_job": createdjob, "logfile": logfile, "last_seen": None}
+    def cached_spec(self, key, build):
+        """
+        Get a spec template from the cache, building it on first use.
 
-        # Record job info - the name is what we use to get a status later
-        self.report_job_submission(
-            SubmittedJobInfo(job, external_jobid=createdjob.name, aux=aux)
+        Templates are never changed, since assigning a message to a field
+        of another (e.g., a policy to a job) copies it. A key of None means
+        the spec cannot be shared, so it is built every time.
+        """
+        if key is None:
+            return build()
+        if key not in self.spec_cache:
+            self.spec_cache[key] = build()
+        return self.spec_cache[key]
+
+    def get_policy_key(self, job):
+        """
+        Everything the allocation policy of a job is built from.
+        """
+        params = [self.get_param(job, name) for name in self.policy_params]
+        return (
+            "policy",
+            *params,
+            job.resources.get("nvidia_gpu"),
+            self.is_preemptible(job),
+        )
+
+    def get_setup_key(self, job):
+        """
+        Everything the setup and Snakefile steps of a job are built from.
+
+        The setup of a container, and snippets, include the job's command.
+        """
+        family = self.get_param(job, "image_family")
+        if "batch-cos" in family or self.get_param(job, "snippets"):
+            return
+        return ("setup", family)
+
+    def get_setup_runnables(self, writer):
+        """
+        Get the runnables to set up Snakemake and write the Snakefile.
+        """
+        setup_command = writer.setup()
+        self.logger.info("\n🌟️ Setup Command:")
+        print(setup_command)
+
+        # Snakemake setup must finish before snakemake is run
+        setup = batch_v1.Runnable()
+        setup.script = batch_v1.Runnable.Script()
+        setup.script.text = setup_command
+
+        # Runnable to write Snakefile on the host
+        snakefile_step = batch_v1.Runnable()
+        snakefile_step.script = batch_v1.Runnable.Script()
+        snakefile_step.script.text = writer.write_snakefile()
+        return setup, snakefile_step
+
+    def add_notifications(self, batchjob, job):
+        """
+        Have Google Batch publish job and task state changes to the
+        notification topic.
+        """
+        if self.notifications is None:
+            return
+        topic = notifyutil.topic_path(
+            self.get_param(job, "project"), self.executor_settings.notification_topic
         )
+        notifications = []
+        for type_ in ["JOB_STATE_CHANGED", "TASK_STATE_CHANGED"]:
+            notification = batch_v1.JobNotification()
+            notification.pubsub_topic = topic
+            notification.message.type_ = batch_v1.JobNotification.Type[type_]
+            notifications.append(notification)
+        batchjob.notifications = notifications
 
     def project_parent(self, job):
         """
@@ -356,9 +1301,10 @@ class GoogleBatchExecutor(RemoteExecutor):
             policy.accelerators = accelerators
 
         # Customize boot disk
-        boot_disk = self.get_boot_disk(job)
-        if boot_disk is not None:
-            policy.boot_disk = boot_disk
+        self.get_boot_disk(job, policy.boot_disk)
+
+        # Local SSDs and persistent disks of the volumes
+        policy.disks = volumeutil.attached_disks(self.get_volumes(job))
 
         instances.policy = policy
         allocation_policy.instances = [instances]
@@ -403,27 +1349,23 @@ class GoogleBatchExecutor(RemoteExecutor):
             service_account.email = service_account_email
         return service_account
 
-    def get_boot_disk(self, job):
+    def get_boot_disk(self, job, boot_disk):
         """
-        Given a job request, add a customized boot disk.
+        Given a job request, customize the boot disk.
+
+        The image of the family is kept unless a boot disk image is given.
         """
         # Reference disk, boot disk type, and size
         image = self.get_param(job, "boot_disk_image")
         size = self.get_param(job, "boot_disk_gb")
         typ = self.get_param(job, "boot_disk_type")
 
-        # Cut out early if no customization
-        if all(x is None for x in [image, size, typ]):
-            return
-
-        boot_disk = batch_v1.AllocationPolicy.Disk()
         if image is not None:
             boot_disk.image = image
         if size is not None:
             boot_disk.size_gb = size
         if typ is not None:
             boot_disk.type_ = typ
-        return boot_disk
 
     def get_accelerators(self, job):
         """
@@ -462,8 +1404,39 @@ class GoogleBatchExecutor(RemoteExecutor):
 
         This might need to be improved to support storage, etc.
         """
-        assert os.path.exists(self.workflow.main_snakefile)
-        return utils.read_file(self.workflow.main_snakefile)
+        if self.snakefile is None:
+            assert os.path.exists(self.workflow.main_snakefile)
+            self.snakefile = utils.read_file(self.workflow.main_snakefile)
+        return self.snakefile
+
+    def stage_snakefile(self, snakefile):
+        """
+        Upload the Snakefile under its hash to the source prefix, once.
+
+        The url is returned (None without a source prefix), so jobs download
+        the Snakefile instead of having it in their request.
+        """
+        prefix = self.executor_settings.source_prefix
+        if not prefix:
+            return
+        digest = cmdutil.snakefile_digest(snakefile)
+        url = f"{prefix.rstrip('/')}/snakefiles/{digest}/Snakefile"
+        if url not in self.staged:
+            self.api.run(self.upload_snakefile, url, snakefile)
+            self.staged.add(url)
+        return url
+
+    def upload_snakefile(self, url, snakefile):
+        """
+        Upload a Snakefile, unless the object (with the same hash) exists.
+        """
+        bucket, name = utils.split_gcs_url(url)
+        blob = self.get_storage().bucket(bucket).blob(name)
+        try:
+            blob.upload_from_string(snakefile, if_generation_match=0)
+            self.logger.info(f"Uploaded the Snakefile to {url}")
+        except PreconditionFailed:
+            self.logger.debug(f"The Snakefile is already at {url}")
 
     def get_snakefile(self):
         """
@@ -472,125 +1445,554 @@ class GoogleBatchExecutor(RemoteExecutor):
         assert os.path.exists(self.workflow.main_snakefile)
         return os.path.relpath(self.workflow.main_snakefile, os.getcwd())
 
+    def get_async_batch(self):
+        """
+        Get the async Batch client, creating it on first use.
+        """
+        if self.async_batch is None:
+            try:
+                self.async_batch = batch_v1.BatchServiceAsyncClient()
+            except Exception as e:
+                raise WorkflowError("Unable to connect to Google Batch.", e)
+        return self.async_batch
+
+    def get_status_poller(self):
+        """
+        Get the status poller for requesting jobs one by one.
+        """
+        if self.status_poller is None:
+            self.status_poller = statusutil.StatusPoller(
+                self.get_async_batch(),
+                self.executor_settings.status_concurrency,
+                api=self.api,
+            )
+        return self.status_poller
+
+    def get_status_index(self):
+        """
+        Get the status index for listing all jobs of the run.
+        """
+        if self.status_index is None:
+            self.status_index = statusutil.StatusIndex(
+                self.get_async_batch(), "snakemake-run", self.run_id, api=self.api
+            )
+        return self.status_index
+
+    async def get_job_statuses(self, active_jobs: List[SubmittedJobInfo]):
+        """
+        Get a lookup of external job id to the Batch job (or an exception).
+
+        In list mode, one paged list_jobs request per parent refreshes the
+        status index. Jobs that are not listed yet (e.g., just submitted)
+        are requested one by one, as are all jobs if listing fails.
+        """
+        tasks = [j for j in active_jobs if "task_index" in j.aux]
+        piloted = [j for j in active_jobs if "pilot" in j.aux]
+        held = [j for j in active_jobs if "held" in j.aux]
+        active_jobs = [
+            j
+            for j in active_jobs
+            if "task_index" not in j.aux
+            and "pilot" not in j.aux
+            and "held" not in j.aux
+        ]
+        names = [j.external_jobid for j in active_jobs]
+        responses = {}
+        if tasks:
+            responses.update(await self.get_task_statuses(tasks))
+        if piloted:
+            responses.update(await self.get_pilot_statuses(piloted))
+        if held:
+            responses.update(await self.get_held_statuses(held))
+        if active_jobs and self.executor_settings.status_mode == "list":
+            index = self.get_status_index()
+            try:
+                await index.refresh(self.project_parent(j.job) for j in active_jobs)
+            except Exception as e:
+                self.logger.warning(
+                    f"Unable to list Google Batch jobs, requesting them one by one: {e}"
+                )
+            for name in names:
+                if index.get(name) is not None:
+                    responses[name] = index.get(name)
+
+        missing = [name for name in names if name not in responses]
+        if missing:
+            poller = self.get_status_poller()
+            responses.update(await poller.get_jobs(missing))
+        return responses
+
+    async def get_task_statuses(self, tasks: List[SubmittedJobInfo]):
+        """
+        Get a lookup of external job id to the task (or an exception) for jobs
+        packed into job arrays, with one list_tasks request per array.
+
+        Tasks that are not listed yet are left out.
+        """
+        groups = list(dict.fromkeys(j.aux["task_group"] for j in tasks))
+        listings = await self.get_status_poller().get_tasks(groups)
+        found = {}
+        for listing in listings.values():
+            if not isinstance(listing, Exception):
+                found.update((task.name, task) for task in listing)
+
+        responses = {}
+        for j in tasks:
+            listing = listings[j.aux["task_group"]]
+            if isinstance(listing, Exception):
+                responses[j.external_jobid] = listing
+            elif j.external_jobid in found:
+                responses[j.external_jobid] = found[j.external_jobid]
+        return responses
+
+    async def get_pilot_statuses(self, piloted: List[SubmittedJobInfo]):
+        """
+        Get a lookup of external job id to a task (or an exception) for jobs
+        on warm workers, from the results in the queue of each pilot.
+
+        Jobs claimed by a worker that stopped without a result have failed.
+        Pilots with queued jobs and too few workers get new ones.
+        """
+        pilots = [
+            self.pilots[key] for key in dict.fromkeys(j.aux["pilot"] for j in piloted)
+        ]
+        workers = {}
+        for pilot in pilots:
+            with pilot.lock:
+                workers[pilot.key] = dict(pilot.workers)
+        worker_jobs = await self.get_status_poller().get_jobs(
+            [name for names in workers.values() for name in names]
+        )
+
+        results = {}
+        stopped = set()
+        for pilot in pilots:
+            for name, worker in workers[pilot.key].items():
+                response = worker_jobs[name]
+                if isinstance(response, NotFound) or (
+                    isinstance(response, batch_v1.Job)
+                    and response.status.state.name in ["SUCCEEDED", "FAILED"]
+                ):
+                    stopped.add(worker)
+                    with pilot.lock:
+                        pilot.workers.pop(name, None)
+            try:
+                results[pilot.key] = await asyncio.to_thread(pilot.queue.results)
+            except Exception as e:
+                results[pilot.key] = e
+
+        State = batch_v1.TaskStatus.State
+        responses = {}
+        for j in piloted:
+            pilot = self.pilots[j.aux["pilot"]]
+            result = results[pilot.key]
+            if isinstance(result, Exception):
+                responses[j.external_jobid] = result
+                continue
+            state = State.PENDING
+            if j.aux["task"] in result:
+                state = State.SUCCEEDED if result[j.aux["task"]] == 0 else State.FAILED
+            elif stopped:
+                try:
+                    claim = await asyncio.to_thread(
+                        pilot.queue.claimed_by, j.aux["task"]
+                    )
+                except Exception as e:
+                    responses[j.external_jobid] = e
+                    continue
+                if pilotutil.claim_worker(claim) in stopped:
+                    state = State.FAILED
+            responses[j.external_jobid] = batch_v1.Task(
+                name=j.external_jobid, status=batch_v1.TaskStatus(state=state)
+            )
+
+        # Jobs whose results could not be read stay queued
+        finished = {
+            j.aux["task"]
+            for j in piloted
+            if isinstance(responses[j.external_jobid], batch_v1.Task)
+            and responses[j.external_jobid].status.state
+            in [State.SUCCEEDED, State.FAILED]
+        }
+        for pilot in pilots:
+            with pilot.lock:
+                pilot.tasks.difference_update(
+                    j.aux["task"]
+                    for j in piloted
+                    if j.aux["pilot"] == pilot.key and j.aux["task"] in finished
+                )
+                needed = pilot.needed()
+            if needed:
+                await asyncio.to_thread(self.scale_pilot, pilot)
+        return responses
+
+    async def get_held_statuses(self, held: List[SubmittedJobInfo]):
+        """
+        Get a lookup of external job id to the Batch job (or an exception) for
+        jobs waiting for reference images, creating those whose images are
+        built. Jobs still waiting are reported as queued.
+        """
+        urls = list(dict.fromkeys(url for j in held for url in j.aux["references"]))
+        await asyncio.to_thread(self.check_reference_builds, urls)
+
+        responses = {}
+        for j in held:
+            with self.reference_lock:
+                builds = [self.references[url] for url in j.aux["references"]]
+            errors = [build["error"] for build in builds if build["error"]]
+            if errors:
+                responses[j.external_jobid] = WorkflowError(errors[0])
+                continue
+            if any(build["builder"] for build in builds):
+                responses[j.external_jobid] = batch_v1.Job(
+                    name=j.external_jobid,
+                    status=batch_v1.JobStatus(state=batch_v1.JobStatus.State.QUEUED),
+                )
+                continue
+            try:
+                createdjob = await asyncio.to_thread(self.create_job, j.aux["held"])
+            except Exception as e:
+                responses[j.external_jobid] = e
+                continue
+            for key in ["held", "references"]:
+                del j.aux[key]
+            j.aux["batch_job"] = createdjob
+            j.external_jobid = createdjob.name
+            responses[j.external_jobid] = createdjob
+        return responses
+
     async def check_active_jobs(self, active_jobs: List[SubmittedJobInfo]):
         """
         Check the status of active jobs.
         """
+        # Jobs that are not due stay active unchecked
+        now = time.monotonic()
+        self.metrics.set_gauge("active_jobs", len(active_jobs))
+        changed = set()
+        if self.notifications is not None:
+            changed = self.notifications.take_changed()
+        due = []
+        for j in active_jobs:
+            if self.is_due(j, now, changed):
+                due.append(j)
+            else:
+                yield j
+        active_jobs = due
+
+        responses = await self.get_job_statuses(active_jobs) if active_jobs else {}
+
         # Loop through active jobs and act on status
         for j in active_jobs:
-            jobid = j.external_jobid
-            request = batch_v1.GetJobRequest(name=jobid)
+            response = responses.get(j.external_jobid)
 
-            # Aux logs are consistently here
-            aux_logs = [j.aux["logfile"]]
-            last_seen = j.aux["last_seen"]
+            # Tasks of a new job array might not be listed yet
+            if response is None:
+                self.recheck(j, changed)
+                yield j
+                continue
 
-            try:
-                response = self.batch.get_job(request=request)
-            except DeadlineExceeded:
-                msg = f"Google Batch job '{j.external_jobid}' exceeded deadline. "
-                self.report_job_error(j, msg=msg, aux_logs=aux_logs)
+            if isinstance(response, NotFound):
+                msg = f"Google Batch job '{j.external_jobid}' no longer exists. "
+                self.report_job_error(j, msg=msg, aux_logs=[j.aux["logfile"]])
+                continue
+
+            # Requests were already retried, so check again next time
+            if isinstance(response, Exception) and self.is_transient(response):
+                self.logger.warning(
+                    f"Unable to get status of Google Batch job "
+                    f"'{j.external_jobid}', checking again later: {response}"
+                )
+                self.recheck(j, changed)
                 yield j
+                continue
 
-            self.logger.info(f"Job {jobid} has state {response.status.state.name}")
-            for event in response.status.status_events:
-                if not last_seen or event.event_time.nanosecond > last_seen:
-                    self.logger.info(f"{event.type_}: {event.description}")
-                    last_seen = event.event_time.nanosecond
-
-            # Update last seen for next time (TODO not sure this is sticking)
-            j.aux["last_seen"] = last_seen
-
-            # Possible statuses:
-            # RUNNING
-            # SCHEDULED
-            # QUEUED
-            # STATE_UNSPECIFIED
-            # SUCCEEDED
-            # FAILED
-            # DELETION_IN_PROGRESS
-            if response.status.state.name in ["FAILED", "SUCCEEDED"]:
-                self.save_finished_job_logs(j)
-
-            if response.status.state.name == "FAILED":
-                msg = f"Google Batch job '{j.external_jobid}' failed. "
-                self.report_job_error(j, msg=msg, aux_logs=aux_logs)
-
-            elif response.status.state.name == "SUCCEEDED":
-                self.report_job_success(j)
-
-            # Otherwise, we are queued / scheduled / running, etc.
-            else:
+            if isinstance(response, Exception):
+                raise response
+
+            if self.handle_job_status(j, response):
+                self.schedule_poll(j, response.status.state.name, now)
                 yield j
+            else:
+                self.schedule_poll(j, None, now)
 
-    def save_finished_job_logs(
-        self,
-        job_info: SubmittedJobInfo,
-        sleeps=60,
-        page_size=1000,
-    ):
-        """
-        Download logs using Google Cloud Logging API and save
-        them locally. Since tail logging does not work, this function
-        is run only at the end of the job.
-        """
-        job_uid = job_info.aux["batch_job"].uid
-        filter_query = f"labels.job_uid={job_uid}"
-        logfname = job_info.aux["logfile"]
-
-        log_client = logging.Client(project=self.executor_settings.project)
-        logger = log_client.logger("batch_task_logs")
-
-        def attempt_log_save(fname, logger, query, page_size):
-            with open(fname, "w", encoding="utf-8") as logfile:
-                for log_entry in logger.list_entries(
-                    filter_=query,
-                    page_size=page_size,
-                ):
-                    logfile.write(str(log_entry.payload) + "\n")
+        # Logs of all jobs finished in this round are downloaded together
+        self.log_harvester.dispatch()
+        self.metrics.observe("poll_cycle_seconds", time.monotonic() - now)
+        self.log_metrics_summary()
 
-        self.logger.info(f"Saving logs for Batch job {job_uid} to {logfname}.")
+    def log_metrics_summary(self):
+        """
+        Log a summary of the metrics, at most every metrics_summary_seconds.
+        """
+        interval = self.executor_settings.metrics_summary_seconds
+        now = time.monotonic()
+        if not interval or now - self.last_summary < interval:
+            return
+        self.last_summary = now
+        self.logger.info(self.metrics.summary())
 
+    def write_metrics(self):
+        """
+        Write the metrics of this run to .snakemake/googlebatch_logs.
+        """
+        extension = (
+            "json" if self.executor_settings.metrics_format == "json" else "prom"
+        )
+        path = os.path.join(
+            self.workdir,
+            ".snakemake",
+            "googlebatch_logs",
+            f"metrics-{self.run_id}.{extension}",
+        )
         try:
-            attempt_log_save(logfname, logger, filter_query, page_size)
-        except ResourceExhausted:
-            self.logger.warning(
-                "Too many requests to Google Logging API.\n"
-                + f"Skipping logs for job {job_uid} and sleeping for {sleeps}s."
-            )
-            time.sleep(sleeps)
+            self.metrics.write(path, self.executor_settings.metrics_format)
+            self.logger.info(f"Google Batch executor metrics written to {path}")
+        except Exception as e:
+            self.logger.warning(f"Failed to write executor metrics: {e}")
+        return path
 
-            self.logger.warning(
-                f"Trying to retrieve logs for Batch job {job_uid} once more."
-            )
-            try:
-                attempt_log_save(logfname, logger, filter_query, page_size)
-            except ResourceExhausted:
-                self.logger.warning(
-                    "Retry to retrieve logs failed, "
-                    + f"the log file {logfname} might be incomplete."
-                )
+    def is_due(self, j: SubmittedJobInfo, now, changed=()):
+        """
+        Determine if a job needs a status check in this round.
+
+        With notifications, a job is checked when it changed state (its
+        Batch job name, or task name in a job array, is in changed), and
+        otherwise only every max_status_interval seconds, in case a
+        notification got lost.
+        """
+        name = j.external_jobid
+        if "held" in j.aux:
+            return True
+        if self.notifications is not None and "pilot" not in j.aux:
+            if self.batch_job_name(j) in changed or name in changed:
+                return True
+            last_checked = self.last_checked.get(name)
+            fallback = self.executor_settings.max_status_interval
+            if last_checked is not None and now - last_checked < fallback:
+                return False
+        if self.poll_scheduler is not None:
+            return self.poll_scheduler.is_due(name, now)
+        return True
+
+    def schedule_poll(self, j: SubmittedJobInfo, state, now):
+        """
+        Schedule the next status check of a job (state None if finished).
+        """
+        name = j.external_jobid
+        if self.notifications is not None:
+            if state is None:
+                self.last_checked.pop(name, None)
+                self.notifications.forget(name)
+                if "array" not in j.aux:
+                    self.notifications.forget(self.batch_job_name(j))
+            else:
+                self.last_checked[name] = now
+        if self.poll_scheduler is None:
+            return
+        if state is None:
+            self.poll_scheduler.finish(j.external_jobid, j.job.name, now)
+        else:
+            self.poll_scheduler.update(j.external_jobid, j.job.name, state, now)
+
+    def recheck(self, j: SubmittedJobInfo, changed):
+        """
+        Keep a notified change of a job that could not be checked.
+        """
+        if self.notifications is None:
+            return
+        for name in {self.batch_job_name(j), j.external_jobid}:
+            if name in changed:
+                self.notifications.mark_changed(name)
+
+    def batch_job_name(self, j: SubmittedJobInfo):
+        """
+        The name of the Batch job, which is shared by the tasks of a job array.
+        """
+        return j.aux.get("array", j.external_jobid)
+
+    def log_key(self, j: SubmittedJobInfo):
+        """
+        The key of a job's logs, the Batch job uid (and task index for arrays).
+        """
+        job_uid = j.aux["batch_job"].uid
+        if "task_index" in j.aux:
+            return f"{job_uid}/{j.aux['task_index']}"
+        return job_uid
+
+    def is_transient(self, ex):
+        """
+        Determine if an error (after retries) might go away by itself.
+        """
+        return isinstance(ex, RetryError) or utils.google_cloud_retry(ex)
+
+    def handle_job_status(self, j: SubmittedJobInfo, response: batch_v1.Job):
+        """
+        Act on the status of a Batch job (or task of a job array), returning
+        True if it is still active.
+        """
+        jobid = j.external_jobid
+
+        # Aux logs are consistently here
+        aux_logs = [j.aux["logfile"]]
+        last_seen = j.aux["last_seen"]
+
+        self.logger.info(f"Job {jobid} has state {response.status.state.name}")
+        for event in response.status.status_events:
+            if not last_seen or event.event_time.nanosecond > last_seen:
+                self.logger.info(f"{event.type_}: {event.description}")
+                last_seen = event.event_time.nanosecond
+
+        # Update last seen for next time (TODO not sure this is sticking)
+        j.aux["last_seen"] = last_seen
+
+        # Possible statuses:
+        # RUNNING
+        # SCHEDULED
+        # QUEUED
+        # STATE_UNSPECIFIED
+        # SUCCEEDED
+        # FAILED
+        # DELETION_IN_PROGRESS
+        # Tasks of job arrays are PENDING, ASSIGNED, RUNNING, FAILED,
+        # SUCCEEDED or UNEXECUTED
+        if response.status.state.name in ["FAILED", "SUCCEEDED", "UNEXECUTED"]:
+            self.save_finished_job_logs(j)
+
+        elif (
+            response.status.state.name == "RUNNING"
+            and self.executor_settings.log_tail
+            and "pilot" not in j.aux
+        ):
+            self.log_harvester.tail(self.log_key(j), j.aux["logfile"])
+
+        if response.status.state.name == "FAILED":
+            msg = f"Google Batch job '{j.external_jobid}' failed. "
+            self.report_job_error(j, msg=msg, aux_logs=aux_logs)
+
+        # A task of a job array that did not run (e.g., the job failed)
+        elif response.status.state.name == "UNEXECUTED":
+            msg = f"Google Batch task '{j.external_jobid}' was not executed. "
+            self.report_job_error(j, msg=msg, aux_logs=aux_logs)
+
+        elif response.status.state.name == "SUCCEEDED":
+            self.report_job_success(j)
+
+        # Otherwise, we are queued / scheduled / running, etc.
+        else:
+            return True
+        return False
+
+    def save_finished_job_logs(self, job_info: SubmittedJobInfo):
+        """
+        Queue downloading the logs of a finished job from Google Cloud Logging.
+
+        This is done in the background so status checks do not wait for it,
+        together with the logs of all jobs finished in the same status check.
+        If the logs were tailed while the job was running, only the
+        remaining entries are downloaded.
+        """
+        if "pilot" in job_info.aux:
+            self.log_harvester.pool.submit(self.save_pilot_logs, job_info)
+            return
+        batch_job = job_info.aux["batch_job"]
+        self.log_harvester.submit(
+            self.log_key(job_info), job_info.aux["logfile"], since=batch_job.create_time
+        )
+
+    def save_pilot_logs(self, job_info: SubmittedJobInfo):
+        """
+        Save the log of a job on a warm worker from the queue, and clean up.
+        """
+        pilot = self.pilots[job_info.aux["pilot"]]
+        task = job_info.aux["task"]
+        try:
+            with open(job_info.aux["logfile"], "w", encoding="utf-8") as fd:
+                fd.write(pilot.queue.read_log(task))
+            pilot.queue.remove(task)
         except Exception as e:
-            self.logger.warning(
-                f"Failed to retrieve logs for Batch job {job_uid}: {str(e)}"
-            )
+            self.logger.warning(f"Failed to retrieve logs for job {task}: {e}")
 
     def cancel_jobs(self, active_jobs: List[SubmittedJobInfo]):
         """
         Cancel all active jobs. This method is called when snakemake is interrupted.
+
+        Delete requests are sent concurrently, and the deletions are then waited
+        for together, up to the cancel timeout in total.
         """
-        for job in active_jobs:
-            jobid = job.external_jobid
-            reason = f"User requested cancel for {jobid}"
-            request = batch_v1.DeleteJobRequest(name=jobid, reason=reason)
-            operation = self.batch.delete_job(request=request)
-            self.logger.info(f"Waiting for job {jobid} to cancel...")
-            response = operation.result()
-            self.logger.info(response)
+        # Tasks of a job array are deleted with their Batch job, jobs
+        # on warm workers with the workers, and jobs waiting for reference
+        # images were not created yet (but their builders were)
+        jobids = [
+            self.batch_job_name(j)
+            for j in active_jobs
+            if "pilot" not in j.aux and "held" not in j.aux
+        ]
+        jobids += self.reference_builders()
+        for key in dict.fromkeys(
+            j.aux["pilot"] for j in active_jobs if "pilot" in j.aux
+        ):
+            self.pilots[key].queue.stop()
+            with self.pilots[key].lock:
+                jobids += list(self.pilots[key].workers)
+        jobids = list(dict.fromkeys(jobids))
+        self.logger.info(f"Cancelling {len(jobids)} Google Batch jobs...")
+        confirmed, pending = self.delete_jobs(jobids)
+
+        self.logger.info(f"Confirmed deletion of {len(confirmed)} jobs.")
+        if pending:
+            self.logger.warning(
+                f"Deletion of {len(pending)} jobs is not confirmed, "
+                "check that they are gone in the Google Batch console:\n"
+                + "\n".join(f"{jobid}: {reason}" for jobid, reason in pending.items())
+            )
 
         # Ensure we cleanup cache, etc.
         self.shutdown()
 
+    def delete_jobs(self, jobids):
+        """
+        Delete Batch jobs concurrently, with an overall timeout.
+
+        Returns the job ids confirmed deleted, and a lookup of the job ids
+        still pending to the reason why.
+        """
+        concurrency = max(1, self.executor_settings.cancel_concurrency)
+        deadline = time.monotonic() + self.executor_settings.cancel_timeout
+
+        def remaining():
+            return max(deadline - time.monotonic(), 0)
+
+        def delete(jobid):
+            reason = f"User requested cancel for {jobid}"
+            request = batch_v1.DeleteJobRequest(name=jobid, reason=reason)
+            try:
+                operation = self.api.call(
+                    self.batch.delete_job,
+                    request=request,
+                    timeout=remaining(),
+                    deadline=remaining(),
+                )
+            except NotFound:
+                # The job is already gone
+                return
+            return operation.result(timeout=remaining())
+
+        pool = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="googlebatch-cancel"
+        )
+        futures = {pool.submit(delete, jobid): jobid for jobid in jobids}
+        done, not_done = wait(futures, timeout=remaining())
+        pool.shutdown(wait=False, cancel_futures=True)
+
+        confirmed = []
+        pending = {futures[f]: "timed out waiting for deletion" for f in not_done}
+        for future in done:
+            if future.exception() is not None:
+                pending[futures[future]] = str(future.exception()) or "timed out"
+            else:
+                confirmed.append(futures[future])
+        return confirmed, pending
+
     def shutdown(self):
         """
         Shutdown deletes build packages if the user didn't request to clean
@@ -599,3 +2001,18 @@ class GoogleBatchExecutor(RemoteExecutor):
 
         # Call parent shutdown
         super().shutdown()
+        self.submit_pool.shutdown(wait=True)
+
+        # Idle workers stop right away instead of waiting for their TTL
+        for pilot in (self.pilots or {}).values():
+            try:
+                pilot.queue.stop()
+            except Exception as e:
+                self.logger.warning(f"Failed to stop warm workers: {e}")
+        if self.notifications is not None:
+            self.notifications.stop()
+
+        # Status checks are done, so no more logs are queued
+        self.log_harvester.shutdown()
+        self.write_metrics()
+        self.write_machine_report()
@@ -0,0 +1,355 @@
+# Background download of Google Batch job logs from Cloud Logging
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import re
+import threading
+import time
+
+from google.api_core.exceptions import ResourceExhausted
+from google.cloud import logging
+
+import snakemake_executor_plugin_googlebatch.api as apiutil
+import snakemake_executor_plugin_googlebatch.utils as utils
+
+
+def task_index(labels):
+    """
+    Get the task index from the labels of a log entry (None if unknown).
+
+    The task id label looks like task/<job uid>-group0-<index>/<retry>/<runnable>.
+    """
+    match = re.search(r"-group\d+-(\d+)(/|$)", labels.get("task_id") or "")
+    if match:
+        return int(match.group(1))
+
+
+class LogCursor:
+    """
+    A log cursor remembers the newest log entry saved for a job.
+
+    Entries can share a timestamp, so the insert ids seen at the newest
+    timestamp are kept to skip them when the next query starts there.
+    """
+
+    def __init__(self):
+        self.started = False
+        self.timestamp = None
+        self.insert_ids = set()
+
+    def lower_bound(self, since=None):
+        """
+        The earliest timestamp of an entry that is not saved yet.
+        """
+        return self.timestamp or since
+
+    def is_new(self, entry):
+        """
+        Determine if an entry has not been saved yet.
+        """
+        if self.timestamp is None or entry.timestamp is None:
+            return True
+        if entry.timestamp > self.timestamp:
+            return True
+        return entry.timestamp == self.timestamp and (
+            entry.insert_id not in self.insert_ids
+        )
+
+    def advance(self, entry):
+        """
+        Move the cursor past a saved entry.
+        """
+        if entry.timestamp is None:
+            return
+        if self.timestamp is None or entry.timestamp > self.timestamp:
+            self.timestamp = entry.timestamp
+            self.insert_ids = set()
+        if entry.timestamp == self.timestamp:
+            self.insert_ids.add(entry.insert_id)
+
+
+class LogHarvester:
+    """
+    A log harvester saves job logs from Cloud Logging in the background.
+
+    Downloads run in a small pool of worker threads, so status checks never
+    wait on log I/O. All workers share one Logging client and one token
+    bucket, which hands out a token per page request to stay within the
+    Cloud Logging read quota (60 entries.list requests per minute by default).
+
+    Each job has a cursor, so logs of running jobs can be tailed: every
+    download only fetches entries newer than the last one saved and
+    appends them to the logfile.
+
+    Logs of finished jobs are queued with submit and sent out with dispatch,
+    which combines up to batch_size jobs into a single query. Its entries
+    are streamed once and routed to each job's logfile by the job uid label.
+    Tails of running jobs are queued with tail and combined the same way,
+    but dispatch sends out one tail query at a time, and only when no logs
+    of finished jobs are waiting, so tails never hold those back.
+    Jobs packed as tasks of one Batch job (job arrays) are saved separately,
+    under the key <job uid>/<task index>, by the task id label.
+    """
+
+    def __init__(
+        self,
+        project,
+        logger,
+        workers=2,
+        requests_per_minute=60,
+        tail_seconds=60,
+        batch_size=50,
+        page_size=1000,
+        client=None,
+        api=None,
+    ):
+        self.project = project
+        self.logger = logger
+        self.tail_seconds = tail_seconds
+        self.batch_size = max(1, batch_size)
+        self.page_size = page_size
+        self.client = client
+        self.api = api or apiutil.ResilientApi()
+        self.limiter = utils.TokenBucket(requests_per_minute / 60)
+        self.pool = ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="googlebatch-logs"
+        )
+
+        # Finished jobs waiting for dispatch, and batches of them not saved yet
+        self.pending = []
+        self.saving = 0
+
+        # Running jobs waiting for a tail, oldest first
+        self.tail_pending = {}
+
+        # Cursors and locks (one download at a time) per job uid
+        self.lock = threading.Lock()
+        self.cursors = {}
+        self.job_locks = {}
+        self.last_tail = {}
+        self.tailing = set()
+        self.finished = set()
+
+    def get_logger(self):
+        """
+        Get the batch task logger, creating the shared client on first use.
+        """
+        with self.lock:
+            if self.client is None:
+                self.client = logging.Client(project=self.project)
+        return self.client.logger("batch_task_logs")
+
+    def get_job_lock(self, job_uid):
+        with self.lock:
+            return self.job_locks.setdefault(job_uid, threading.Lock())
+
+    def submit(self, job_uid, logfile, since=None):
+        """
+        Queue saving the (remaining) logs of a finished Batch job to a logfile.
+
+        The earliest time of its entries (e.g., the job creation) narrows
+        down the query.
+        """
+        with self.lock:
+            self.pending.append((job_uid, logfile, since))
+            self.tail_pending.pop(job_uid, None)
+
+    def dispatch(self):
+        """
+        Send out the queued jobs to the workers, batch_size jobs per query.
+
+        Finished jobs go first. Running jobs are tailed with a single query
+        (of up to batch_size jobs), unless a tail is still running or logs
+        of finished jobs are waiting, and the others wait for later rounds.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+            batches = [
+                pending[i : i + self.batch_size]
+                for i in range(0, len(pending), self.batch_size)
+            ]
+            self.saving += len(batches)
+            tails = []
+            if not self.tailing and not self.saving:
+                for job_uid in list(self.tail_pending)[: self.batch_size]:
+                    tails.append((job_uid, self.tail_pending.pop(job_uid), None))
+                    self.tailing.add(job_uid)
+        futures = [self.pool.submit(self.save, batch) for batch in batches]
+        if tails:
+            futures.append(self.pool.submit(self.save_tail, tails))
+        return futures
+
+    def tail(self, job_uid, logfile):
+        """
+        Queue appending new logs of a running Batch job to a logfile.
+
+        A job is tailed at most once every tail_seconds, and not while
+        a previous tail is still queued. It returns whether the tail was
+        queued, for dispatch to send out.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if job_uid in self.tailing or job_uid in self.finished:
+                return False
+            if job_uid in self.tail_pending:
+                return False
+            if now - self.last_tail.get(job_uid, now - self.tail_seconds) < (
+                self.tail_seconds
+            ):
+                return False
+            self.tail_pending[job_uid] = logfile
+            self.last_tail[job_uid] = now
+        return True
+
+    def list_pages(self, query):
+        """
+        Yield pages of log entries for a query, taking a token per page.
+        """
+        entries = self.get_logger().list_entries(
+            filter_=query, order_by=logging.ASCENDING, page_size=self.page_size
+        )
+        pages = entries.pages
+        while True:
+            self.limiter.acquire()
+            with self.api.measure("list_entries"):
+                page = next(pages, None)
+            if page is None:
+                return
+            yield page
+
+    def query(self, targets):
+        """
+        Query the entries of many jobs at once.
+
+        The logger adds the log name, and the earliest entry not saved yet
+        bounds the timestamp.
+        """
+        job_uids = dict.fromkeys(key.split("/")[0] for key in targets)
+        uids = " OR ".join(f'"{job_uid}"' for job_uid in job_uids)
+        query = f"labels.job_uid=({uids})"
+        bounds = [cursor.lower_bound(since) for _, cursor, since in targets.values()]
+        if all(bounds):
+            query += f' AND timestamp>="{min(bounds).isoformat()}"'
+        return query
+
+    def harvest(self, jobs, final=True):
+        """
+        Append the entries after each job's cursor to its logfile.
+
+        The first download for a job starts a new logfile.
+        """
+        # Locks are taken in order, so concurrent batches cannot deadlock
+        with ExitStack() as stack:
+            for job_uid in sorted(set(job_uid for job_uid, _, _ in jobs)):
+                stack.enter_context(self.get_job_lock(job_uid))
+
+            targets = {}
+            with self.lock:
+                for job_uid, logfile, since in jobs:
+                    if not final and job_uid in self.finished:
+                        continue
+                    cursor = self.cursors.setdefault(job_uid, LogCursor())
+                    targets[job_uid] = (logfile, cursor, since)
+            if not targets:
+                return
+
+            files = {}
+            for job_uid, (logfile, cursor, _) in targets.items():
+                mode = "a" if cursor.started else "w"
+                files[job_uid] = stack.enter_context(
+                    open(logfile, mode, encoding="utf-8")
+                )
+                cursor.started = True
+
+            for page in self.list_pages(self.query(targets)):
+                for log_entry in page:
+                    job_uid = self.route(log_entry, targets)
+                    if job_uid is None:
+                        continue
+                    cursor = targets[job_uid][1]
+                    if not cursor.is_new(log_entry):
+                        continue
+                    files[job_uid].write(str(log_entry.payload) + "\n")
+                    cursor.advance(log_entry)
+
+    def route(self, log_entry, targets):
+        """
+        Get the key of the job (or task of a job array) an entry belongs to.
+        """
+        labels = log_entry.labels or {}
+        job_uid = labels.get("job_uid")
+        if job_uid in targets:
+            return job_uid
+        key = f"{job_uid}/{task_index(labels)}"
+        if key in targets:
+            return key
+
+    def save_tail(self, jobs):
+        """
+        Append new logs of running jobs, skipping this round on errors.
+        """
+        job_uids = ", ".join(job_uid for job_uid, _, _ in jobs)
+        try:
+            self.logger.debug(f"Tailing logs for Batch jobs {job_uids}.")
+            self.harvest(jobs, final=False)
+        except ResourceExhausted:
+            self.logger.debug(f"Too many requests to tail logs for {job_uids}.")
+            self.limiter.pause(self.tail_seconds)
+        except Exception as e:
+            self.logger.debug(f"Failed to tail logs for Batch jobs {job_uids}: {e}")
+        finally:
+            with self.lock:
+                for job_uid, _, _ in jobs:
+                    self.tailing.discard(job_uid)
+
+    def save(self, jobs, sleeps=60):
+        """
+        Download the remaining logs of finished Batch jobs.
+
+        Transient errors are retried by the resilient API, continuing from
+        the cursors. If the quota is exhausted anyway, all workers pause for
+        sleeps seconds before the next attempt.
+        """
+        job_uids = ", ".join(job_uid for job_uid, _, _ in jobs)
+        for job_uid, logfile, _ in jobs:
+            self.logger.info(f"Saving logs for Batch job {job_uid} to {logfile}.")
+
+        def on_error(ex):
+            if isinstance(ex, ResourceExhausted):
+                self.logger.warning(
+                    "Too many requests to Google Logging API.\n"
+                    + f"Pausing log downloads for {sleeps}s before retrying "
+                    + f"logs for Batch jobs {job_uids}."
+                )
+                self.limiter.pause(sleeps)
+
+        try:
+            self.api.run(self.harvest, jobs, on_error=on_error)
+        except Exception as e:
+            self.logger.warning(
+                f"Failed to retrieve logs for Batch jobs {job_uids}, "
+                + f"the log files might be incomplete: {str(e)}"
+            )
+        finally:
+            for job_uid, _, _ in jobs:
+                self.forget(job_uid)
+            with self.lock:
+                self.saving -= 1
+
+    def forget(self, job_uid):
+        """
+        Drop the state of a finished job, so it is not tailed again.
+        """
+        with self.lock:
+            self.finished.add(job_uid)
+            self.cursors.pop(job_uid, None)
+            self.job_locks.pop(job_uid, None)
+            self.last_tail.pop(job_uid, None)
+            self.tail_pending.pop(job_uid, None)
+
+    def shutdown(self):
+        """
+        Send out and wait for all queued downloads to finish.
+        """
+        self.dispatch()
+        self.pool.shutdown(wait=True)
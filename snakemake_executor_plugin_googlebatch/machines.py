@@ -0,0 +1,165 @@
+# Shapes and prices of Compute Engine machine types, to fit and size jobs
+
+import functools
+import json
+import math
+import os
+import re
+
+from snakemake_interface_common.exceptions import WorkflowError
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# The catalog of machine families shipped with the plugin
+default_catalog = os.path.join(here, "machines.json")
+
+# Memory (GiB) per vCPU of series missing from the catalog
+# https://cloud.google.com/compute/docs/machine-resource
+default_memory_per_vcpu = {"standard": 4, "highmem": 8, "highcpu": 1}
+
+# Memory left for the operating system and the Batch agent
+system_memory_mib = 512
+
+# The boot disk size of Batch VMs, which disk_mb is added to
+base_boot_disk_gb = 30
+
+# Params that right-sizing sets from the resources of a job
+sized_params = ["machine_type", "cpu_milli", "memory", "boot_disk_gb"]
+
+
+class MachineType:
+    """
+    A machine type with its vCPUs, memory and spot price (per hour).
+    """
+
+    def __init__(self, name, vcpus, memory_mib, price, gpus=False):
+        self.name = name
+        self.vcpus = vcpus
+        self.memory_mib = memory_mib
+        self.price = price
+        self.gpus = gpus
+
+    def fits(self, vcpus, memory_mib, gpus=0):
+        return (
+            self.vcpus >= vcpus
+            and self.memory_mib - system_memory_mib >= memory_mib
+            and (self.gpus or not gpus)
+        )
+
+
+class MachineCatalog:
+    """
+    A machine catalog lists the machine types jobs can be right-sized to.
+
+    It is read from the catalog shipped with the plugin, and families from
+    a user catalog (in the same format) are added or replace those. Each
+    family lists its memory per vCPU by type, the vCPU counts it comes in
+    (one list for all types, or a list per type where they differ), its
+    spot price per vCPU and GiB of memory, and whether GPUs attach.
+    """
+
+    def __init__(self, families):
+        self.families = families
+        self.machines = []
+        for series, family in families.items():
+            price = family.get("spot_price", {})
+            sizes = family.get("vcpus", [])
+            for kind, ratio in family.get("memory_per_vcpu", {}).items():
+                counts = sizes.get(kind, []) if isinstance(sizes, dict) else sizes
+                for vcpus in counts:
+                    memory_gib = vcpus * ratio
+                    self.machines.append(
+                        MachineType(
+                            f"{series}-{kind}-{vcpus}",
+                            vcpus,
+                            int(memory_gib * 1024),
+                            vcpus * price.get("vcpu", 0)
+                            + memory_gib * price.get("memory_gib", 0),
+                            family.get("gpus", False),
+                        )
+                    )
+
+    @classmethod
+    def load(cls, path=None):
+        families = read_catalog(default_catalog)
+        if path:
+            families.update(read_catalog(path))
+        return cls(families)
+
+    def memory_per_vcpu(self, series, kind):
+        ratios = self.families.get(series, {}).get("memory_per_vcpu", {})
+        return ratios.get(kind, default_memory_per_vcpu[kind])
+
+    def choose(self, vcpus, memory_mib, gpus=0):
+        """
+        Get the cheapest machine type that fits (None if none does).
+
+        Of machine types with the same price, the smaller one wins.
+        """
+        fitting = [m for m in self.machines if m.fits(vcpus, memory_mib, gpus)]
+        if not fitting:
+            return
+        return min(fitting, key=lambda m: (m.price, m.vcpus, m.memory_mib, m.name))
+
+
+def read_catalog(path):
+    """
+    Read the machine families of a catalog file.
+    """
+    try:
+        with open(path) as fd:
+            return json.load(fd)["families"]
+    except (OSError, ValueError, KeyError) as e:
+        raise WorkflowError(f"Unable to read the machine catalog {path}: {e}")
+
+
+def machine_shape(machine_type, catalog=None):
+    """
+    Get the vCPUs and memory (MiB) of a machine type (None if unknown).
+
+    Predefined (e.g., n2-standard-8) and custom machine types
+    (e.g., n2-custom-4-16384) are understood, shared-core and accelerator
+    optimized ones are not.
+    """
+    machine_type = (machine_type or "").strip()
+    custom = re.fullmatch(r"(?:(\w+)-)?custom-(\d+)-(\d+)(?:-ext)?", machine_type)
+    if custom:
+        return int(custom.group(2)), int(custom.group(3))
+
+    predefined = re.fullmatch(r"(\w+)-(standard|highmem|highcpu)-(\d+)", machine_type)
+    if not predefined:
+        return
+    series, kind, vcpus = predefined.groups()
+    ratio = (catalog or get_catalog()).memory_per_vcpu(series, kind)
+    return int(vcpus), int(int(vcpus) * ratio * 1024)
+
+
+def tasks_per_vm(machine_type, cpu_milli, memory_mib, catalog=None):
+    """
+    The number of tasks with the given resources that fit on one VM.
+
+    It is 1 if the machine type is unknown or a task does not fit.
+    """
+    shape = machine_shape(machine_type, catalog)
+    if shape is None:
+        return 1
+    vcpus, memory = shape
+    fits = [vcpus * 1000 // max(1, cpu_milli or 1)]
+    if memory_mib:
+        fits.append((memory - system_memory_mib) // memory_mib)
+    return max(1, min(fits))
+
+
+def boot_disk_gb(disk_mb):
+    """
+    The boot disk size (GB) for a job needing disk_mb of scratch space.
+    """
+    return base_boot_disk_gb + math.ceil(disk_mb / 1024)
+
+
+@functools.lru_cache(maxsize=None)
+def get_catalog():
+    """
+    The shipped catalog, read on first use.
+    """
+    return MachineCatalog.load()
@@ -0,0 +1,211 @@
+# Metrics of the calls to Google Cloud and of the executor itself
+
+import bisect
+import json
+import os
+import threading
+
+
+class Histogram:
+    """
+    A histogram counts observed values (e.g., seconds) into fixed buckets.
+
+    Each bucket holds the values up to its bound, and a last bucket the
+    values above all bounds, so quantiles are known up to a bucket.
+    """
+
+    bounds = [
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+        60,
+        300,
+    ]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def quantile(self, q):
+        """
+        The bound of the bucket holding the q quantile (the max above all).
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.mean,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": {
+                str(bound): count
+                for bound, count in zip(self.bounds + ["+Inf"], self.counts)
+            },
+        }
+
+
+class Metrics:
+    """
+    Metrics hold histograms, counters and gauges, each named and labeled.
+
+    They are shared by all threads of the executor, and written to a
+    metrics file (JSON or Prometheus text) at the end of the run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value (e.g., seconds of a call) to a histogram.
+        """
+        with self.lock:
+            key = self.key(name, labels)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        with self.lock:
+            key = self.key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Set the current value of a gauge, which also keeps its maximum.
+        """
+        with self.lock:
+            key = self.key(name, labels)
+            _, maximum = self.gauges.get(key, (value, value))
+            self.gauges[key] = (value, max(maximum, value))
+
+    def get_histogram(self, name, **labels):
+        return self.histograms.get(self.key(name, labels))
+
+    def get_counter(self, name, **labels):
+        return self.counters.get(self.key(name, labels), 0)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "histograms": [
+                    {"name": name, "labels": dict(labels), **histogram.to_dict()}
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": v, "max": m}
+                    for (name, labels), (v, m) in sorted(self.gauges.items())
+                ],
+            }
+
+    def to_prometheus(self):
+        """
+        Render the metrics in the Prometheus text format.
+        """
+
+        def series(name, labels, **extra):
+            labels = {**dict(labels), **extra}
+            if not labels:
+                return name
+            pairs = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            return f"{name}{{{pairs}}}"
+
+        lines = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                seen = 0
+                for bound, count in zip(Histogram.bounds + ["+Inf"], histogram.counts):
+                    seen += count
+                    lines.append(f"{series(name + '_bucket', labels, le=bound)} {seen}")
+                lines.append(f"{series(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{series(name + '_count', labels)} {histogram.count}")
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{series(name, labels)} {value}")
+            for (name, labels), (value, maximum) in sorted(self.gauges.items()):
+                lines.append(f"{series(name, labels)} {value}")
+                lines.append(f"{series(name + '_max', labels)} {maximum}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, format="json"):
+        """
+        Write the metrics to a file, as json or prometheus text.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as fd:
+            if format == "prometheus":
+                fd.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), fd, indent=4)
+
+    def summary(self):
+        """
+        A short summary of the API calls and status checks so far.
+        """
+        with self.lock:
+            calls = {
+                dict(labels).get("method"): histogram
+                for (name, labels), histogram in self.histograms.items()
+                if name == "api_call_seconds"
+            }
+            errors = {}
+            for (name, labels), value in self.counters.items():
+                if name in ["api_errors_total", "api_retries_total"]:
+                    method = dict(labels).get("method")
+                    errors[method] = errors.get(method, 0) + value
+            cycles = self.histograms.get(self.key("poll_cycle_seconds", {}))
+
+        lines = ["Google Cloud API calls:"]
+        for method, histogram in sorted(calls.items()):
+            lines.append(
+                f"  {method}: {histogram.count} calls, "
+                f"mean {histogram.mean:.3f}s, p95 {histogram.quantile(0.95):.3f}s, "
+                f"max {histogram.max:.3f}s, errors {errors.get(method, 0)}"
+            )
+        if cycles is not None:
+            lines.append(
+                f"Status checks: {cycles.count} cycles, mean {cycles.mean:.3f}s, "
+                f"max {cycles.max:.3f}s"
+            )
+        return "\n".join(lines)
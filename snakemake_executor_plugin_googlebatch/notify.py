@@ -0,0 +1,149 @@
+# Job state changes pushed by Google Batch through Pub/Sub
+
+import re
+import threading
+
+from snakemake_interface_common.exceptions import WorkflowError
+
+try:
+    from google.cloud import pubsub_v1
+except ImportError:
+    pubsub_v1 = None
+
+
+def topic_path(project, topic):
+    """
+    Expand a topic name to its full path (projects/<project>/topics/<topic>).
+    """
+    if topic.startswith("projects/"):
+        return topic
+    return f"projects/{project}/topics/{topic}"
+
+
+def subscription_path(project, subscription):
+    """
+    Expand a subscription name to its full path.
+    """
+    if subscription.startswith("projects/"):
+        return subscription
+    return f"projects/{project}/subscriptions/{subscription}"
+
+
+def task_name(job_name, task_uid):
+    """
+    The name of a task from its job name and UID (<job uid>-<group>-<index>).
+    """
+    match = re.search(r"-(group\d+)-(\d+)$", task_uid or "")
+    if not job_name or not match:
+        return
+    return f"{job_name}/taskGroups/{match.group(1)}/tasks/{match.group(2)}"
+
+
+class NotificationListener:
+    """
+    A notification listener records job state changes from a subscription.
+
+    Google Batch publishes a message to the job's notification topic on
+    every change of the job state, with the job name and new state as
+    attributes, and of the state of each task, with the task UID too (so
+    tasks of a running job array are known to have finished). The Pub/Sub
+    client streams them in its own background threads into a table of job
+    (or task) name to latest state, and status checks only request the jobs
+    that changed since they were last checked. The
+    changes are taken before the requests are sent, so a message that
+    arrives while a job is requested counts for the next check.
+    """
+
+    job_state_changed = "JOB_STATE_CHANGED"
+    task_state_changed = "TASK_STATE_CHANGED"
+
+    def __init__(self, subscription, logger, subscriber=None):
+        self.subscription = subscription
+        self.logger = logger
+        self.subscriber = subscriber
+        self.future = None
+        self.lock = threading.Lock()
+        self.states = {}
+        self.changed = set()
+
+    def start(self):
+        """
+        Start streaming messages from the subscription.
+        """
+        if self.subscriber is None:
+            if pubsub_v1 is None:
+                raise WorkflowError(
+                    "Job notifications require the google-cloud-pubsub package, "
+                    "e.g., pip install snakemake-executor-plugin-googlebatch[pubsub]"
+                )
+            self.subscriber = pubsub_v1.SubscriberClient()
+        self.logger.debug(f"Listening for job notifications on {self.subscription}")
+        self.future = self.subscriber.subscribe(
+            self.subscription, callback=self.receive
+        )
+
+    def receive(self, message):
+        """
+        Record the new state of a job or task from a notification message.
+        """
+        attributes = message.attributes or {}
+        name = state = None
+        if attributes.get("Type") == self.job_state_changed:
+            name = attributes.get("JobName")
+            state = attributes.get("NewJobState")
+        elif attributes.get("Type") == self.task_state_changed:
+            name = task_name(attributes.get("JobName"), attributes.get("TaskUID"))
+            state = attributes.get("NewTaskState")
+        if name and state:
+            with self.lock:
+                self.states[name] = state
+                self.changed.add(name)
+        message.ack()
+
+    def has_changed(self, name):
+        """
+        Determine if a job changed state since it was last checked.
+        """
+        with self.lock:
+            return name in self.changed
+
+    def get(self, name):
+        """
+        Get the last notified state of a job (None if there was none).
+        """
+        with self.lock:
+            return self.states.get(name)
+
+    def take_changed(self):
+        """
+        Get and clear the jobs that changed state, so only newer changes count.
+        """
+        with self.lock:
+            changed, self.changed = self.changed, set()
+        return changed
+
+    def mark_changed(self, name):
+        """
+        Mark a job as changed again, e.g., when its check failed.
+        """
+        with self.lock:
+            if name in self.states:
+                self.changed.add(name)
+
+    def forget(self, name):
+        with self.lock:
+            self.changed.discard(name)
+            self.states.pop(name, None)
+
+    def stop(self, timeout=30):
+        """
+        Stop streaming messages, waiting for the stream to close.
+        """
+        if self.future is None:
+            return
+        self.future.cancel()
+        try:
+            self.future.result(timeout=timeout)
+        except Exception as e:
+            self.logger.debug(f"Job notifications stopped: {e}")
+        self.future = None
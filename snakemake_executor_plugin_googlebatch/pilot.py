@@ -0,0 +1,295 @@
+# Warm workers (pilots) that run many Snakemake jobs on one Batch VM
+
+import os
+import tempfile
+import threading
+
+from google.api_core.exceptions import NotFound
+from google.cloud import storage
+
+import snakemake_executor_plugin_googlebatch.utils as utils
+
+worker_loop = """
+attempt=${BATCH_TASK_RETRY_ATTEMPT:-0}
+worker=%(worker)s.${attempt}
+idle_ttl=%(idle_ttl)s
+poll_seconds=%(poll_seconds)s
+scratch=$(mktemp -d)
+%(functions)s
+idle=0
+if [ ${attempt} -gt 0 ]; then
+    for task in $(queue_list); do
+        case "$(queue_claimer ${task})" in
+        %(worker)s.*)
+            echo "Worker ${worker} was retried while running Snakemake job ${task}" \\
+                > ${scratch}/task.log
+            queue_finish ${task} 1 ${scratch}/task.log
+            ;;
+        esac
+    done
+fi
+echo "Worker ${worker} is waiting for Snakemake jobs"
+while ! queue_stopped; do
+    ran=0
+    for task in $(queue_list); do
+        queue_claim ${task} || continue
+        echo "Worker ${worker} is running Snakemake job ${task}"
+        queue_fetch ${task} > ${scratch}/task.sh
+        bash ${scratch}/task.sh > ${scratch}/task.log 2>&1
+        code=$?
+        cat ${scratch}/task.log
+        queue_finish ${task} ${code} ${scratch}/task.log
+        ran=1
+        idle=0
+    done
+    if [ ${ran} = 0 ]; then
+        if [ ${idle} -ge ${idle_ttl} ]; then
+            echo "Worker ${worker} was idle for ${idle}s, stopping"
+            exit 0
+        fi
+        sleep ${poll_seconds}
+        idle=$((idle + poll_seconds))
+    fi
+done
+echo "Worker ${worker} was stopped"
+"""
+
+local_functions = """
+queue=%s
+queue_list() { ls ${queue}/queue 2>/dev/null | sed -n 's/\\.sh$//p'; }
+queue_claim() { (set -o noclobber; echo ${worker} > ${queue}/claims/$1) 2>/dev/null; }
+queue_claimer() { cat ${queue}/claims/$1 2>/dev/null; }
+queue_fetch() { cat ${queue}/queue/$1.sh; }
+queue_finish() {
+    cp $3 ${queue}/logs/$1.log
+    touch ${queue}/done/$1.$2
+    rm -f ${queue}/queue/$1.sh
+}
+queue_stopped() { test -e ${queue}/stop; }
+"""
+
+gcs_functions = """
+queue=%s
+queue_list() {
+    gsutil ls "${queue}/queue/*.sh" 2>/dev/null \\
+        | xargs -r -n1 basename | sed 's/\\.sh$//'
+}
+queue_claim() {
+    echo ${worker} | gsutil -q -h "x-goog-if-generation-match:0" \\
+        cp - ${queue}/claims/$1 2>/dev/null
+}
+queue_claimer() { gsutil -q cat ${queue}/claims/$1 2>/dev/null; }
+queue_fetch() { gsutil -q cp ${queue}/queue/$1.sh -; }
+queue_finish() {
+    gsutil -q cp $3 ${queue}/logs/$1.log
+    echo | gsutil -q cp - ${queue}/done/$1.$2
+    gsutil -q rm ${queue}/queue/$1.sh
+}
+queue_stopped() { gsutil -q stat ${queue}/stop; }
+"""
+
+
+class LocalQueue:
+    """
+    A local queue keeps the commands of Snakemake jobs in a directory.
+
+    It is meant for tests (or workers sharing a filesystem). The layout is
+    the same for all queues: queue/<task>.sh holds a command, claims/<task>
+    is created (only once) by the worker running it, which then writes
+    logs/<task>.log and done/<task>.<exit code>. A stop file asks all
+    workers to exit.
+
+    Claims hold the worker id and its Batch retry attempt (<worker>.<n>).
+    A worker retried after a preemption fails the tasks still claimed by
+    its earlier attempts, which would otherwise never finish.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        for name in ["queue", "claims", "logs", "done"]:
+            os.makedirs(os.path.join(url, name), exist_ok=True)
+
+    def path(self, *parts):
+        return os.path.join(self.url, *parts)
+
+    def put(self, task, command):
+        """
+        Add a command, writing it in full before it shows up in the queue.
+        """
+        fd, tmpfile = tempfile.mkstemp(dir=self.url)
+        with os.fdopen(fd, "w") as fd:
+            fd.write(command)
+        os.rename(tmpfile, self.path("queue", f"{task}.sh"))
+
+    def results(self):
+        """
+        Get a lookup of finished task to its exit code.
+        """
+        return dict(parse_result(name) for name in os.listdir(self.path("done")))
+
+    def claimed_by(self, task):
+        """
+        Get the worker that claimed a task (None if not claimed).
+        """
+        try:
+            with open(self.path("claims", task)) as fd:
+                return fd.read().strip()
+        except FileNotFoundError:
+            return
+
+    def read_log(self, task):
+        try:
+            with open(self.path("logs", f"{task}.log")) as fd:
+                return fd.read()
+        except FileNotFoundError:
+            return ""
+
+    def remove(self, task):
+        """
+        Remove all traces of a finished task.
+        """
+        paths = [self.path("queue", f"{task}.sh"), self.path("claims", task)]
+        paths.append(self.path("logs", f"{task}.log"))
+        paths += [
+            self.path("done", name)
+            for name in os.listdir(self.path("done"))
+            if parse_result(name)[0] == task
+        ]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stop(self):
+        open(self.path("stop"), "w").close()
+
+    def functions(self):
+        return local_functions % self.url
+
+
+class GcsQueue:
+    """
+    A GCS queue keeps the commands of Snakemake jobs under a bucket prefix.
+
+    Workers claim a task by creating its claim object on the condition
+    that it does not exist yet, so every task runs only once.
+    """
+
+    def __init__(self, url, client=None):
+        self.url = url.rstrip("/")
+        bucket, self.prefix = utils.split_gcs_url(self.url)
+        self.client = client or storage.Client()
+        self.bucket = self.client.bucket(bucket)
+
+    def blob(self, *parts):
+        return self.bucket.blob("/".join([self.prefix, *parts]).lstrip("/"))
+
+    def put(self, task, command):
+        self.blob("queue", f"{task}.sh").upload_from_string(command)
+
+    def results(self):
+        prefix = self.blob("done", "").name
+        blobs = self.client.list_blobs(self.bucket, prefix=prefix)
+        return dict(parse_result(blob.name[len(prefix) :]) for blob in blobs)
+
+    def claimed_by(self, task):
+        try:
+            return self.blob("claims", task).download_as_text().strip()
+        except NotFound:
+            return
+
+    def read_log(self, task):
+        try:
+            return self.blob("logs", f"{task}.log").download_as_text()
+        except NotFound:
+            return ""
+
+    def remove(self, task):
+        blobs = [self.blob("queue", f"{task}.sh"), self.blob("claims", task)]
+        blobs.append(self.blob("logs", f"{task}.log"))
+        blobs += [
+            self.blob("done", f"{task}.{code}")
+            for name, code in self.results().items()
+            if name == task
+        ]
+        for blob in blobs:
+            try:
+                blob.delete()
+            except NotFound:
+                pass
+
+    def stop(self):
+        self.blob("stop").upload_from_string("")
+
+    def functions(self):
+        return gcs_functions % self.url
+
+
+def claim_worker(claim):
+    """
+    Get the worker id of a claim (<worker>.<attempt>), None if unclaimed.
+    """
+    if claim is None:
+        return
+    worker, _, attempt = claim.rpartition(".")
+    return worker if worker and attempt.isdigit() else claim
+
+
+def parse_result(name):
+    """
+    Parse a result name (<task>.<exit code>) into the task and exit code.
+    """
+    task, _, code = name.rpartition(".")
+    return task, int(code)
+
+
+def get_queue(url):
+    """
+    Get a GCS queue for a gs:// url, and a local queue otherwise.
+    """
+    if url.startswith("gs://"):
+        return GcsQueue(url)
+    return LocalQueue(url)
+
+
+def worker_script(queue, worker, idle_ttl=300, poll_seconds=10):
+    """
+    The script of a worker, running queued commands until it is idle too long.
+    """
+    return worker_loop % {
+        "worker": worker,
+        "idle_ttl": int(idle_ttl),
+        "poll_seconds": max(1, int(poll_seconds)),
+        "functions": queue.functions(),
+    }
+
+
+class Pilot:
+    """
+    A pilot runs Snakemake jobs with the same signature on warm workers.
+
+    Its workers are Batch jobs made from the request of the first job
+    (template), with the Snakemake command replaced by the worker loop.
+    Jobs are queued, and the pilot keeps up to max_workers workers for
+    them. Workers stop by themselves after being idle for a while.
+
+    Workers are added from the main thread (on submission) and from the
+    status checks (in a worker thread), so both hold the lock while they
+    use the workers and tasks.
+    """
+
+    def __init__(self, key, queue, template, max_workers=1):
+        self.key = key
+        self.queue = queue
+        self.template = template
+        self.max_workers = max(1, max_workers)
+
+        # Batch job name of each worker to its worker id, and queued tasks
+        self.lock = threading.Lock()
+        self.workers = {}
+        self.tasks = set()
+
+    def needed(self):
+        """
+        The number of workers to add for the queued tasks.
+        """
+        return max(0, min(self.max_workers, len(self.tasks)) - len(self.workers))
@@ -0,0 +1,127 @@
+# Reference volumes: read-only disks made from a bucket prefix, once
+
+import hashlib
+import math
+import re
+
+from snakemake_interface_common.exceptions import WorkflowError
+
+from snakemake_executor_plugin_googlebatch.volumes import VolumeSpec
+
+# Images are marked ready next to the reference data, under this prefix
+marker_prefix = ".snakemake-references"
+
+# Room left on a reference disk for the file system (GB)
+filesystem_gb = 10
+
+# The machine type of the job that builds a reference image
+builder_machine_type = "e2-standard-4"
+
+# Copy a bucket prefix onto a new disk, and make an image of the disk
+builder_script = """
+#!/bin/bash
+set -e
+name=%(image)s
+metadata=http://metadata.google.internal/computeMetadata/v1/instance
+zone=$(curl -s -H "Metadata-Flavor: Google" ${metadata}/zone | cut -d/ -f4)
+instance=$(curl -s -H "Metadata-Flavor: Google" ${metadata}/name)
+if gcloud compute images describe ${name} > /dev/null 2>&1; then
+    echo "The reference image ${name} exists already"
+else
+    cleanup() {
+        gcloud compute instances detach-disk ${instance} --disk=${name} \\
+            --zone=${zone} || true
+        gcloud compute disks delete ${name} --zone=${zone} --quiet || true
+    }
+    trap cleanup EXIT
+    gcloud compute disks create ${name} --size=%(size_gb)sGB \\
+        --type=pd-balanced --zone=${zone}
+    gcloud compute instances attach-disk ${instance} --disk=${name} \\
+        --device-name=${name} --zone=${zone}
+    device=/dev/disk/by-id/google-${name}
+    while [ ! -e ${device} ]; do sleep 1; done
+    sudo mkfs.ext4 -F ${device}
+    sudo mkdir -p /mnt/reference
+    sudo mount ${device} /mnt/reference
+    sudo gsutil -m cp -r "%(url)s/*" /mnt/reference/
+    sudo umount /mnt/reference
+    gcloud compute instances detach-disk ${instance} --disk=${name} --zone=${zone}
+    gcloud compute images create ${name} --source-disk=${name} \\
+        --source-disk-zone=${zone} --labels=snakemake-reference=%(digest)s
+fi
+echo ${name} | gsutil cp - %(marker)s
+echo "The reference image ${name} holds %(url)s"
+"""
+
+
+class ReferenceVolume(VolumeSpec):
+    """
+    A reference volume is a bucket prefix that jobs read from a disk.
+
+    It is written as <gs://bucket/prefix>:<mount path>[:<size GB>], and
+    volumes are separated by commas. The disk of each job is made from an
+    image of the prefix, named by a hash of its content, and mounted
+    read-only.
+    """
+
+    def __init__(self, url, mount_path, size_gb=None):
+        super().__init__("pd-balanced", mount_path, size_gb=size_gb)
+        self.url = url.rstrip("/")
+        self.image = None
+
+    @property
+    def read_only(self):
+        return True
+
+    @classmethod
+    def parse(cls, spec):
+        match = re.fullmatch(r"(gs://[^:]+):([^:]+)(?::(\d+))?", spec.strip())
+        if not match:
+            raise WorkflowError(
+                f"Invalid reference volume {spec}, expected "
+                "gs://<bucket>/<prefix>:<path>[:<size GB>]"
+            )
+        url, mount_path, size_gb = match.groups()
+        return cls(url, mount_path, int(size_gb) if size_gb else None)
+
+
+def parse_references(spec):
+    """
+    Parse comma separated reference volumes, naming their disks in order.
+    """
+    references = [
+        ReferenceVolume.parse(x) for x in (spec or "").split(",") if x.strip()
+    ]
+    for index, reference in enumerate(references):
+        reference.device_name = f"snakemake-reference-{index}"
+    return references
+
+
+def content_digest(objects):
+    """
+    A hash of the objects (name, checksum and size) under a prefix.
+    """
+    digest = hashlib.sha256()
+    for name, checksum, size in sorted(objects):
+        digest.update(f"{name}\0{checksum}\0{size}\n".encode("utf-8"))
+    return digest.hexdigest()[0:16]
+
+
+def disk_size_gb(objects):
+    """
+    The size of a disk (GB) that holds the objects.
+    """
+    size = sum(size for _, _, size in objects)
+    return math.ceil(size * 1.1 / 1024**3) + filesystem_gb
+
+
+def image_name(digest, size_gb):
+    return f"snakemake-ref-{digest}-{size_gb}"
+
+
+def marker_url(url, image):
+    """
+    The object marking an image as ready, in the bucket of the reference.
+    """
+    bucket = url[len("gs://") :].split("/")[0]
+    return f"gs://{bucket}/{marker_prefix}/{image}"
@@ -0,0 +1,204 @@
+# Status polling for Google Batch jobs
+
+import asyncio
+
+from google.cloud import batch_v1
+
+import snakemake_executor_plugin_googlebatch.api as apiutil
+
+
+class StatusPoller:
+    """
+    A status poller requests the state of many Google Batch jobs at once.
+
+    Requests are sent through the async Batch client, and at most
+    max_concurrency of them are in flight at any given time. Each request
+    is retried on transient errors by the resilient API.
+    """
+
+    def __init__(self, client, max_concurrency=50, api=None):
+        self.client = client
+        self.max_concurrency = max(1, max_concurrency or 1)
+        self.api = api or apiutil.ResilientApi()
+
+    async def get_job(self, name, semaphore):
+        """
+        Get a single job, waiting for a free slot first.
+        """
+        async with semaphore:
+            request = batch_v1.GetJobRequest(name=name)
+            return await self.api.call_async(self.client.get_job, request=request)
+
+    async def get_jobs(self, names):
+        """
+        Get many jobs concurrently.
+
+        The result is a lookup of job name to the job, or to the exception
+        raised when requesting it, so one failed request does not hide the
+        status of the others.
+        """
+        # The semaphore must be created in the loop that uses it
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        responses = await asyncio.gather(
+            *[self.get_job(name, semaphore) for name in names],
+            return_exceptions=True,
+        )
+        return dict(zip(names, responses))
+
+    async def list_tasks(self, group, semaphore):
+        """
+        List all tasks of a task group, waiting for a free slot first.
+        """
+        async with semaphore:
+            request = batch_v1.ListTasksRequest(parent=group)
+            pager = await self.api.call_async(self.client.list_tasks, request=request)
+            return [task async for task in pager]
+
+    async def get_tasks(self, groups):
+        """
+        List the tasks of many task groups (of job arrays) concurrently.
+
+        The result is a lookup of task group name to its tasks, or to the
+        exception raised when listing them.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        responses = await asyncio.gather(
+            *[self.list_tasks(group, semaphore) for group in groups],
+            return_exceptions=True,
+        )
+        return dict(zip(groups, responses))
+
+
+class StatusIndex:
+    """
+    A status index holds the latest known state of the jobs of one workflow run.
+
+    It is refreshed with one paged list_jobs call per parent, filtered on the
+    run label, so a poll cycle costs about one request per page of jobs
+    instead of one per job. Finished jobs are listed too, since leaving them
+    out would cost a get_job request for each job when it finishes. A field
+    mask limits the response to what the status checks read.
+    """
+
+    fields = [
+        "jobs.name",
+        "jobs.status.state",
+        "jobs.status.status_events",
+        "next_page_token",
+    ]
+
+    def __init__(self, client, label, run_id, page_size=500, api=None):
+        self.client = client
+        self.api = api or apiutil.ResilientApi()
+        self.filter = f'labels.{label}="{run_id}"'
+        self.page_size = page_size
+        self.jobs = {}
+
+    async def list_jobs(self, parent):
+        """
+        List all jobs of the run under one parent (project and region).
+        """
+        request = batch_v1.ListJobsRequest(
+            parent=parent, filter=self.filter, page_size=self.page_size
+        )
+        pager = await self.api.call_async(
+            self.client.list_jobs,
+            request=request,
+            metadata=[("x-goog-fieldmask", ",".join(self.fields))],
+        )
+        return [job async for job in pager]
+
+    async def refresh(self, parents):
+        """
+        Replace the index with the jobs currently listed under the parents.
+
+        The index is emptied first, so it never serves a stale listing when
+        listing fails.
+        """
+        self.jobs = {}
+        parents = sorted(set(parents))
+        listings = await asyncio.gather(*[self.list_jobs(p) for p in parents])
+        self.jobs = {job.name: job for listing in listings for job in listing}
+
+    def get(self, name):
+        """
+        Get the last listed job by name (None if not listed yet).
+        """
+        return self.jobs.get(name)
+
+
+class PollScheduler:
+    """
+    A poll scheduler decides when each active job is checked next.
+
+    New jobs are due right away, and jobs that are queued or scheduled are
+    checked every interval. Once a job runs, the time between checks doubles
+    with every check, up to max_interval. Jobs of a rule that finished before
+    are also checked right when they are expected to finish (after the
+    average running time of the rule), so quick completions are not missed.
+    """
+
+    def __init__(self, interval=10, max_interval=600, factor=2):
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.factor = factor
+
+        # Per job name: next check, current interval, and start of running
+        self.next_check = {}
+        self.intervals = {}
+        self.running_since = {}
+
+        # Per rule: number of finished jobs and their average running time
+        self.finished = {}
+        self.durations = {}
+
+    def is_due(self, name, now):
+        return self.next_check.get(name, now) <= now
+
+    def expected_finish(self, name, rule):
+        """
+        When a running job is expected to finish, if the rule finished before.
+        """
+        if name not in self.running_since or rule not in self.durations:
+            return
+        return self.running_since[name] + self.durations[rule]
+
+    def update(self, name, rule, state, now):
+        """
+        Schedule the next check of a job that is still active.
+        """
+        if state != "RUNNING":
+            self.intervals[name] = self.interval
+            self.next_check[name] = now + self.interval
+            return
+
+        if name not in self.running_since:
+            self.running_since[name] = now
+            interval = self.interval
+        else:
+            interval = min(
+                self.intervals.get(name, self.interval) * self.factor,
+                self.max_interval,
+            )
+        self.intervals[name] = interval
+        next_check = now + interval
+
+        # Don't sleep past the expected finish
+        expected = self.expected_finish(name, rule)
+        if expected is not None and now < expected < next_check:
+            next_check = expected
+        self.next_check[name] = next_check
+
+    def finish(self, name, rule, now):
+        """
+        Forget a finished job, adding its running time to the rule average.
+        """
+        started = self.running_since.pop(name, None)
+        self.next_check.pop(name, None)
+        self.intervals.pop(name, None)
+        if started is None:
+            return
+        count = self.finished.get(rule, 0)
+        average = self.durations.get(rule, 0)
+        self.finished[rule] = count + 1
+        self.durations[rule] = average + (now - started - average) / (count + 1)
@@ -1,4 +1,7 @@
-from google.api_core import retry
+import threading
+import time
+
+from google.api_core import exceptions, retry
 from requests.exceptions import ReadTimeout
 
 
@@ -8,10 +11,11 @@ def google_cloud_retry(ex):
 
     Given an exception from Google Cloud, determine if it's one in the
     listing of transient errors (determined by function
-    google.api_core.retry.if_transient_error(exception)) or determine if
-    triggered by a hash mismatch due to a bad download. This function will
-    return a boolean to indicate if retry should be done, and is typically
-    used with the google.api_core.retry.Retry as a decorator (predicate).
+    google.api_core.retry.if_transient_error(exception)), a call that
+    exceeded its deadline, or determine if triggered by a hash mismatch due
+    to a bad download. This function will return a boolean to indicate if
+    retry should be done, and is typically used with the
+    google.api_core.retry.Retry as a decorator (predicate).
 
     Arguments:
       ex (Exception) : the exception passed from the decorated function
@@ -21,6 +25,10 @@ def google_cloud_retry(ex):
     if retry.if_transient_error(ex):
         return True
 
+    # A call that ran into its deadline can be tried again.
+    if isinstance(ex, exceptions.DeadlineExceeded):
+        return True
+
     # Timeouts should be considered for retry as well.
     if isinstance(ex, ReadTimeout):
         return True
@@ -42,6 +50,14 @@ def bytesto(bytes, to, bsize=1024):
     return answer
 
 
+def split_gcs_url(url):
+    """
+    Split a gs://bucket/name url into the bucket and (object) name.
+    """
+    bucket, _, name = url[len("gs://") :].partition("/")
+    return bucket, name
+
+
 def read_file(filename):
     """
     Read a file from the local system.
@@ -49,3 +65,51 @@ def read_file(filename):
     with open(filename, "r") as fd:
         content = fd.read()
     return content
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket to rate limit requests.
+
+    Tokens are added at rate per second, up to capacity. Each request
+    takes a token, waiting for one to be added if none are left.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        """
+        Add the tokens earned since the last update (must hold the lock).
+        """
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.updated - now, 0) + (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hand out no tokens for the next seconds (e.g., after a quota error).
+        """
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic() + seconds)
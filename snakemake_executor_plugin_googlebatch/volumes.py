@@ -0,0 +1,293 @@
+# Volumes of a task: local SSDs, persistent disks and buckets
+
+from google.cloud import batch_v1
+from snakemake_interface_common.exceptions import WorkflowError
+
+# Size of one local SSD (GB)
+local_ssd_gb = 375
+
+# Disk types from fastest to slowest, to pick the scratch space
+disk_types = [
+    "local-ssd",
+    "hyperdisk-extreme",
+    "pd-ssd",
+    "hyperdisk-balanced",
+    "pd-balanced",
+    "hyperdisk-throughput",
+    "pd-standard",
+]
+
+# The gcsfuse file cache on the boot disk (MB), without a disk for it
+boot_cache_mb = 4096
+
+# Mount profiles: gcsfuse options of buckets, for how a job uses them
+# https://cloud.google.com/storage/docs/cloud-storage-fuse/cli-options
+mount_profiles = {
+    "default": [],
+    # Files are read several times, and in random order: cache them
+    "read-heavy": [
+        "--implicit-dirs",
+        "--metadata-cache-ttl-secs=600",
+        "--stat-cache-max-size-mb=256",
+        "--type-cache-max-size-mb=32",
+        "--kernel-list-cache-ttl-secs=600",
+        "--cache-dir=%(cache)s",
+        "--file-cache-max-size-mb=%(cache_mb)s",
+        "--file-cache-cache-file-for-range-read",
+        "--file-cache-enable-parallel-downloads",
+        "--file-cache-parallel-downloads-per-file=16",
+    ],
+    # Files are written: stage them on disk, and see those of other jobs
+    "write-heavy": [
+        "--implicit-dirs",
+        "--metadata-cache-ttl-secs=0",
+        "--temp-dir=%(temp)s",
+    ],
+    # Large files are read once, from start to end
+    "streaming": [
+        "--implicit-dirs",
+        "--metadata-cache-ttl-secs=60",
+        "--sequential-read-size-mb=200",
+        "--max-conns-per-host=100",
+    ],
+}
+
+# Local SSDs striped into one RAID0 volume, once per VM
+raid0_step = """
+#!/bin/bash
+set -e
+if ! mountpoint -q %(mount)s; then
+command -v mdadm || sudo yum install -y mdadm || sudo apt-get install -y mdadm
+devices=""
+for name in %(names)s; do
+    devices="${devices} /dev/disk/by-id/google-${name}"
+done
+sudo mdadm --create /dev/md/%(device)s --level=0 --raid-devices=%(count)s \\
+    --force --run ${devices}
+sudo mkfs.ext4 -F /dev/md/%(device)s
+sudo mkdir -p %(mount)s
+sudo mount /dev/md/%(device)s %(mount)s
+sudo chmod a+w %(mount)s
+fi
+echo "Striped %(count)s local SSDs into %(mount)s"
+"""
+
+
+class VolumeSpec:
+    """
+    A volume spec declares one volume of a task.
+
+    It is written as <kind>:<options>:<mount path>, and specs are separated
+    by commas:
+
+      local-ssd:<count>:<mount path>[:raid0]
+      <disk type>:<size GB>:<mount path>  (pd-* or hyperdisk-* types)
+      gcs:<bucket[/prefix]>:<mount path>[:<mount profile>]
+      nfs:<server>:<remote path>:<mount path>
+    """
+
+    def __init__(
+        self,
+        kind,
+        mount_path,
+        size_gb=None,
+        count=1,
+        remote_path=None,
+        raid0=False,
+        profile=None,
+        server=None,
+    ):
+        self.kind = kind
+        self.mount_path = mount_path
+        self.size_gb = size_gb
+        self.count = count
+        self.remote_path = remote_path
+        self.raid0 = raid0
+        self.profile = profile
+        self.server = server
+        self.device_name = None
+        self.image = None
+
+    @property
+    def is_disk(self):
+        return self.kind in disk_types
+
+    @property
+    def read_only(self):
+        return False
+
+    @property
+    def device_names(self):
+        """
+        The device names of the disks (one per local SSD when striped).
+        """
+        if self.raid0:
+            return [f"{self.device_name}-{i}" for i in range(self.count)]
+        return [self.device_name]
+
+    @classmethod
+    def parse(cls, spec):
+        parts = [part.strip() for part in spec.strip().split(":")]
+        kind = parts[0]
+        try:
+            if kind == "gcs" and len(parts) in [3, 4]:
+                profile = parts[3] if len(parts) == 4 else None
+                if profile is not None and profile not in mount_profiles:
+                    raise ValueError(f"unknown mount profile {profile}")
+                return cls(kind, parts[2], remote_path=parts[1], profile=profile)
+            if kind == "nfs" and len(parts) == 4:
+                return cls(kind, parts[3], remote_path=parts[2], server=parts[1])
+            if kind == "local-ssd" and len(parts) in [3, 4]:
+                raid0 = len(parts) == 4
+                if raid0 and parts[3] != "raid0":
+                    raise ValueError(f"unknown option {parts[3]}")
+                count = int(parts[1])
+                if count < 1:
+                    raise ValueError("at least one local SSD is needed")
+                return cls(
+                    kind,
+                    parts[2],
+                    size_gb=count * local_ssd_gb,
+                    count=count,
+                    raid0=raid0 and count > 1,
+                )
+            if kind in disk_types and len(parts) == 3:
+                return cls(kind, parts[2], size_gb=int(parts[1]))
+        except ValueError as e:
+            raise WorkflowError(f"Invalid volume {spec}: {e}")
+        raise WorkflowError(
+            f"Invalid volume {spec}, expected local-ssd:<count>:<path>[:raid0], "
+            "<disk type>:<size GB>:<path>, gcs:<bucket>:<path>[:<profile>] or "
+            "nfs:<server>:<remote path>:<path>"
+        )
+
+
+def parse_volumes(spec):
+    """
+    Parse comma separated volume specs, naming the disks in order.
+    """
+    volumes = [VolumeSpec.parse(x) for x in (spec or "").split(",") if x.strip()]
+    paths = [volume.mount_path for volume in volumes]
+    if len(set(paths)) != len(paths):
+        raise WorkflowError(f"Volumes {spec} share a mount path")
+    disks = [volume for volume in volumes if volume.is_disk]
+    for index, volume in enumerate(disks):
+        volume.device_name = f"snakemake-disk-{index}"
+    return volumes
+
+
+def attached_disks(volumes):
+    """
+    The disks to attach to the VM for the volumes.
+    """
+    disks = []
+    for volume in volumes:
+        if not volume.is_disk:
+            continue
+        size_gb = local_ssd_gb if volume.raid0 else volume.size_gb
+        for device_name in volume.device_names:
+            disk = batch_v1.AllocationPolicy.AttachedDisk()
+            disk.new_disk = batch_v1.AllocationPolicy.Disk(
+                type_=volume.kind, size_gb=size_gb
+            )
+            if volume.image:
+                disk.new_disk.image = volume.image
+            disk.device_name = device_name
+            disks.append(disk)
+    return disks
+
+
+def task_volumes(volumes, profile="default"):
+    """
+    The volumes Batch mounts for the task (striped SSDs are mounted by a step).
+
+    NFS shares (which can hold the others' paths) are mounted first, and
+    disks before buckets, so gcsfuse can cache on them. Buckets are mounted
+    with the options of their own profile, or the given one.
+    """
+    mounts = []
+    order = {"nfs": 0}
+    for volume in sorted(
+        volumes, key=lambda volume: order.get(volume.kind, 1 if volume.is_disk else 2)
+    ):
+        if volume.raid0:
+            continue
+        mount = batch_v1.Volume(mount_path=volume.mount_path)
+        if volume.kind == "nfs":
+            mount.nfs = batch_v1.NFS(
+                server=volume.server, remote_path=volume.remote_path
+            )
+        elif volume.is_disk:
+            mount.device_name = volume.device_name
+            if volume.read_only:
+                mount.mount_options = ["ro"]
+        else:
+            mount.gcs = batch_v1.GCS(remote_path=volume.remote_path)
+            mount.mount_options = mount_options(volume.profile or profile, volumes)
+        mounts.append(mount)
+    return mounts
+
+
+def mount_options(profile, volumes=None):
+    """
+    The gcsfuse options of a mount profile.
+
+    Caches and staged writes go to the fastest disk Batch mounts (striped
+    SSDs are mounted later), or to the boot disk. The file cache takes up to
+    half of the disk.
+    """
+    if profile not in mount_profiles:
+        raise WorkflowError(
+            f"Mount profile must be one of {list(mount_profiles)}, found {profile}"
+        )
+    disks = [volume for volume in volumes or [] if not volume.raid0]
+    disk = fastest_disk(disks)
+    if disk is not None:
+        values = {
+            "cache": f"{disk.mount_path}/gcsfuse-cache",
+            "temp": f"{disk.mount_path}/gcsfuse-temp",
+            "cache_mb": disk.size_gb * 1024 // 2,
+        }
+    else:
+        values = {
+            "cache": "/tmp/gcsfuse-cache",
+            "temp": "/tmp/gcsfuse-temp",
+            "cache_mb": boot_cache_mb,
+        }
+    return [option % values for option in mount_profiles[profile]]
+
+
+def raid0_steps(volumes):
+    """
+    The scripts striping local SSDs of the volumes into one volume each.
+    """
+    return [
+        raid0_step
+        % {
+            "mount": volume.mount_path,
+            "names": " ".join(volume.device_names),
+            "device": volume.device_name,
+            "count": volume.count,
+        }
+        for volume in volumes
+        if volume.raid0
+    ]
+
+
+def fastest_disk(volumes):
+    """
+    The volume of the fastest disk that can be written (None without disks).
+    """
+    disks = [volume for volume in volumes if volume.is_disk and not volume.read_only]
+    if not disks:
+        return
+    return min(disks, key=lambda volume: disk_types.index(volume.kind))
+
+
+def scratch_path(volumes):
+    """
+    The mount path of the fastest disk (None without disks).
+    """
+    disk = fastest_disk(volumes)
+    if disk is not None:
+        return disk.mount_path
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the Google Batch executor, run against in-process fakes.
+# usage:
+#         python -m tests.benchmarks poll --jobs 10,100,1000,2000
+#         python -m tests.benchmarks spec --jobs 10000
+#         python -m tests.benchmarks scale --jobs 100,1000,10000
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import pathlib
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import MagicMock
+
+from snakemake_executor_plugin_googlebatch.logs import LogHarvester
+from snakemake_executor_plugin_googlebatch.status import StatusPoller
+from tests.fake import (
+    FakeBatchAsyncClient,
+    FakeBatchService,
+    FakeWorkflowRun,
+    make_building_executor,
+    make_building_job,
+)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Snakemake Google Batch Executor Benchmarks",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    poll = subparsers.add_parser("poll", help="poll cycle time by active jobs")
+    poll.add_argument(
+        "--jobs",
+        help="comma separated numbers of active jobs (defaults to 10,100,1000,2000)",
+        default="10,100,1000,2000",
+    )
+    poll.add_argument(
+        "--concurrency",
+        help="comma separated status request limits (defaults to 1,10,50,200)",
+        default="1,10,50,200",
+    )
+    poll.add_argument(
+        "--latency",
+        help="seconds per fake get_job request (defaults to 0.01)",
+        default=0.01,
+        type=float,
+    )
+
+    spec = subparsers.add_parser("spec", help="job request build time")
+    spec.add_argument(
+        "--jobs",
+        help="number of jobs to build requests for (defaults to 10000)",
+        default=10000,
+        type=int,
+    )
+    spec.add_argument(
+        "--kinds",
+        help="number of distinct machine types among the jobs (defaults to 4)",
+        default=4,
+        type=int,
+    )
+
+    scale = subparsers.add_parser(
+        "scale", help="workflow runs against a fake Batch service by job count"
+    )
+    scale.add_argument(
+        "--jobs",
+        help="comma separated numbers of jobs (defaults to 100,1000,10000)",
+        default="100,1000,10000",
+    )
+    scale.add_argument(
+        "--latency",
+        help="seconds per fake Batch request (defaults to 0.01)",
+        default=0.01,
+        type=float,
+    )
+    scale.add_argument(
+        "--status-mode",
+        help="status mode of the executor (get or list, defaults to get)",
+        default="get",
+    )
+    scale.add_argument(
+        "--array-size",
+        help="array size of the executor (defaults to 0, no job arrays)",
+        default=0,
+        type=int,
+    )
+    scale.add_argument(
+        "--quota-errors",
+        help="share of fake Batch requests failing with a quota error",
+        default=0,
+        type=float,
+    )
+    scale.add_argument(
+        "--preemptions",
+        help="share of fake Batch jobs getting preempted",
+        default=0,
+        type=float,
+    )
+    return parser
+
+
+def split_ints(value):
+    return [int(x) for x in value.split(",") if x.strip()]
+
+
+def print_table(header, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(str(x).rjust(w) for x, w in zip(row, widths)))
+
+
+def benchmark_poll(args):
+    """
+    Time one poll cycle for a number of active jobs and concurrency limits.
+    """
+    concurrency = split_ints(args.concurrency)
+    rows = []
+    for count in split_ints(args.jobs):
+        names = [f"projects/p/locations/r/jobs/job-{i}" for i in range(count)]
+        row = [count]
+        for limit in concurrency:
+            poller = StatusPoller(FakeBatchAsyncClient(args.latency), limit)
+            start = time.perf_counter()
+            asyncio.run(poller.get_jobs(names))
+            row.append(f"{time.perf_counter() - start:.3f}s")
+        rows.append(row)
+
+    print(f"Poll cycle time with {args.latency}s per get_job request")
+    print_table(["jobs"] + [f"limit={x}" for x in concurrency], rows)
+
+
+def benchmark_spec(args):
+    """
+    Time building job requests, with and without the spec cache.
+    """
+    tmp_path = pathlib.Path(tempfile.mkdtemp())
+    jobs = [
+        make_building_job(
+            tmp_path,
+            f"rule-{i}",
+            {"googlebatch_machine_type": f"n2-standard-{2 ** (i % args.kinds)}"},
+        )
+        for i in range(args.jobs)
+    ]
+
+    rows = []
+    for cached in [False, True]:
+        executor = make_building_executor(tmp_path)
+        executor.logger = logging.getLogger("benchmark")
+        if not cached:
+            executor.cached_spec = lambda key, build: build()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for job in jobs:
+                executor.build_job_request(job)
+            seconds = time.perf_counter() - start
+        per_10k = seconds / args.jobs * 10000
+        rows.append(["yes" if cached else "no", f"{seconds:.3f}s", f"{per_10k:.3f}s"])
+
+    print(f"Build time of {args.jobs} job requests ({args.kinds} machine types)")
+    print_table(["cache", "total", "per 10k jobs"], rows)
+
+
+def make_run(args, count):
+    service = FakeBatchService(
+        latency=args.latency,
+        quota_error_rate=args.quota_errors,
+        preempt_rate=args.preemptions,
+    )
+    run = FakeWorkflowRun(
+        pathlib.Path(tempfile.mkdtemp()),
+        service,
+        status_mode=args.status_mode,
+        array_size=args.array_size,
+    )
+    return run, run.make_jobs(count)
+
+
+def benchmark_harvest(run):
+    """
+    Time saving the logs of all finished jobs of a run again, in entries/s.
+    """
+    harvester = LogHarvester(
+        "p",
+        MagicMock(),
+        requests_per_minute=60000000,
+        client=run.service.logging,
+        api=run.executor.api,
+    )
+    logs = run.tmp_path / "harvest"
+    logs.mkdir()
+    for index, j in enumerate(run.succeeded + run.failed):
+        harvester.submit(run.executor.log_key(j), str(logs / f"{index}.log"))
+    start = time.perf_counter()
+    harvester.shutdown()
+    return len(run.service.logging.entries) / (time.perf_counter() - start)
+
+
+def benchmark_scale(args):
+    """
+    Run workflows of growing size against a fake Batch service.
+
+    Submission throughput, the time and requests of a poll cycle and the
+    log harvest throughput are measured in one run, and the memory held by
+    the executor for its active jobs (after submission and one status
+    check) in another, since tracing memory slows everything down.
+    """
+    rows = []
+    for count in split_ints(args.jobs):
+        run, jobs = make_run(args, count)
+        start = time.perf_counter()
+        run.submit(jobs)
+        submit_seconds = time.perf_counter() - start
+
+        seconds = []
+        requests = sum(run.service.calls.values())
+        while run.active:
+            start = time.perf_counter()
+            run.poll()
+            seconds.append(time.perf_counter() - start)
+        run.executor.log_harvester.shutdown()
+        requests = sum(run.service.calls.values()) - requests
+        harvest = benchmark_harvest(run)
+
+        run, jobs = make_run(args, count)
+        tracemalloc.start()
+        run.submit(jobs)
+        run.poll()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        run.executor.log_harvester.shutdown()
+
+        rows.append(
+            [
+                count,
+                f"{count / submit_seconds:.0f}",
+                f"{sum(seconds) / len(seconds):.3f}s",
+                f"{requests / len(seconds):.0f}",
+                f"{harvest:.0f}",
+                f"{memory / count / 1024:.1f}",
+            ]
+        )
+
+    print(
+        f"Workflow runs with {args.latency}s per fake Batch request "
+        f"(status mode {args.status_mode}, array size {args.array_size})"
+    )
+    header = ["jobs", "submits/s", "poll cycle", "requests/cycle"]
+    print_table(header + ["log entries/s", "KiB/active job"], rows)
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.benchmark == "poll":
+        benchmark_poll(args)
+    elif args.benchmark == "spec":
+        benchmark_spec(args)
+    elif args.benchmark == "scale":
+        benchmark_scale(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,708 @@
+# In-process fakes of the Google Cloud clients used by the executor
+
+import asyncio
+import collections
+import contextlib
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+import random
+import re
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from google.api_core.exceptions import AlreadyExists, NotFound, ResourceExhausted
+from google.cloud.batch_v1.types import (
+    ComputeResource,
+    CreateJobRequest,
+    Job,
+    JobStatus,
+    Runnable,
+    StatusEvent,
+    Task,
+    TaskGroup,
+    TaskSpec,
+    TaskStatus,
+)
+
+from snakemake_executor_plugin_googlebatch import ExecutorSettings
+from snakemake_executor_plugin_googlebatch.executor import GoogleBatchExecutor
+
+
+class FakeJobPager:
+    """
+    A fake async pager, counting a request for each page it fetches.
+    """
+
+    def __init__(self, client, jobs, page_size):
+        self.client = client
+        self.jobs = jobs
+        self.page_size = page_size or len(jobs) or 1
+
+    async def __aiter__(self):
+        for start in range(0, max(len(self.jobs), 1), self.page_size):
+            # The first page is fetched by list_jobs itself
+            if start:
+                self.client.list_calls += 1
+                await asyncio.sleep(self.client.latency)
+            for job in self.jobs[start : start + self.page_size]:
+                yield job
+
+
+class FakeBatchAsyncClient:
+    """
+    A fake async Batch client that answers after a fixed latency.
+
+    Jobs added with add_job are returned as stored, and any other job is
+    reported with the default state. The client records the number of
+    requests in flight, so tests can check how many were sent at once.
+    """
+
+    def __init__(self, latency=0.01, state=JobStatus.State.RUNNING):
+        self.latency = latency
+        self.state = state
+        self.jobs = {}
+        self.tasks = {}
+        self.calls = 0
+        self.list_calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def add_job(self, name, state=None, labels=None):
+        job = Job(
+            name=name,
+            labels=labels or {},
+            status=JobStatus(state=state or self.state),
+        )
+        self.jobs[name] = job
+        return job
+
+    async def get_job(self, request=None, **kwargs):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        if request.name in self.jobs:
+            return self.jobs[request.name]
+        return Job(name=request.name, status=JobStatus(state=self.state))
+
+    def add_task(self, group, index, state=TaskStatus.State.PENDING):
+        task = Task(name=f"{group}/tasks/{index}", status=TaskStatus(state=state))
+        self.tasks.setdefault(group, []).append(task)
+        return task
+
+    async def list_tasks(self, request=None, **kwargs):
+        self.list_calls += 1
+        await asyncio.sleep(self.latency)
+        return FakeJobPager(self, self.tasks.get(request.parent, []), None)
+
+    async def list_jobs(self, request=None, metadata=None, **kwargs):
+        self.list_calls += 1
+        await asyncio.sleep(self.latency)
+
+        # Only the labels.<key>="<value>" filter is understood
+        match = re.fullmatch(r'labels\.(\S+)="(.*)"', request.filter or "")
+        jobs = [
+            job
+            for name, job in self.jobs.items()
+            if name.startswith(request.parent + "/")
+            and (not match or job.labels.get(match.group(1)) == match.group(2))
+        ]
+        return FakeJobPager(self, jobs, request.page_size)
+
+
+class FakeLogEntry:
+    """
+    A fake Cloud Logging entry from a Batch task.
+    """
+
+    def __init__(self, job_uid, payload, timestamp, insert_id, task_index=None):
+        self.labels = {"job_uid": job_uid}
+        if task_index is not None:
+            self.labels["task_id"] = f"task/{job_uid}-group0-{task_index}/0/0"
+        self.payload = payload
+        self.timestamp = timestamp
+        self.insert_id = insert_id
+
+
+class FakeEntries:
+    """
+    Fake entries of a list_entries call, fetched page by page.
+    """
+
+    def __init__(self, client, entries, page_size):
+        self.client = client
+        self.entries = entries
+        self.page_size = page_size or len(entries) or 1
+
+    @property
+    def pages(self):
+        for start in range(0, len(self.entries), self.page_size):
+            self.client.list_calls += 1
+            yield iter(self.entries[start : start + self.page_size])
+
+
+class FakeLogger:
+    def __init__(self, client):
+        self.client = client
+
+    def list_entries(self, filter_=None, page_size=None, **kwargs):
+        filter_ = filter_ or ""
+        uids = re.search(r"labels\.job_uid=\(([^)]*)\)", filter_)
+        uids = set(re.findall(r'"([^"]+)"', uids.group(1) if uids else ""))
+        entries = [e for e in self.client.entries if e.labels["job_uid"] in uids]
+        after = re.search(r'timestamp>="([^"]+)"', filter_)
+        if after:
+            after = datetime.fromisoformat(after.group(1))
+            entries = [e for e in entries if e.timestamp >= after]
+        return FakeEntries(self.client, entries, page_size)
+
+
+class FakeLoggingClient:
+    """
+    A fake Cloud Logging client serving entries added with add_logs.
+
+    Entries are timestamped in the order they are added, with a few
+    sharing a timestamp. Only filters on a list of labels.job_uid values
+    and a lower bound on the timestamp are understood.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.list_calls = 0
+        self.start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def add_logs(self, job_uid, lines, task_index=None):
+        for line in lines:
+            count = len(self.entries)
+            timestamp = self.start + timedelta(seconds=count // 2)
+            entry = FakeLogEntry(
+                job_uid, line, timestamp, f"insert-{count:06d}", task_index
+            )
+            self.entries.append(entry)
+
+    def logger(self, name):
+        return FakeLogger(self)
+
+
+class FakeOperation:
+    def __init__(self, result=None):
+        self.value = result
+
+    def result(self, timeout=None):
+        return self.value
+
+
+class FakeBatchService:
+    """
+    An in-process fake of the Batch service, for scale tests and benchmarks.
+
+    Created jobs move from QUEUED through SCHEDULED and RUNNING to
+    SUCCEEDED, spending durations[state] seconds in each state. Time only
+    passes with advance, so runs are fast and repeatable. A share of the
+    jobs (preempt_rate) is preempted halfway through running and fails, and
+    a share of all calls (quota_error_rate) fails with ResourceExhausted.
+    Each finished job (or task of a job array) writes log_lines entries to
+    the fake Logging client. The sync and async client views share the
+    service and retry calls with the policy they are given, like the real
+    clients do.
+    """
+
+    default_durations = {"QUEUED": 10, "SCHEDULED": 10, "RUNNING": 60}
+
+    def __init__(
+        self,
+        latency=0,
+        durations=None,
+        quota_error_rate=0,
+        preempt_rate=0,
+        log_lines=3,
+        seed=0,
+    ):
+        self.latency = latency
+        self.durations = dict(self.default_durations, **(durations or {}))
+        self.quota_error_rate = quota_error_rate
+        self.preempt_rate = preempt_rate
+        self.log_lines = log_lines
+        self.random = random.Random(seed)
+        self.logging = FakeLoggingClient()
+        self.lock = threading.Lock()
+        self.now = 0
+
+        # Per job name: the job as created, when it was created, and
+        # whether it gets preempted
+        self.jobs = {}
+        self.created = {}
+        self.preempted = set()
+        self.finished = set()
+
+        # Requests by method, and quota errors raised
+        self.calls = collections.Counter()
+        self.list_calls = 0
+        self.quota_errors = 0
+
+    def advance(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+    def request(self, method):
+        """
+        Count a request, failing it with a quota error by chance.
+        """
+        with self.lock:
+            self.calls[method] += 1
+            if method.startswith("list"):
+                self.list_calls += 1
+            if self.random.random() < self.quota_error_rate:
+                self.quota_errors += 1
+                raise ResourceExhausted(f"Quota exceeded for {method} requests")
+
+    def create(self, request):
+        name = f"{request.parent}/jobs/{request.job_id}"
+        with self.lock:
+            if name in self.jobs:
+                raise AlreadyExists(f"Job {name} already exists")
+            job = Job.deserialize(Job.serialize(request.job))
+            job.name = name
+            job.uid = f"{request.job_id}-{len(self.jobs):06d}"
+            job.create_time = self.logging.start
+            for index, group in enumerate(job.task_groups):
+                group.name = f"{name}/taskGroups/group{index}"
+            self.jobs[name] = job
+            self.created[name] = self.now
+            if self.random.random() < self.preempt_rate:
+                self.preempted.add(name)
+        return self.get(name)
+
+    def state(self, name):
+        """
+        The state of a job at the current time (writing its logs once done).
+        """
+        elapsed = self.now - self.created[name]
+        state = "SUCCEEDED"
+        for step in ["QUEUED", "SCHEDULED", "RUNNING"]:
+            duration = self.durations[step]
+            if step == "RUNNING" and name in self.preempted:
+                duration /= 2
+            if elapsed < duration:
+                state = step
+                break
+            elapsed -= duration
+        else:
+            if name in self.preempted:
+                state = "FAILED"
+        if state in ["SUCCEEDED", "FAILED"] and name not in self.finished:
+            self.finished.add(name)
+            self.write_logs(self.jobs[name])
+        return state
+
+    def write_logs(self, job):
+        count = job.task_groups[0].task_count if job.task_groups else 1
+        for index in range(max(count, 1)):
+            lines = [f"{job.name} line {i}" for i in range(self.log_lines)]
+            self.logging.add_logs(job.uid, lines, index if count > 1 else None)
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.jobs:
+                raise NotFound(f"Job {name} not found")
+            job = Job.deserialize(Job.serialize(self.jobs[name]))
+            state = self.state(name)
+        job.status = JobStatus(state=JobStatus.State[state])
+        if state == "FAILED":
+            job.status.status_events = [
+                StatusEvent(
+                    type_="STATUS_CHANGED",
+                    event_time=self.logging.start + timedelta(seconds=self.now),
+                    description=f"Job {name} failed: the VM was preempted "
+                    "(exit code 50001)",
+                )
+            ]
+        return job
+
+    def tasks(self, group):
+        name = group.split("/taskGroups/")[0]
+        job = self.get(name)
+        state = TaskStatus.State[
+            {"QUEUED": "PENDING", "SCHEDULED": "ASSIGNED"}.get(
+                job.status.state.name, job.status.state.name
+            )
+        ]
+        return [
+            Task(name=f"{group}/tasks/{index}", status=TaskStatus(state=state))
+            for index in range(job.task_groups[0].task_count)
+        ]
+
+    def delete(self, name):
+        with self.lock:
+            if name not in self.jobs:
+                raise NotFound(f"Job {name} not found")
+            del self.jobs[name]
+
+    def client(self):
+        return FakeBatchClient(self)
+
+    def async_client(self):
+        return FakeBatchServiceAsyncClient(self)
+
+
+class FakeBatchClient:
+    """
+    A fake sync Batch client of a fake Batch service.
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    def call(self, method, func, retry=None):
+        def attempt():
+            time.sleep(self.service.latency)
+            self.service.request(method)
+            return func()
+
+        return retry(attempt)() if retry is not None else attempt()
+
+    def create_job(self, request=None, retry=None, timeout=None, **kwargs):
+        return self.call("create_job", lambda: self.service.create(request), retry)
+
+    def get_job(self, request=None, name=None, retry=None, timeout=None, **kwargs):
+        name = name or request.name
+        return self.call("get_job", lambda: self.service.get(name), retry)
+
+    def delete_job(self, request=None, retry=None, timeout=None, **kwargs):
+        return self.call(
+            "delete_job",
+            lambda: FakeOperation(self.service.delete(request.name)),
+            retry,
+        )
+
+
+class FakeBatchServiceAsyncClient:
+    """
+    A fake async Batch client of a fake Batch service.
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    async def call(self, method, func, retry=None):
+        async def attempt():
+            await asyncio.sleep(self.service.latency)
+            self.service.request(method)
+            return func()
+
+        return await (retry(attempt)() if retry is not None else attempt())
+
+    async def get_job(self, request=None, retry=None, timeout=None, **kwargs):
+        return await self.call("get_job", lambda: self.service.get(request.name), retry)
+
+    async def list_jobs(self, request=None, retry=None, timeout=None, **kwargs):
+        def list_jobs():
+            match = re.fullmatch(r'labels\.(\S+)="(.*)"', request.filter or "")
+            with self.service.lock:
+                names = [
+                    name
+                    for name, job in self.service.jobs.items()
+                    if name.startswith(request.parent + "/")
+                    and (not match or job.labels.get(match.group(1)) == match.group(2))
+                ]
+            jobs = [self.service.get(name) for name in names]
+            return FakeJobPager(self.service, jobs, request.page_size)
+
+        return await self.call("list_jobs", list_jobs, retry)
+
+    async def list_tasks(self, request=None, retry=None, timeout=None, **kwargs):
+        return await self.call(
+            "list_tasks",
+            lambda: FakeJobPager(
+                self.service, self.service.tasks(request.parent), None
+            ),
+            retry,
+        )
+
+
+def make_executor(tmp_path, **settings):
+    """
+    Make an executor without a workflow (or Google Cloud credentials).
+
+    The workflow and logger are mocks, and the sync Batch client is
+    a MagicMock that tests can configure.
+    """
+    executor = GoogleBatchExecutor.__new__(GoogleBatchExecutor)
+    executor.workflow = MagicMock()
+    executor.workflow.persistence.path = str(tmp_path / ".snakemake")
+    executor.workflow.remote_execution_settings.seconds_between_status_checks = 10
+    executor.logger = MagicMock()
+    settings.setdefault("project", "p")
+    settings.setdefault("region", "us-central1")
+    executor.executor_settings = ExecutorSettings(**settings)
+    with patch("google.cloud.batch_v1.BatchServiceClient"):
+        executor.__post_init__()
+    return executor
+
+
+def make_building_executor(tmp_path, **settings):
+    """
+    Make an executor that can build real job requests for fake jobs.
+    """
+    executor = make_executor(tmp_path, **settings)
+    snakefile = tmp_path / "Snakefile"
+    snakefile.write_text("rule all:\n    shell: 'echo $HOME'\n")
+    executor.workflow.main_snakefile = str(snakefile)
+    executor.workflow.executor_settings = executor.executor_settings
+    executor.workflow.spawned_job_args_factory.envvars.return_value = {}
+    settings = executor.workflow.remote_execution_settings
+    settings.preemptible_rules.is_preemptible.return_value = False
+    settings.preemptible_retries = None
+    executor.format_job_exec = lambda job: f"python -m snakemake --cores 1 {job.name}"
+    return executor
+
+
+def make_building_job(tmp_path, name, resources=None, threads=1):
+    """
+    A fake Snakemake job with what build_job_request reads.
+    """
+    job = MagicMock()
+    job.name = name
+    job.resources = resources or {}
+    job.threads = threads
+    job.rule.name = name.split("-")[0]
+    job.is_group.return_value = False
+    job.logfile_suggestion.return_value = str(tmp_path / "logs" / f"{name}.log")
+    return job
+
+
+def make_job_request(job, cpu_milli=1000, command=None):
+    """
+    A job request like build_job_request makes, with a runnable per step.
+    """
+    runnables = [
+        Runnable(script=Runnable.Script(text="setup")),
+        Runnable(script=Runnable.Script(text="snakefile")),
+        Runnable(barrier=Runnable.Barrier(name="wait-for-setup")),
+        Runnable(script=Runnable.Script(text=command or f"snakemake {job.name}")),
+    ]
+    task = TaskSpec(
+        runnables=runnables, compute_resource=ComputeResource(cpu_milli=cpu_milli)
+    )
+    batchjob = Job(
+        task_groups=[TaskGroup(task_count=1, task_spec=task)],
+        labels={"snakemake-job": job.name, "snakemake-run": "run"},
+    )
+    request = CreateJobRequest(
+        parent="projects/p/locations/r", job_id=job.name, job=batchjob
+    )
+    return request, f"{job.name}.log"
+
+
+class FakeJobInfo:
+    """
+    A stand-in for SubmittedJobInfo with a fake Snakemake job.
+    """
+
+    def __init__(self, external_jobid, resources=None):
+        self.external_jobid = external_jobid
+        self.job = MagicMock()
+        self.job.resources = resources or {}
+        self.aux = {"logfile": "job.log", "last_seen": None}
+
+
+class FakeMessage:
+    """
+    A fake Pub/Sub message, recording whether it was acknowledged.
+    """
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self.acked = False
+
+    def ack(self):
+        self.acked = True
+
+
+class FakeStreamingPullFuture:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def result(self, timeout=None):
+        return None
+
+
+class FakeSubscriber:
+    """
+    A fake Pub/Sub subscriber that delivers published messages right away.
+    """
+
+    def __init__(self):
+        self.callbacks = {}
+        self.futures = []
+
+    def subscribe(self, subscription, callback=None):
+        self.callbacks[subscription] = callback
+        future = FakeStreamingPullFuture()
+        self.futures.append(future)
+        return future
+
+    def publish(self, subscription, **attributes):
+        message = FakeMessage(attributes)
+        self.callbacks[subscription](message)
+        return message
+
+
+class FakeWorkflowRun:
+    """
+    Run fake jobs through an executor and a fake Batch service.
+
+    Jobs are submitted like Snakemake does, and the active jobs are then
+    checked every status interval (of service time) until all are done.
+    Submissions, log downloads and retries are not rate limited, so only
+    the executor and the service latency count.
+    """
+
+    def __init__(self, tmp_path, service, **settings):
+        settings.setdefault("submit_qps", 1000000)
+        settings.setdefault("log_requests_per_minute", 60000000)
+        self.tmp_path = tmp_path
+        self.service = service
+        self.active = []
+        self.succeeded = []
+        self.failed = []
+        self.cycles = 0
+
+        executor = make_building_executor(tmp_path, **settings)
+        executor.logger = logging.getLogger("googlebatch-fake")
+        executor.logger.setLevel(logging.ERROR)
+        executor.batch = service.client()
+        executor.async_batch = service.async_client()
+        executor.log_harvester.client = service.logging
+        executor.api.initial = 0.001
+        executor.api.maximum = 0.01
+        executor.run_job_pre = lambda job: None
+        executor.report_job_submission = self.active.append
+        executor.report_job_success = self.succeeded.append
+        executor.report_job_error = lambda j, **kwargs: self.failed.append(j)
+        self.executor = executor
+
+    def make_jobs(self, count, resources=None):
+        return [
+            make_building_job(self.tmp_path, f"rule-{i}", resources)
+            for i in range(count)
+        ]
+
+    def submit(self, jobs):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            self.executor.run_jobs(jobs)
+
+    async def check(self):
+        return [j async for j in self.executor.check_active_jobs(self.active)]
+
+    def poll(self):
+        """
+        Run one status check of the active jobs, after a status interval.
+        """
+        settings = self.executor.workflow.remote_execution_settings
+        self.service.advance(settings.seconds_between_status_checks)
+        self.active[:] = asyncio.run(self.check())
+        self.cycles += 1
+
+    def finish(self):
+        """
+        Check the active jobs until all are done, and save their logs.
+        """
+        while self.active:
+            self.poll()
+        self.executor.log_harvester.shutdown()
+
+
+# A Snakemake storage plugin keeping objects (fake://<path>) in the local
+# directory $FAKE_STORAGE, for running Snakemake jobs like on a VM. With
+# $FAKE_STORAGE_CORRUPT set, it stores truncated objects.
+fake_storage_plugin = """
+import os
+import shutil
+from dataclasses import dataclass
+
+from snakemake_interface_storage_plugins.settings import StorageProviderSettingsBase
+from snakemake_interface_storage_plugins.storage_object import (
+    StorageObjectRead,
+    StorageObjectWrite,
+)
+from snakemake_interface_storage_plugins.storage_provider import (
+    ExampleQuery,
+    QueryType,
+    StorageProviderBase,
+    StorageQueryValidationResult,
+)
+
+
+@dataclass
+class StorageProviderSettings(StorageProviderSettingsBase):
+    pass
+
+
+class StorageProvider(StorageProviderBase):
+    @classmethod
+    def example_queries(cls):
+        return [ExampleQuery("fake://bucket/file", QueryType.ANY, "A file")]
+
+    def use_rate_limiter(self):
+        return False
+
+    def default_max_requests_per_second(self):
+        return 100
+
+    def rate_limiter_key(self, query, operation):
+        return None
+
+    @classmethod
+    def is_valid_query(cls, query):
+        return StorageQueryValidationResult(query, query.startswith("fake://"))
+
+
+class StorageObject(StorageObjectRead, StorageObjectWrite):
+    def path(self):
+        return os.path.join(os.environ["FAKE_STORAGE"], self.local_suffix())
+
+    async def inventory(self, cache):
+        pass
+
+    def get_inventory_parent(self):
+        return None
+
+    def local_suffix(self):
+        return self.query[len("fake://") :]
+
+    def cleanup(self):
+        pass
+
+    def exists(self):
+        return os.path.exists(self.path())
+
+    def mtime(self):
+        return os.path.getmtime(self.path())
+
+    def size(self):
+        return os.path.getsize(self.path())
+
+    def retrieve_object(self):
+        shutil.copy(self.path(), self.local_path())
+
+    def store_object(self):
+        os.makedirs(os.path.dirname(self.path()), exist_ok=True)
+        shutil.copy(self.local_path(), self.path())
+        if os.environ.get("FAKE_STORAGE_CORRUPT"):
+            os.truncate(self.path(), 1)
+
+    def remove(self):
+        os.remove(self.path())
+
+    def list_candidate_matches(self):
+        return []
+"""
@@ -0,0 +1,70 @@
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from google.api_core.exceptions import (
+    DeadlineExceeded,
+    PermissionDenied,
+    ServiceUnavailable,
+)
+from google.api_core.retry import Retry
+
+from snakemake_executor_plugin_googlebatch.api import CircuitBreaker, ResilientApi
+
+
+def make_api(**kwargs):
+    return ResilientApi(initial=0.01, maximum=0.02, deadline=5, **kwargs)
+
+
+def test_run_retries_transient_errors():
+    api = make_api()
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise DeadlineExceeded("slow")
+        return "done"
+
+    assert api.run(flaky) == "done"
+    assert len(attempts) == 3
+    assert api.breaker.failures == 0
+
+
+def test_run_raises_permanent_errors():
+    api = make_api()
+    func = MagicMock(side_effect=PermissionDenied("no"))
+    with pytest.raises(PermissionDenied):
+        api.run(func)
+    assert func.call_count == 1
+
+
+def test_call_passes_retry_and_timeout():
+    api = make_api(timeout=7)
+    method = MagicMock(return_value="job")
+    assert api.call(method, "request") == "job"
+    assert method.call_args.kwargs["timeout"] == 7
+    assert isinstance(method.call_args.kwargs["retry"], Retry)
+
+    api.call(method, "request", timeout=1)
+    assert method.call_args.kwargs["timeout"] == 1
+
+
+def test_breaker_opens_after_failures_in_a_row():
+    breaker = CircuitBreaker(threshold=3, cooldown=0.1)
+    api = make_api(breaker=breaker)
+    func = MagicMock(side_effect=ServiceUnavailable("down"))
+    with pytest.raises(Exception):
+        api.run(func, deadline=0.05)
+    assert func.call_count >= 3
+    assert breaker.is_open
+
+    start = time.monotonic()
+    breaker.wait()
+    assert time.monotonic() - start <= 0.2
+    assert not breaker.is_open
+
+    breaker.record_failure()
+    breaker.record_success()
+    assert breaker.failures == 0
+    assert not breaker.is_open
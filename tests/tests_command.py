@@ -0,0 +1,334 @@
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+from google.api_core.exceptions import PreconditionFailed
+from snakemake_interface_common.exceptions import WorkflowError
+
+import snakemake_executor_plugin_googlebatch.command as cmdutil
+from tests.fake import (
+    fake_storage_plugin,
+    make_building_executor,
+    make_building_job,
+    make_executor,
+)
+
+
+def make_writer(writer, **settings):
+    settings = SimpleNamespace(image_family="batch-centos", **settings)
+    return writer(
+        command="snakemake --cores 1 all",
+        snakefile="rule all:\n    shell: 'true'",
+        snippets=None,
+        settings=settings,
+        resources={},
+        snakefile_path="./Snakefile",
+    )
+
+
+def test_setup_installs_snakemake_without_bundle():
+    setup = make_writer(cmdutil.CentosWriter, runtime_bundle=None).setup()
+    assert setup.startswith(cmdutil.snakemake_centos_install)
+    assert setup.endswith(cmdutil.install_snakemake)
+    assert "gsutil" not in setup
+
+
+def test_setup_unpacks_runtime_bundle():
+    centos = make_writer(cmdutil.CentosWriter, runtime_bundle="gs://b/runtime/")
+    debian = make_writer(cmdutil.DebianWriter, runtime_bundle="gs://b/runtime")
+    setup = centos.setup()
+    bundle = centos.get_runtime_bundle(cmdutil.snakemake_centos_install)
+
+    # The bundle is named by the install, so each family has its own
+    assert bundle.startswith("gs://b/runtime/snakemake-runtime-")
+    assert bundle.endswith(".tar.gz")
+    assert bundle != debian.get_runtime_bundle(cmdutil.snakemake_debian_install)
+    assert f"bundle={bundle}\n" in setup
+
+    # The install (with yum update) only runs if the bundle is missing
+    unpack = setup.index("tar -xzf")
+    assert setup.index("yum update") > unpack
+    install = cmdutil.pinned_install(cmdutil.runtime_versions())
+    assert setup.index(install) > unpack
+    assert subprocess.run(["bash", "-n", "-c", setup]).returncode == 0
+
+
+def test_runtime_bundle_follows_local_versions(monkeypatch):
+    writer = make_writer(cmdutil.CentosWriter, runtime_bundle="gs://b/runtime")
+    template = cmdutil.snakemake_centos_install
+    versions = {"snakemake": "8.30.0", "snakemake-executor-plugin-googlebatch": "0.5.1"}
+    monkeypatch.setattr(cmdutil, "runtime_versions", lambda: dict(versions))
+    bundle = writer.get_runtime_bundle(template)
+
+    # The bundled install is pinned to the local Snakemake
+    setup = writer.setup()
+    assert "pip install snakemake==8.30.0\n" in setup
+    assert "install-snek.sh https://github.com/snakemake/snakemake\n" not in setup
+    assert "install-snek.sh https://github.com/snakemake/snakemake-storage" in setup
+
+    # A new version of Snakemake or the plugin builds a new bundle
+    versions["snakemake"] = "8.31.0"
+    assert writer.get_runtime_bundle(template) != bundle
+    versions["snakemake"] = "8.30.0"
+    assert writer.get_runtime_bundle(template) == bundle
+    versions["snakemake-executor-plugin-googlebatch"] = "0.6.0"
+    assert writer.get_runtime_bundle(template) != bundle
+
+    # Development versions are not released, so they are installed from source
+    install = cmdutil.pinned_install({"snakemake": "8.30.1.dev3+g1234"})
+    assert install == cmdutil.install_snakemake
+
+
+def test_container_setup_ignores_bundle():
+    writer = make_writer(cmdutil.COSWriter, runtime_bundle="gs://b/runtime")
+    assert "gsutil" not in writer.setup()
+
+
+def run_script(script, **env):
+    return subprocess.run(
+        ["bash", "-c", script],
+        capture_output=True,
+        text=True,
+        env={"PATH": os.environ["PATH"], **env},
+    )
+
+
+def test_snakefile_is_written_as_is(tmp_path):
+    snakefile = "rule all:\n    shell: 'echo $HOME `date` \\\\n'\nEOF\n"
+    writer = make_writer(cmdutil.CentosWriter)
+    writer.snakefile = snakefile
+    writer.snakefile_path = str(tmp_path / "Snakefile")
+    assert run_script(writer.write_snakefile()).returncode == 0
+    assert (tmp_path / "Snakefile").read_text() == snakefile + "\n"
+
+
+def test_snakefile_is_downloaded_and_checked(tmp_path):
+    # A fake gsutil copies from a local "bucket"
+    bucket = tmp_path / "bucket"
+    bucket.mkdir()
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    gsutil = bin / "gsutil"
+    gsutil.write_text(f'#!/bin/bash\ncp "{bucket}/${{3#gs://b/}}" "$4"\n')
+    gsutil.chmod(0o755)
+
+    snakefile = f"rule all:\n    shell: 'echo {tmp_path}'\n"
+    digest = cmdutil.snakefile_digest(snakefile)
+    writer = make_writer(cmdutil.CentosWriter)
+    writer.snakefile = snakefile
+    writer.snakefile_path = str(tmp_path / "Snakefile")
+    writer.snakefile_url = f"gs://b/{digest}"
+    script = writer.write_snakefile()
+    assert snakefile not in script
+
+    # A Snakefile that does not match its hash is rejected
+    (bucket / digest).write_text("rule tampered:\n")
+    result = run_script(script, PATH=f"{bin}:{os.environ['PATH']}")
+    assert result.returncode == 1
+    assert "does not match its hash" in result.stdout
+
+    (bucket / digest).write_text(snakefile)
+    result = run_script(script, PATH=f"{bin}:{os.environ['PATH']}")
+    assert result.returncode == 0
+    assert (tmp_path / "Snakefile").read_text() == snakefile
+
+    # The next job on the VM uses the cached copy
+    (bucket / digest).unlink()
+    (tmp_path / "Snakefile").unlink()
+    assert run_script(script, PATH=f"{bin}:{os.environ['PATH']}").returncode == 0
+    assert (tmp_path / "Snakefile").read_text() == snakefile
+
+
+def test_snakefile_is_uploaded_once(tmp_path):
+    executor = make_executor(tmp_path, source_prefix="gs://b/sources/")
+    executor.storage = MagicMock()
+    blob = executor.storage.bucket.return_value.blob.return_value
+
+    url = executor.stage_snakefile("rule all:\n")
+    digest = cmdutil.snakefile_digest("rule all:\n")
+    assert url == f"gs://b/sources/snakefiles/{digest}/Snakefile"
+    assert executor.stage_snakefile("rule all:\n") == url
+    blob.upload_from_string.assert_called_once_with(
+        "rule all:\n", if_generation_match=0
+    )
+    executor.storage.bucket.assert_called_once_with("b")
+
+    # Another run already uploaded the same Snakefile
+    blob.upload_from_string.side_effect = PreconditionFailed("exists")
+    executor.stage_snakefile("rule other:\n")
+    assert make_executor(tmp_path).stage_snakefile("rule all:\n") is None
+
+
+def test_snakefile_is_written_for_containers(tmp_path):
+    executor = make_building_executor(tmp_path, source_prefix="gs://b/sources")
+    executor.storage = MagicMock()
+    cos = make_building_job(
+        tmp_path, "a", resources={"googlebatch_image_family": "batch-cos-stable"}
+    )
+    centos = make_building_job(tmp_path, "b")
+
+    # The COS host has no gsutil to download the Snakefile
+    writer = executor.get_command_writer(cos)
+    assert writer.snakefile_url is None
+    script = writer.write_snakefile()
+    assert "gsutil" not in script
+    assert "cat <<'SNAKEFILE_" in script
+    executor.storage.bucket.assert_not_called()
+
+    writer = executor.get_command_writer(centos)
+    assert writer.snakefile_url.startswith("gs://b/sources/snakefiles/")
+    assert "gsutil -q cp" in writer.write_snakefile()
+
+
+def test_step_runs_once_per_vm(tmp_path):
+    # Four tasks on a VM start the step at the same time
+    counter = tmp_path / "counter"
+    step = f"sleep 0.2\necho run >> {counter}\n"
+    script = cmdutil.once_per_vm(step)
+    tasks = [subprocess.Popen(["bash", "-c", script]) for _ in range(4)]
+    assert [task.wait() for task in tasks] == [0, 0, 0, 0]
+    assert counter.read_text() == "run\n"
+
+    # A failed step fails the task, and the next task tries again
+    failing = cmdutil.once_per_vm(f"echo try >> {tmp_path / 'tries'}\nexit 3\n")
+    assert run_script(failing).returncode == 3
+    assert run_script(failing).returncode == 3
+    assert (tmp_path / "tries").read_text() == "try\ntry\n"
+
+
+def test_inputs_are_prefetched(tmp_path):
+    # gsutil copies from a local directory standing in for the bucket
+    bucket = tmp_path / "bucket"
+    (bucket / "bams").mkdir(parents=True)
+    for name in ["a.bam", "b c.bam"]:
+        (bucket / "bams" / name).write_text(name)
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    gsutil = bin_dir / "gsutil"
+    gsutil.write_text(f'#!/bin/bash\ncp "{bucket}/${{@: -2:1}}" "${{@: -1}}"\n')
+    gsutil.chmod(0o755)
+
+    inputs = [
+        ("bams/a.bam", ".snakemake/storage/gcs/b/bams/a.bam"),
+        ("bams/b c.bam", ".snakemake/storage/gcs/b/bams/b c.bam"),
+    ]
+    script = f"cd {tmp_path}\n" + cmdutil.prefetch_script(inputs, 2)
+    result = run_script(script, PATH=f"{bin_dir}:{os.environ['PATH']}")
+    assert "Prefetched 2 inputs" in result.stdout
+    local = tmp_path / ".snakemake" / "storage" / "gcs" / "b" / "bams"
+    assert (local / "b c.bam").read_text() == "b c.bam"
+
+    # Inputs that fail are left to Snakemake
+    script = f"cd {tmp_path}\n" + cmdutil.prefetch_script([("missing", "x")], 2)
+    result = run_script(script, PATH=f"{bin_dir}:{os.environ['PATH']}")
+    assert result.returncode == 0
+    assert "Some inputs were not prefetched" in result.stdout
+
+
+def make_fake_gsutil(tmp_path, bucket):
+    """
+    A gsutil that hashes and copies files of a local directory standing in
+    for the bucket, and counts its uploads.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    gsutil = bin_dir / "gsutil"
+    gsutil.write_text(
+        "#!/bin/bash\n"
+        f"bucket={bucket}\n"
+        'args=("$@")\n'
+        'checksum() { md5sum < "$1" | cut -d" " -f1; }\n'
+        'case " $* " in\n'
+        '*" hash "*) echo "Hash (crc32c): $(checksum "${args[-1]}")" ;;\n'
+        '*" ls "*) test -f "${bucket}/${args[-1]}" &&'
+        ' echo "Hash (crc32c): $(checksum "${bucket}/${args[-1]}")" ;;\n'
+        '*) cp "${args[-2]}" "${bucket}/${args[-1]}";'
+        f" echo upload >> {tmp_path}/uploads ;;\n"
+        "esac\n"
+    )
+    gsutil.chmod(0o755)
+    return f"{bin_dir}:{os.environ['PATH']}"
+
+
+def test_outputs_are_verified(tmp_path):
+    bucket = tmp_path / "bucket"
+    bucket.mkdir()
+    (bucket / "same.txt").write_text("same")
+    (bucket / "stale.txt").write_text("old")
+    path = make_fake_gsutil(tmp_path, bucket)
+    for name in ["same.txt", "stale.txt", "new.txt"]:
+        (tmp_path / name).write_text("same" if name == "same.txt" else "new")
+
+    outputs = [(name, name) for name in ["same.txt", "stale.txt", "new.txt"]]
+    script = f"cd {tmp_path}\n" + cmdutil.verify_script(outputs, 2)
+    result = run_script(script, PATH=path)
+    assert result.returncode == 0
+    assert "Verified 3 outputs (10 bytes)" in result.stdout
+    assert (bucket / "stale.txt").read_text() == "new"
+    assert (bucket / "new.txt").read_text() == "new"
+    assert (tmp_path / "uploads").read_text() == "upload\nupload\n"
+
+
+def test_outputs_are_verified_before_snakemake_removes_them(tmp_path):
+    # Snakemake runs a job like on a VM, with a storage plugin for a local bucket
+    plugins = tmp_path / "plugins" / "snakemake_storage_plugin_fake"
+    plugins.mkdir(parents=True)
+    (plugins / "__init__.py").write_text(fake_storage_plugin)
+    bucket = tmp_path / "bucket"
+    workdir = tmp_path / "workdir"
+    workdir.mkdir()
+    (workdir / "Snakefile").write_text(
+        'rule a:\n    output: "a.txt"\n    shell: "echo $TEXT > {output}"\n'
+    )
+    command = (
+        f"cd {workdir} && {sys.executable} -m snakemake --snakefile Snakefile "
+        "--target-jobs 'a:' --allowed-rules a --cores 1 --force "
+        "--keep-storage-local-copies --nocolor --notemp --no-hooks --nolock "
+        "--default-storage-provider fake --default-storage-prefix fake://b "
+        "--shared-fs-usage none --mode remote"
+    )
+    writer = make_writer(cmdutil.CentosWriter)
+    writer.command = command
+    local = workdir / ".snakemake" / "storage" / "fake" / "b" / "a.txt"
+    writer.verify = cmdutil.verify_script([("b/a.txt", str(local))], 2)
+    script = writer.run()
+    env = {
+        "PATH": make_fake_gsutil(tmp_path, bucket),
+        "PYTHONPATH": str(plugins.parent),
+        "FAKE_STORAGE": str(bucket),
+    }
+
+    # The stored output is checked while its local copy exists, and repaired
+    result = run_script(script, TEXT="hello", FAKE_STORAGE_CORRUPT="1", **env)
+    assert result.returncode == 0, result.stderr
+    assert "Verified 1 outputs (6 bytes)" in result.stdout
+    assert (bucket / "b" / "a.txt").read_text() == "hello\n"
+    assert (tmp_path / "uploads").read_text() == "upload\n"
+
+    # Snakemake still removes the local copy afterwards
+    assert not local.exists()
+
+    # Nothing is checked when the job failed
+    (workdir / "Snakefile").write_text(
+        'rule a:\n    output: "a.txt"\n    shell: "false"\n'
+    )
+    result = run_script(script, **env)
+    assert result.returncode != 0
+    assert "Verified" not in result.stdout
+
+    # A run that never reaches the check fails, instead of passing unchecked
+    writer.command = command + " --dry-run"
+    result = run_script(writer.run(), **env)
+    assert result.returncode != 0
+    assert "Outputs were not verified" in result.stderr
+
+
+def test_verification_needs_a_known_snakemake_command():
+    with pytest.raises(WorkflowError):
+        cmdutil.verify_snakemake("snakemake --cores 1 a", "true")
+    with pytest.raises(WorkflowError):
+        cmdutil.check_verify_version("9.0.0")
+    cmdutil.check_verify_version("8.30.0")
@@ -0,0 +1,592 @@
+import asyncio
+import json
+import threading
+import time
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+from google.api_core.exceptions import NotFound, ServiceUnavailable
+from google.cloud.batch_v1.types import CreateJobRequest, Job, JobStatus
+from snakemake_interface_common.exceptions import WorkflowError
+
+from snakemake_executor_plugin_googlebatch import common_settings
+from tests.fake import (
+    FakeBatchService,
+    FakeJobInfo,
+    FakeWorkflowRun,
+    make_building_executor,
+    make_building_job,
+    make_executor,
+    make_job_request,
+)
+
+
+class FakeOperation:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def result(self, timeout=None):
+        if timeout is not None and timeout < self.seconds:
+            time.sleep(timeout)
+            raise TimeoutError()
+        time.sleep(self.seconds)
+        return MagicMock()
+
+
+def test_cancel_deletes_jobs_concurrently(tmp_path):
+    executor = make_executor(tmp_path, cancel_concurrency=20, cancel_timeout=5)
+    executor.shutdown = MagicMock()
+    lock = threading.Lock()
+    deleted = []
+
+    def delete_job(request=None, **kwargs):
+        with lock:
+            deleted.append(request.name)
+        if request.name == "job-gone":
+            raise NotFound("no such job")
+        return FakeOperation(0.05)
+
+    executor.batch.delete_job.side_effect = delete_job
+    jobs = [FakeJobInfo(f"job-{i}") for i in range(40)] + [FakeJobInfo("job-gone")]
+    start = time.monotonic()
+    executor.cancel_jobs(jobs)
+
+    # 41 deletions of 0.05s each, 20 at a time
+    assert time.monotonic() - start < 1
+    assert len(deleted) == 41
+    executor.shutdown.assert_called_once()
+
+    # Jobs that are already gone count as deleted
+    confirmed, pending = executor.delete_jobs(["job-0", "job-1", "job-gone"])
+    assert sorted(confirmed) == ["job-0", "job-1", "job-gone"]
+    assert pending == {}
+
+
+def test_cancel_reports_pending_deletions(tmp_path):
+    executor = make_executor(tmp_path, cancel_concurrency=10, cancel_timeout=0.2)
+    slow = {"job-slow"}
+    executor.batch.delete_job.side_effect = lambda request=None, **kwargs: (
+        FakeOperation(5 if request.name in slow else 0)
+    )
+
+    start = time.monotonic()
+    confirmed, pending = executor.delete_jobs(["job-fast", "job-slow"])
+    assert time.monotonic() - start < 1
+    assert confirmed == ["job-fast"]
+    assert list(pending) == ["job-slow"]
+
+
+def make_submitting_executor(tmp_path, latency=0.05, **settings):
+    """
+    An executor with stubbed job requests and a slow create_job.
+    """
+    executor = make_executor(tmp_path, **settings)
+    executor.build_job_request = lambda job: (
+        CreateJobRequest(job_id=job.name),
+        f"{job.name}.log",
+    )
+    executor.report_job_submission = MagicMock()
+    executor.report_job_error = MagicMock()
+
+    def create_job(request, **kwargs):
+        time.sleep(latency)
+        if request.job_id == "job-bad":
+            raise ServiceUnavailable("try again later")
+        return Job(name=f"projects/p/locations/r/jobs/{request.job_id}")
+
+    executor.batch.create_job.side_effect = create_job
+    return executor
+
+
+def make_jobs(names):
+    jobs = []
+    for name in names:
+        job = MagicMock()
+        job.name = name
+        jobs.append(job)
+    return jobs
+
+
+def test_run_jobs_submits_concurrently(tmp_path):
+    executor = make_submitting_executor(
+        tmp_path, submit_concurrency=20, submit_qps=1000
+    )
+    jobs = make_jobs([f"job-{i}" for i in range(40)] + ["job-bad"])
+    start = time.monotonic()
+    executor.run_jobs(jobs)
+
+    # 41 submissions of 0.05s each, 20 at a time
+    assert time.monotonic() - start < 1
+    submitted = [c.args[0] for c in executor.report_job_submission.call_args_list]
+    assert len(submitted) == 40
+    assert all(info.external_jobid.endswith(info.job.name) for info in submitted)
+    assert submitted[0].aux["logfile"] == f"{submitted[0].job.name}.log"
+
+    # The failed submission is reported as a job error
+    executor.report_job_error.assert_called_once()
+    assert executor.report_job_error.call_args.args[0].job.name == "job-bad"
+
+
+def test_run_jobs_limits_submission_rate(tmp_path):
+    executor = make_submitting_executor(
+        tmp_path, latency=0, submit_concurrency=20, submit_qps=50
+    )
+    start = time.monotonic()
+    executor.run_jobs(make_jobs([f"job-{i}" for i in range(11)]))
+
+    # The first submission is free, the next ten take 1/50s each
+    assert time.monotonic() - start >= 0.19
+    assert executor.report_job_submission.call_count == 11
+
+
+def test_run_jobs_packs_job_arrays(tmp_path):
+    executor = make_submitting_executor(tmp_path, latency=0, array_size=3)
+    executor.build_job_request = lambda job: make_job_request(
+        job, cpu_milli=2000 if job.name == "job-big" else 1000
+    )
+    executor.get_param = lambda job, param: {
+        "image_family": "batch-centos",
+        "work_tasks": 1,
+    }.get(param)
+    created = []
+
+    def create_job(request, **kwargs):
+        created.append(request)
+        return Job(name=f"projects/p/locations/r/jobs/{request.job_id}")
+
+    executor.batch.create_job.side_effect = create_job
+    executor.run_jobs(make_jobs([f"job-{i}" for i in range(5)] + ["job-big"]))
+
+    # Five alike jobs in arrays of three and two, and the big job on its own
+    steps = {r.job_id: len(r.job.task_groups[0].task_spec.runnables) for r in created}
+    assert steps == {"job-big": 4, "job-0": 3, "job-3": 3}
+    counts = {r.job_id: r.job.task_groups[0].task_count for r in created}
+    assert counts == {"job-big": 1, "job-0": 3, "job-3": 2}
+
+    array = next(r for r in created if r.job_id == "job-0")
+    script = array.job.task_groups[0].task_spec.runnables[-1].script.text
+    assert "case ${BATCH_TASK_INDEX} in" in script
+    assert "0)\nsnakemake job-0\n;;\n1)\nsnakemake job-1\n;;" in script
+
+    submitted = [c.args[0] for c in executor.report_job_submission.call_args_list]
+    tasks = {info.job.name: info for info in submitted if "task_index" in info.aux}
+    assert len(submitted) == 6
+    assert tasks["job-4"].external_jobid == (
+        "projects/p/locations/r/jobs/job-3/taskGroups/group0/tasks/1"
+    )
+    assert tasks["job-4"].aux["array"] == "projects/p/locations/r/jobs/job-3"
+    assert tasks["job-4"].aux["logfile"] == "job-4.log"
+
+
+def test_job_specs_are_cached(tmp_path, capsys):
+    executor = make_building_executor(tmp_path)
+    executor.get_allocation_policy = MagicMock(wraps=executor.get_allocation_policy)
+    jobs = [make_building_job(tmp_path, f"a-{i}") for i in range(3)]
+    jobs.append(
+        make_building_job(
+            tmp_path, "b-0", {"googlebatch_machine_type": "n2-standard-8"}
+        )
+    )
+    requests = [executor.build_job_request(job)[0] for job in jobs]
+
+    # One policy per machine type, and the setup is printed once
+    assert executor.get_allocation_policy.call_count == 2
+    assert capsys.readouterr().out.count("yum update") == 1
+
+    # Templates are copied into each job, so jobs only differ by command
+    first, second, other = requests[0].job, requests[1].job, requests[3].job
+    assert first.allocation_policy == second.allocation_policy
+    assert other.allocation_policy.instances[0].policy.machine_type == "n2-standard-8"
+    runnables = [r.job.task_groups[0].task_spec.runnables for r in requests]
+    assert runnables[0][:3] == runnables[1][:3] == runnables[3][:3]
+    assert runnables[0][-1].script.text.endswith("snakemake --cores 1 a-0")
+    assert runnables[1][-1].script.text.endswith("snakemake --cores 1 a-1")
+
+    second.allocation_policy.instances[0].policy.machine_type = "changed"
+    third = executor.build_job_request(jobs[2])[0].job
+    assert third.allocation_policy.instances[0].policy.machine_type == "c2-standard-4"
+
+
+def test_job_specs_with_snippets_are_not_shared(tmp_path):
+    executor = make_building_executor(tmp_path)
+    assert executor.get_setup_key(make_building_job(tmp_path, "a-0")) is not None
+    job = make_building_job(tmp_path, "a-1", {"googlebatch_snippets": "x.sh"})
+    assert executor.get_setup_key(job) is None
+    job = make_building_job(tmp_path, "a-2", {"googlebatch_image_family": "batch-cos"})
+    assert executor.get_setup_key(job) is None
+
+
+def test_bin_packing_shares_vms(tmp_path):
+    service = FakeBatchService()
+    run = FakeWorkflowRun(tmp_path, service, bin_pack=True)
+    jobs = run.make_jobs(10)
+    jobs.append(make_building_job(tmp_path, "big-0", {"googlebatch_cpu_milli": 4000}))
+    jobs.append(make_building_job(tmp_path, "gpu-0", {"nvidia_gpu": 1}))
+    run.submit(jobs)
+
+    # Four 1-CPU jobs per c2-standard-4, the others on their own
+    groups = {
+        job.labels["snakemake-job"]: job.task_groups[0] for job in service.jobs.values()
+    }
+    shapes = {
+        name: (group.task_count, group.task_count_per_node)
+        for name, group in groups.items()
+    }
+    assert shapes == {
+        "rule-0": (4, 4),
+        "rule-4": (4, 4),
+        "rule-8": (2, 2),
+        "big-0": (1, 1),
+        "gpu-0": (1, 1),
+    }
+
+    # Setup and Snakefile steps run once per VM
+    setup, snakefile, command = groups["rule-0"].task_spec.runnables
+    assert "flock" in setup.script.text and "flock" in snakefile.script.text
+    assert "flock" not in command.script.text
+    assert "flock" not in groups["big-0"].task_spec.runnables[0].script.text
+
+    run.finish()
+    assert len(run.succeeded) == 12
+
+
+def test_auto_machine_type_sizes_jobs(tmp_path):
+    executor = make_building_executor(tmp_path, auto_machine_type="on")
+    small = make_building_job(tmp_path, "small-0", {"mem_mb": 2000})
+    big = make_building_job(
+        tmp_path, "big-0", {"mem_mb": 60000, "disk_mb": 100000}, threads=8
+    )
+    fixed = make_building_job(
+        tmp_path, "fixed-0", {"googlebatch_machine_type": "c2-standard-8"}
+    )
+    jobs = {job.name: executor.build_job_request(job)[0].job for job in [small, big]}
+    jobs["fixed-0"] = executor.build_job_request(fixed)[0].job
+
+    def machine_type(job):
+        return job.allocation_policy.instances[0].policy.machine_type
+
+    assert machine_type(jobs["small-0"]) == "t2d-standard-1"
+    assert machine_type(jobs["big-0"]) == "e2-highmem-8"
+    assert machine_type(jobs["fixed-0"]) == "c2-standard-8"
+    resources = jobs["big-0"].task_groups[0].task_spec.compute_resource
+    assert (resources.cpu_milli, resources.memory_mib) == (8000, 60000)
+    boot_disk = jobs["big-0"].allocation_policy.instances[0].policy.boot_disk
+    assert boot_disk.size_gb == 128
+    assert boot_disk.image.endswith("/global/images/family/hpc-centos-7")
+
+    path = executor.write_machine_report()
+    with open(path) as fd:
+        report = {entry["job"]: entry for entry in json.load(fd)}
+    assert report["big-0"]["machine_type"] == "e2-highmem-8"
+    assert report["fixed-0"]["machine_type"] == "c2-standard-8"
+
+
+def test_user_catalog_is_used_for_bin_packing(tmp_path):
+    path = tmp_path / "catalog.json"
+    path.write_text(
+        json.dumps(
+            {
+                "families": {
+                    "c2": {
+                        "memory_per_vcpu": {"standard": 1},
+                        "vcpus": [4],
+                        "spot_price": {"vcpu": 0.01, "memory_gib": 0.001},
+                    }
+                }
+            }
+        )
+    )
+    executor = make_building_executor(
+        tmp_path, bin_pack=True, machine_catalog=str(path)
+    )
+    job = make_building_job(tmp_path, "a-0", {"googlebatch_memory": 1000})
+
+    # c2-standard-4 has 4 GiB of memory in this catalog, not 16 GiB
+    assert executor.tasks_per_vm(job) == 3
+
+
+def test_auto_machine_type_report_only(tmp_path):
+    executor = make_building_executor(tmp_path, auto_machine_type="report")
+    job = make_building_job(tmp_path, "small-0", {"mem_mb": 2000})
+    request = executor.build_job_request(job)[0]
+
+    # The choice is reported, but the job runs on the default machine type
+    policy = request.job.allocation_policy.instances[0].policy
+    assert policy.machine_type == "c2-standard-4"
+    assert executor.machine_report[0]["machine_type"] == "t2d-standard-1"
+    assert executor.machine_report[0]["used"] == "c2-standard-4"
+
+
+def test_volumes_are_added_to_jobs(tmp_path):
+    executor = make_building_executor(
+        tmp_path,
+        volumes="local-ssd:2:/mnt/ssd:raid0,pd-balanced:500:/mnt/data",
+    )
+    job = make_building_job(tmp_path, "a-0", {"googlebatch_bucket": "bucket"})
+    request = executor.build_job_request(job)[0]
+
+    policy = request.job.allocation_policy.instances[0].policy
+    assert [disk.device_name for disk in policy.disks] == [
+        "snakemake-disk-0-0",
+        "snakemake-disk-0-1",
+        "snakemake-disk-1",
+    ]
+
+    # The bucket is kept (after the disks), and the striped SSDs are
+    # mounted by the first step
+    task = request.job.task_groups[0].task_spec
+    assert [volume.mount_path for volume in task.volumes] == [
+        "/mnt/data",
+        "/mnt/share",
+    ]
+    assert "mdadm --create" in task.runnables[0].script.text
+    assert task.runnables[-1].environment.variables["TMPDIR"] == "/mnt/ssd"
+
+
+def test_buckets_are_mounted_with_profiles(tmp_path):
+    executor = make_building_executor(
+        tmp_path,
+        mount_profile="read-heavy",
+        volumes="pd-ssd:100:/mnt/cache,gcs:refs:/mnt/refs:streaming",
+    )
+    job = make_building_job(tmp_path, "a-0", {"googlebatch_bucket": "bucket"})
+    task = executor.build_job_request(job)[0].job.task_groups[0].task_spec
+    options = {volume.mount_path: volume.mount_options for volume in task.volumes}
+
+    assert "--cache-dir=/mnt/cache/gcsfuse-cache" in options["/mnt/share"]
+    assert "--file-cache-max-size-mb=51200" in options["/mnt/share"]
+    assert "--sequential-read-size-mb=200" in options["/mnt/refs"]
+    assert list(options["/mnt/cache"]) == []
+
+    # A rule can ask for another profile
+    job = make_building_job(
+        tmp_path,
+        "b-0",
+        {"googlebatch_bucket": "bucket", "googlebatch_mount_profile": "write-heavy"},
+    )
+    task = executor.build_job_request(job)[0].job.task_groups[0].task_spec
+    assert "--temp-dir=/mnt/cache/gcsfuse-temp" in task.volumes[1].mount_options
+
+    with pytest.raises(WorkflowError):
+        make_building_executor(tmp_path, mount_profile="fast")
+
+
+@pytest.mark.parametrize(
+    "settings", [{"submit_qps": 0}, {"log_requests_per_minute": -1}]
+)
+def test_rate_limits_must_be_positive(tmp_path, settings):
+    with pytest.raises(WorkflowError, match="must be greater than 0"):
+        make_executor(tmp_path, **settings)
+
+
+def make_reference_storage(marked):
+    """
+    A storage client with reference data, and whether its image is ready.
+    """
+    client = MagicMock()
+    blobs = [MagicMock(crc32c="abc==", size=2**30) for _ in range(2)]
+    blobs[0].name, blobs[1].name = "hg38/genome.fa", "hg38/genome.fa.fai"
+    client.list_blobs.return_value = blobs
+    client.bucket.return_value.blob.return_value.exists.return_value = marked
+    return client
+
+
+def test_reference_volumes_are_built_once(tmp_path):
+    executor = make_building_executor(
+        tmp_path, reference_volumes="gs://refs/hg38:/mnt/hg38"
+    )
+    executor.storage = make_reference_storage(marked=False)
+    executor.batch.create_job.return_value.name = "projects/p/jobs/reference"
+
+    requests = [
+        executor.build_job_request(make_building_job(tmp_path, f"a-{i}"))[0]
+        for i in range(3)
+    ]
+
+    # One job builds the image, without waiting for it
+    assert executor.batch.create_job.call_count == 1
+    executor.batch.get_job.assert_not_called()
+    builder = executor.batch.create_job.call_args[0][0]
+    script = builder.job.task_groups[0].task_spec.runnables[0].script.text
+    assert 'gsutil -m cp -r "gs://refs/hg38/*"' in script
+    executor.storage.list_blobs.assert_called_once_with("refs", prefix="hg38/")
+    assert executor.reference_builders() == ["projects/p/jobs/reference"]
+
+    # Every job gets a disk made from the image
+    for request in requests:
+        policy = request.job.allocation_policy.instances[0].policy
+        (disk,) = policy.disks
+        assert disk.new_disk.image.startswith("projects/p/global/images/snakemake-ref-")
+        assert disk.new_disk.size_gb == 13
+        task = request.job.task_groups[0].task_spec
+        (volume,) = task.volumes
+        assert (volume.mount_path, list(volume.mount_options)) == ("/mnt/hg38", ["ro"])
+
+
+def test_reference_volumes_reuse_images(tmp_path):
+    executor = make_building_executor(
+        tmp_path, reference_volumes="gs://refs/hg38:/mnt/hg38"
+    )
+    executor.storage = make_reference_storage(marked=True)
+    job = make_building_job(tmp_path, "a-0")
+    executor.build_job_request(job)
+    assert executor.batch.create_job.call_count == 0
+    assert executor.waiting_references(job) == []
+
+
+def make_reference_executor(tmp_path):
+    """
+    An executor building one reference image, for jobs that ask for it.
+    """
+    executor = make_building_executor(tmp_path, reference_poll_seconds=0)
+    executor.storage = make_reference_storage(marked=False)
+    executor.report_job_submission = MagicMock()
+    executor.created = []
+
+    def create_job(request, **kwargs):
+        executor.created.append(request.job_id)
+        return Job(name=f"{request.parent}/jobs/{request.job_id}", uid=request.job_id)
+
+    executor.batch.create_job.side_effect = create_job
+    executor.batch.get_job.return_value.status.state = JobStatus.State.RUNNING
+    references = {"googlebatch_reference_volumes": "gs://refs/hg38:/mnt/hg38"}
+    jobs = [
+        make_building_job(tmp_path, "a-0", resources=references),
+        make_building_job(tmp_path, "b-0"),
+    ]
+    executor.run_jobs(jobs)
+    return executor
+
+
+async def check(executor, active_jobs):
+    return [j async for j in executor.check_active_jobs(active_jobs)]
+
+
+def test_jobs_wait_only_for_their_reference_images(tmp_path):
+    executor = make_reference_executor(tmp_path)
+
+    # The builder and the job without references are created right away
+    assert len(executor.created) == 2
+    assert executor.created[0].startswith("snakemake-reference-")
+    submitted = [c.args[0] for c in executor.report_job_submission.call_args_list]
+    (held,) = [j for j in submitted if "held" in j.aux]
+    assert held.job.name == "a-0"
+
+    # The job is created once the image is built
+    assert asyncio.run(check(executor, [held])) == [held]
+    assert len(executor.created) == 2
+    executor.batch.get_job.return_value.status.state = JobStatus.State.SUCCEEDED
+    assert asyncio.run(check(executor, [held])) == [held]
+    assert len(executor.created) == 3
+    assert "held" not in held.aux
+    assert held.external_jobid.endswith(f"/jobs/{executor.created[2]}")
+    assert held.aux["batch_job"].uid == executor.created[2]
+    assert executor.reference_builders() == []
+
+
+def test_failed_reference_builds_stop_the_workflow(tmp_path):
+    executor = make_reference_executor(tmp_path)
+    submitted = [c.args[0] for c in executor.report_job_submission.call_args_list]
+    held = [j for j in submitted if "held" in j.aux]
+    executor.batch.get_job.return_value.status.state = JobStatus.State.FAILED
+    with pytest.raises(WorkflowError):
+        asyncio.run(check(executor, held))
+
+
+def test_cancel_deletes_reference_builders(tmp_path):
+    executor = make_reference_executor(tmp_path)
+    executor.shutdown = MagicMock()
+    executor.delete_jobs = MagicMock(return_value=([], {}))
+    submitted = [c.args[0] for c in executor.report_job_submission.call_args_list]
+    executor.cancel_jobs(submitted)
+
+    # The held job does not exist yet, but its builder does
+    (jobids,) = executor.delete_jobs.call_args.args
+    builder = f"projects/p/locations/us-central1/jobs/{executor.created[0]}"
+    assert builder in jobids
+    (held,) = [j for j in submitted if "held" in j.aux]
+    assert held.external_jobid not in jobids
+    assert len(jobids) == 2
+
+
+def test_shared_fs_mounts_the_workflow_directory(tmp_path):
+    executor = make_building_executor(tmp_path, shared_fs="10.0.0.2:/share")
+    assert not common_settings.implies_no_shared_fs
+    assert not executor.common_settings.implies_no_shared_fs
+    assert not executor.common_settings.job_deploy_sources
+    assert not executor.common_settings.auto_deploy_default_storage_provider
+    assert not executor.workflow.remote_execution_settings.job_deploy_sources
+    assert common_settings.job_deploy_sources
+
+    job = make_building_job(tmp_path, "a-0", {"googlebatch_bucket": "bucket"})
+    task = executor.build_job_request(job)[0].job.task_groups[0].task_spec
+    share = task.volumes[0]
+    assert (share.nfs.server, share.nfs.remote_path) == ("10.0.0.2", "/share")
+    assert share.mount_path == executor.workdir == str(tmp_path)
+    assert task.volumes[1].gcs.remote_path == "bucket"
+    assert executor.get_job_exec_prefix(job) == f"cd {tmp_path}"
+
+    with pytest.raises(WorkflowError):
+        make_building_executor(tmp_path, shared_fs="share")
+
+    # Nothing is left over for runs without a shared file system
+    executor = make_building_executor(tmp_path)
+    assert common_settings.implies_no_shared_fs
+    assert executor.common_settings.job_deploy_sources
+    assert executor.common_settings.auto_deploy_default_storage_provider
+
+
+def make_storage_input(query, local_path):
+    path = MagicMock(is_storage=True)
+    path.storage_object.query = query
+    path.storage_object.retrieve = True
+    path.storage_object.local_path.return_value = local_path
+    return path
+
+
+def test_inputs_are_prefetched(tmp_path):
+    executor = make_building_executor(tmp_path, prefetch_inputs=8)
+    storage_settings = executor.workflow.storage_settings
+    storage_settings.local_storage_prefix = Path(".snakemake/storage")
+    storage_settings.remote_job_local_storage_prefix = Path(".snakemake/storage")
+    job = make_building_job(tmp_path, "merge-0")
+    job.input = [
+        make_storage_input(
+            f"gs://b/bams/{i}.bam", Path(f".snakemake/storage/gcs/b/bams/{i}.bam")
+        )
+        for i in range(3)
+    ] + [MagicMock(is_storage=False)]
+
+    assert executor.get_storage_manifest(job.input) == [
+        (f"gs://b/bams/{i}.bam", f".snakemake/storage/gcs/b/bams/{i}.bam")
+        for i in range(3)
+    ]
+    task = executor.build_job_request(job)[0].job.task_groups[0].task_spec
+    script = task.runnables[-1].script.text
+    assert "-P 8" in script
+    assert "gs://b/bams/2.bam\n.snakemake/storage/gcs/b/bams/2.bam\n" in script
+    assert script.index("Prefetched 3 inputs") < script.index("snakemake --cores")
+
+
+def test_outputs_are_verified(tmp_path):
+    executor = make_building_executor(tmp_path, verify_outputs=4)
+    storage_settings = executor.workflow.storage_settings
+    storage_settings.local_storage_prefix = Path(".snakemake/storage")
+    storage_settings.remote_job_local_storage_prefix = Path("/tmp/storage")
+    job = make_building_job(tmp_path, "align-0")
+    job.input = []
+    job.output = [
+        make_storage_input(
+            "gs://b/align/a.bam", Path(".snakemake/storage/gcs/b/align/a.bam")
+        )
+    ]
+
+    task = executor.build_job_request(job)[0].job.task_groups[0].task_spec
+    script = task.runnables[-1].script.text
+    assert "gs://b/align/a.bam\n/tmp/storage/gcs/b/align/a.bam\n" in script
+
+    # Snakemake runs the check itself, before it removes the local copies
+    assert " -m snakemake " not in script
+    assert "cleanup_storage_objects" in script
+    assert script.index("cat <<'VERIFY_") < script.index("--cores 1 align-0")
@@ -0,0 +1,226 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+from google.api_core.exceptions import ResourceExhausted
+
+from snakemake_executor_plugin_googlebatch.api import ResilientApi
+from snakemake_executor_plugin_googlebatch.logs import (
+    LogCursor,
+    LogHarvester,
+    task_index,
+)
+from snakemake_executor_plugin_googlebatch.utils import TokenBucket
+from tests.fake import FakeLoggingClient
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=100, capacity=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+
+    # The first token is free, the next ten take 1/100s each
+    assert time.monotonic() - start >= 0.09
+
+
+def test_token_bucket_pause():
+    bucket = TokenBucket(rate=1000, capacity=5)
+    bucket.pause(0.1)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_harvester_saves_logs_in_background(tmp_path):
+    client = FakeLoggingClient()
+    client.add_logs("uid-a", [f"a{i}" for i in range(5)])
+    client.add_logs("uid-b", ["b0"])
+
+    # Downloads wait until released, but submitting does not
+    release = threading.Event()
+    limiter_acquire = TokenBucket.acquire
+
+    def acquire(bucket):
+        release.wait()
+        limiter_acquire(bucket)
+
+    harvester = LogHarvester(
+        "p", MagicMock(), requests_per_minute=60000, page_size=2, client=client
+    )
+    harvester.limiter.acquire = lambda: acquire(harvester.limiter)
+    harvester.submit("uid-a", str(tmp_path / "a.log"))
+    harvester.submit("uid-b", str(tmp_path / "b.log"))
+    harvester.dispatch()
+    assert client.list_calls == 0
+
+    release.set()
+    harvester.shutdown()
+    assert (tmp_path / "a.log").read_text() == "a0\na1\na2\na3\na4\n"
+    assert (tmp_path / "b.log").read_text() == "b0\n"
+
+    # Both jobs are fetched with one query of three pages
+    assert client.list_calls == 3
+
+
+def test_harvester_retries_after_quota_error(tmp_path):
+    client = FakeLoggingClient()
+    client.add_logs("uid-a", ["a0"])
+    logger = client.logger("batch_task_logs")
+    list_entries = logger.list_entries
+    calls = []
+
+    def flaky_list_entries(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise ResourceExhausted("quota")
+        return list_entries(**kwargs)
+
+    logger.list_entries = flaky_list_entries
+    client.logger = lambda name: logger
+
+    harvester = LogHarvester(
+        "p",
+        MagicMock(),
+        requests_per_minute=60000,
+        client=client,
+        api=ResilientApi(initial=0.01, maximum=0.02),
+    )
+    harvester.save([("uid-a", str(tmp_path / "a.log"), None)], sleeps=0.01)
+    assert len(calls) == 2
+    assert (tmp_path / "a.log").read_text() == "a0\n"
+
+
+def test_harvester_tails_only_new_entries(tmp_path):
+    client = FakeLoggingClient()
+    harvester = LogHarvester(
+        "p", MagicMock(), requests_per_minute=60000, tail_seconds=0, client=client
+    )
+    logfile = tmp_path / "a.log"
+    logfile.write_text("from an earlier run\n")
+
+    client.add_logs("uid-a", ["a0", "a1", "a2"])
+    assert harvester.tail("uid-a", str(logfile))
+    harvester.dispatch()[0].result()
+    assert logfile.read_text() == "a0\na1\na2\n"
+
+    # a3 shares its timestamp with a2, which must not be saved twice
+    client.add_logs("uid-a", ["a3", "a4"])
+    assert harvester.tail("uid-a", str(logfile))
+    harvester.dispatch()[0].result()
+    assert logfile.read_text() == "a0\na1\na2\na3\na4\n"
+
+    client.add_logs("uid-a", ["a5"])
+    harvester.submit("uid-a", str(logfile))
+    harvester.dispatch()[0].result()
+    assert logfile.read_text() == "a0\na1\na2\na3\na4\na5\n"
+
+    # Finished jobs are not tailed again
+    assert not harvester.tail("uid-a", str(logfile))
+    assert "uid-a" not in harvester.cursors
+
+
+def test_harvester_tails_at_most_every_interval(tmp_path):
+    harvester = LogHarvester(
+        "p", MagicMock(), tail_seconds=3600, client=FakeLoggingClient()
+    )
+    assert harvester.tail("uid-a", str(tmp_path / "a.log"))
+    assert not harvester.tail("uid-a", str(tmp_path / "a.log"))
+    harvester.shutdown()
+
+
+def test_harvester_batches_tails_behind_finished_jobs(tmp_path):
+    client = FakeLoggingClient()
+    for i in range(5):
+        client.add_logs(f"uid-{i}", [f"{i}-first"])
+
+    harvester = LogHarvester(
+        "p",
+        MagicMock(),
+        requests_per_minute=60000,
+        tail_seconds=0,
+        batch_size=2,
+        client=client,
+    )
+    for i in range(4):
+        assert harvester.tail(f"uid-{i}", str(tmp_path / f"{i}.log"))
+    harvester.submit("uid-4", str(tmp_path / "4.log"))
+
+    # Logs of finished jobs go first, tails wait for the next round
+    futures = harvester.dispatch()
+    assert len(futures) == 1
+    futures[0].result()
+    assert client.list_calls == 1
+    assert (tmp_path / "4.log").read_text() == "4-first\n"
+
+    # Then one query per round for up to batch_size running jobs
+    for expected in ([0, 1], [2, 3]):
+        futures = harvester.dispatch()
+        assert len(futures) == 1
+        futures[0].result()
+        for i in expected:
+            assert (tmp_path / f"{i}.log").read_text() == f"{i}-first\n"
+    assert client.list_calls == 3
+    assert harvester.dispatch() == []
+    harvester.shutdown()
+
+
+def test_harvester_batches_finished_jobs(tmp_path):
+    client = FakeLoggingClient()
+    for i in range(5):
+        client.add_logs(f"uid-{i}", [f"{i}-first", f"{i}-second"])
+    client.add_logs("uid-other", ["not queued"])
+
+    harvester = LogHarvester(
+        "p", MagicMock(), requests_per_minute=60000, batch_size=2, client=client
+    )
+    for i in range(5):
+        harvester.submit(f"uid-{i}", str(tmp_path / f"{i}.log"))
+    futures = harvester.dispatch()
+    harvester.shutdown()
+
+    # Five jobs in batches of two, each with a single page
+    assert len(futures) == 3
+    assert client.list_calls == 3
+    for i in range(5):
+        assert (tmp_path / f"{i}.log").read_text() == f"{i}-first\n{i}-second\n"
+
+
+def test_harvester_query_bounds_timestamp(tmp_path):
+    client = FakeLoggingClient()
+    client.add_logs("uid-a", ["a0", "a1", "a2", "a3"])
+    harvester = LogHarvester("p", MagicMock(), requests_per_minute=60000, client=client)
+
+    # Entries before the job was created are not fetched
+    since = client.entries[2].timestamp
+    harvester.submit("uid-a", str(tmp_path / "a.log"), since=since)
+    harvester.submit("uid-b", str(tmp_path / "b.log"), since=since)
+    harvester.shutdown()
+    assert (tmp_path / "a.log").read_text() == "a2\na3\n"
+    assert (tmp_path / "b.log").read_text() == ""
+
+    query = harvester.query(
+        {"uid-a": ("a.log", LogCursor(), since), "uid-b": ("b.log", LogCursor(), None)}
+    )
+    assert query == 'labels.job_uid=("uid-a" OR "uid-b")'
+    query = harvester.query({"uid-a": ("a.log", LogCursor(), since)})
+    assert query == f'labels.job_uid=("uid-a") AND timestamp>="{since.isoformat()}"'
+
+
+def test_harvester_routes_array_tasks(tmp_path):
+    client = FakeLoggingClient()
+    client.add_logs("uid-a", ["a0-first", "a0-second"], task_index=0)
+    client.add_logs("uid-a", ["a1-first"], task_index=1)
+    client.add_logs("uid-a", ["a2-first"], task_index=2)
+
+    harvester = LogHarvester("p", MagicMock(), requests_per_minute=60000, client=client)
+    harvester.submit("uid-a/0", str(tmp_path / "0.log"))
+    harvester.submit("uid-a/1", str(tmp_path / "1.log"))
+    harvester.shutdown()
+
+    # Both tasks share a single query on the job uid
+    assert client.list_calls == 1
+    assert (tmp_path / "0.log").read_text() == "a0-first\na0-second\n"
+    assert (tmp_path / "1.log").read_text() == "a1-first\n"
+    assert task_index({"task_id": "task/uid-a-group0-12/0/0"}) == 12
+    assert task_index({}) is None
@@ -0,0 +1,115 @@
+import json
+
+import pytest
+from snakemake_interface_common.exceptions import WorkflowError
+
+from snakemake_executor_plugin_googlebatch.machines import (
+    MachineCatalog,
+    machine_shape,
+    tasks_per_vm,
+)
+
+
+def test_machine_shapes():
+    assert machine_shape("c2-standard-4") == (4, 16384)
+    assert machine_shape("n1-standard-8") == (8, 30720)
+    assert machine_shape("n2-highcpu-16") == (16, 16384)
+    assert machine_shape("c2d-highcpu-8") == (8, 16384)
+    assert machine_shape("n2-custom-6-20480") == (6, 20480)
+    assert machine_shape("custom-2-4096-ext") == (2, 4096)
+
+    # Shared-core and accelerator optimized types are not known
+    assert machine_shape("e2-medium") is None
+    assert machine_shape("a2-highgpu-1g") is None
+    assert machine_shape(None) is None
+
+
+def test_tasks_per_vm():
+    # Four 1-CPU tasks fill a c2-standard-4, memory allows 15
+    assert tasks_per_vm("c2-standard-4", 1000, 1000) == 4
+    assert tasks_per_vm("c2-standard-4", 500, 1000) == 8
+    assert tasks_per_vm("n2-highcpu-16", 1000, 4096) == 3
+    assert tasks_per_vm("c2-standard-4", 8000, 1000) == 1
+    assert tasks_per_vm("e2-medium", 100, 100) == 1
+
+
+def test_catalog_picks_cheapest_fitting_type():
+    catalog = MachineCatalog.load()
+    assert catalog.choose(1, 1000).name == "t2d-standard-1"
+    assert catalog.choose(8, 4000).name == "e2-highcpu-8"
+    assert catalog.choose(1, 30000).name == "e2-highmem-4"
+
+    # GPUs only attach to N1 machine types
+    assert catalog.choose(4, 8000, gpus=1).name.startswith("n1-")
+    assert catalog.choose(1000, 1000) is None
+
+
+# Predefined machine types by series and type, from
+# https://cloud.google.com/compute/docs/general-purpose-machines and
+# https://cloud.google.com/compute/docs/compute-optimized-machines
+real_vcpus = {
+    "e2": {
+        "standard": [2, 4, 8, 16, 32],
+        "highmem": [2, 4, 8, 16],
+        "highcpu": [2, 4, 8, 16, 32],
+    },
+    "n1": {
+        "standard": [1, 2, 4, 8, 16, 32, 64, 96],
+        "highmem": [2, 4, 8, 16, 32, 64, 96],
+        "highcpu": [2, 4, 8, 16, 32, 64, 96],
+    },
+    "n2": {
+        "standard": [2, 4, 8, 16, 32, 48, 64, 80, 96, 128],
+        "highmem": [2, 4, 8, 16, 32, 48, 64, 80, 96, 128],
+        "highcpu": [2, 4, 8, 16, 32, 48, 64, 80, 96],
+    },
+    "n2d": {
+        "standard": [2, 4, 8, 16, 32, 48, 64, 80, 96, 128, 224],
+        "highmem": [2, 4, 8, 16, 32, 48, 64, 80, 96],
+        "highcpu": [2, 4, 8, 16, 32, 48, 64, 80, 96, 128, 224],
+    },
+    "c2": {"standard": [4, 8, 16, 30, 60]},
+    "c2d": {
+        "standard": [2, 4, 8, 16, 32, 56, 112],
+        "highmem": [2, 4, 8, 16, 32, 56, 112],
+        "highcpu": [2, 4, 8, 16, 32, 56, 112],
+    },
+    "c3": {
+        "standard": [4, 8, 22, 44, 88, 176],
+        "highmem": [4, 8, 22, 44, 88, 176],
+        "highcpu": [4, 8, 22, 44, 88, 176],
+    },
+    "t2d": {"standard": [1, 2, 4, 8, 16, 32, 48, 60]},
+}
+
+
+def test_catalog_lists_only_real_machine_types():
+    catalog = MachineCatalog.load()
+    for machine in catalog.machines:
+        series, kind, vcpus = machine.name.split("-")
+        assert int(vcpus) in real_vcpus[series][kind], machine.name
+        assert machine_shape(machine.name, catalog) == (
+            machine.vcpus,
+            machine.memory_mib,
+        )
+
+    # E2 high-memory types stop at 16 vCPUs
+    assert "e2-highmem-32" not in [m.name for m in catalog.machines]
+    assert catalog.choose(20, 240000).name != "e2-highmem-32"
+
+
+def test_user_catalog_replaces_families(tmp_path):
+    path = tmp_path / "catalog.json"
+    cheap = {
+        "memory_per_vcpu": {"standard": 4},
+        "vcpus": [1, 2, 4],
+        "spot_price": {"vcpu": 0.001, "memory_gib": 0.0001},
+    }
+    path.write_text(json.dumps({"families": {"n2": cheap}}))
+    catalog = MachineCatalog.load(str(path))
+    assert catalog.choose(2, 4000).name == "n2-standard-2"
+    assert machine_shape("n2-highmem-4", catalog) == (4, 32768)
+
+    path.write_text("{}")
+    with pytest.raises(WorkflowError):
+        MachineCatalog.load(str(path))
@@ -0,0 +1,104 @@
+import json
+from unittest.mock import MagicMock
+
+import pytest
+from google.api_core.exceptions import DeadlineExceeded, PermissionDenied
+
+from snakemake_executor_plugin_googlebatch.api import ResilientApi
+from snakemake_executor_plugin_googlebatch.metrics import Histogram, Metrics
+from tests.fake import FakeBatchService, FakeWorkflowRun
+
+
+def test_histogram_quantiles():
+    histogram = Histogram()
+    for value in [0.001] * 90 + [0.2] * 9 + [400]:
+        histogram.observe(value)
+
+    assert histogram.count == 100
+    assert histogram.quantile(0.5) == 0.005
+    assert histogram.quantile(0.95) == 0.25
+    assert histogram.quantile(1) == 400
+    assert histogram.to_dict()["buckets"]["+Inf"] == 1
+
+
+def test_metrics_in_prometheus_format():
+    metrics = Metrics()
+    metrics.observe("api_call_seconds", 0.02, method="get_job")
+    metrics.increment("api_errors_total", method="get_job", error="NotFound")
+    metrics.set_gauge("active_jobs", 10)
+    metrics.set_gauge("active_jobs", 4)
+
+    lines = metrics.to_prometheus().splitlines()
+    assert 'api_call_seconds_bucket{method="get_job",le="0.01"} 0' in lines
+    assert 'api_call_seconds_bucket{method="get_job",le="0.025"} 1' in lines
+    assert 'api_call_seconds_count{method="get_job"} 1' in lines
+    assert 'api_errors_total{error="NotFound",method="get_job"} 1' in lines
+    assert "active_jobs 4" in lines
+    assert "active_jobs_max 10" in lines
+
+
+def test_api_records_calls_retries_and_errors():
+    api = ResilientApi(initial=0.01, maximum=0.02, deadline=5)
+    attempts = []
+
+    def get_job():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise DeadlineExceeded("slow")
+        return "job"
+
+    api.run(get_job)
+    with pytest.raises(PermissionDenied):
+        api.call(MagicMock(side_effect=PermissionDenied("no"), __name__="create_job"))
+
+    metrics = api.metrics
+    assert metrics.get_histogram("api_call_seconds", method="get_job").count == 1
+    assert metrics.get_histogram("api_call_seconds", method="create_job").count == 1
+    retries = metrics.get_counter(
+        "api_retries_total", method="get_job", error="DeadlineExceeded"
+    )
+    assert retries == 2
+    errors = metrics.get_counter(
+        "api_errors_total", method="create_job", error="PermissionDenied"
+    )
+    assert errors == 1
+
+
+def test_executor_writes_metrics(tmp_path):
+    service = FakeBatchService(quota_error_rate=0.05)
+    run = FakeWorkflowRun(tmp_path, service)
+    run.submit(run.make_jobs(100))
+    run.finish()
+
+    path = run.executor.write_metrics()
+    assert path.startswith(str(tmp_path / ".snakemake" / "googlebatch_logs"))
+    with open(path) as fd:
+        metrics = json.load(fd)
+
+    calls = {
+        h["labels"]["method"]: h["count"]
+        for h in metrics["histograms"]
+        if h["name"] == "api_call_seconds"
+    }
+    assert calls["create_job"] == 100
+    assert calls["get_job"] == 100 * run.cycles
+    assert calls["list_entries"] >= 2
+    cycles = [h for h in metrics["histograms"] if h["name"] == "poll_cycle_seconds"]
+    assert cycles[0]["count"] == run.cycles
+
+    retries = sum(
+        c["value"]
+        for c in metrics["counters"]
+        if c["name"] == "api_retries_total"
+        and c["labels"]["error"] == "ResourceExhausted"
+    )
+    assert retries == service.quota_errors
+
+    gauges = {g["name"]: g for g in metrics["gauges"]}
+    assert gauges["submission_queue_depth"] == {
+        "name": "submission_queue_depth",
+        "labels": {},
+        "value": 0,
+        "max": 100,
+    }
+    assert gauges["active_jobs"]["max"] == 100
@@ -3,6 +3,7 @@ from unittest.mock import AsyncMock, MagicMock, patch
 from google.cloud.batch_v1.types import Job, JobStatus
 
 from tests import TestWorkflowsBase
+from tests.fake import FakeLoggingClient
 
 
 class TestWorkflowsMockedApi(TestWorkflowsBase):
@@ -16,8 +17,8 @@ class TestWorkflowsMockedApi(TestWorkflowsBase):
         ),
     )
     @patch(
-        "google.cloud.batch_v1.BatchServiceClient.get_job",
-        new=MagicMock(
+        "google.cloud.batch_v1.BatchServiceAsyncClient.get_job",
+        new=AsyncMock(
             return_value=Job(status=JobStatus(state=JobStatus.State.SUCCEEDED)),
             autospec=True,
         ),
@@ -25,7 +26,7 @@ class TestWorkflowsMockedApi(TestWorkflowsBase):
     @patch(
         "google.cloud.logging.Client.logger",
         new=MagicMock(
-            return_value=MagicMock(list_entries=lambda filter_, page_size: []),
+            return_value=FakeLoggingClient().logger("batch_task_logs"),
             autospec=True,
         ),
     )
@@ -0,0 +1,180 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pytest
+from google.cloud.batch_v1.types import Job, JobNotification, TaskStatus
+from snakemake_interface_common.exceptions import WorkflowError
+
+from snakemake_executor_plugin_googlebatch.notify import NotificationListener
+from tests.fake import FakeBatchAsyncClient, FakeJobInfo, FakeSubscriber, make_executor
+
+SUBSCRIPTION = "projects/p/subscriptions/jobs"
+
+
+def make_notified_executor(tmp_path, **settings):
+    subscriber = FakeSubscriber()
+    pubsub = MagicMock()
+    pubsub.SubscriberClient.return_value = subscriber
+    with patch("snakemake_executor_plugin_googlebatch.notify.pubsub_v1", pubsub):
+        executor = make_executor(
+            tmp_path,
+            notification_topic="jobs",
+            notification_subscription="jobs",
+            **settings,
+        )
+    return executor, subscriber
+
+
+def test_listener_records_job_state_changes():
+    subscriber = FakeSubscriber()
+    listener = NotificationListener(SUBSCRIPTION, MagicMock(), subscriber=subscriber)
+    listener.start()
+
+    message = subscriber.publish(
+        SUBSCRIPTION, Type="JOB_STATE_CHANGED", JobName="job-a", NewJobState="RUNNING"
+    )
+    subscriber.publish(
+        SUBSCRIPTION, Type="TASK_STATE_CHANGED", JobName="job-b", NewTaskState="FAILED"
+    )
+    assert message.acked
+    assert listener.get("job-a") == "RUNNING"
+    assert listener.has_changed("job-a")
+    assert not listener.has_changed("job-b")
+
+    subscriber.publish(
+        SUBSCRIPTION,
+        Type="TASK_STATE_CHANGED",
+        JobName="job-b",
+        TaskUID="job-b-uid-group0-3",
+        NewTaskState="FAILED",
+    )
+    assert listener.get("job-b/taskGroups/group0/tasks/3") == "FAILED"
+    assert listener.take_changed() == {"job-a", "job-b/taskGroups/group0/tasks/3"}
+
+    assert not listener.has_changed("job-a")
+    assert listener.get("job-a") == "RUNNING"
+
+    listener.stop()
+    assert subscriber.futures[0].cancelled
+
+
+def test_notifications_need_topic_and_subscription(tmp_path):
+    with pytest.raises(WorkflowError):
+        make_executor(tmp_path, notification_subscription="jobs")
+
+
+def test_check_requests_only_notified_jobs(tmp_path):
+    executor, subscriber = make_notified_executor(tmp_path)
+    client = FakeBatchAsyncClient(latency=0)
+    executor.async_batch = client
+
+    async def check(active_jobs):
+        return [j async for j in executor.check_active_jobs(active_jobs)]
+
+    active = [FakeJobInfo(f"job-{i}") for i in range(3)]
+    for j in active:
+        j.aux["batch_job"] = Job(uid=j.external_jobid)
+
+    # All jobs are checked once, then only on notifications
+    assert len(asyncio.run(check(active))) == 3
+    assert client.calls == 3
+    assert len(asyncio.run(check(active))) == 3
+    assert client.calls == 3
+
+    subscriber.publish(
+        SUBSCRIPTION, Type="JOB_STATE_CHANGED", JobName="job-1", NewJobState="RUNNING"
+    )
+    assert len(asyncio.run(check(active))) == 3
+    assert client.calls == 4
+
+
+def test_task_notifications_check_tasks_of_running_arrays(tmp_path):
+    executor, subscriber = make_notified_executor(tmp_path)
+    executor.report_job_success = MagicMock()
+    executor.log_harvester = MagicMock()
+    client = FakeBatchAsyncClient(latency=0)
+    executor.async_batch = client
+
+    array = "projects/p/locations/r/jobs/array"
+    group = f"{array}/taskGroups/group0"
+    tasks = [client.add_task(group, index) for index in range(2)]
+    active = []
+    for index in range(2):
+        j = FakeJobInfo(f"{group}/tasks/{index}")
+        j.aux.update(
+            batch_job=Job(uid="uid"), array=array, task_group=group, task_index=index
+        )
+        active.append(j)
+
+    async def check(active_jobs):
+        return [j async for j in executor.check_active_jobs(active_jobs)]
+
+    assert len(asyncio.run(check(active))) == 2
+    assert client.list_calls == 1
+
+    # The first task finishes while the job array is still running
+    tasks[0].status.state = TaskStatus.State.SUCCEEDED
+    subscriber.publish(
+        SUBSCRIPTION,
+        Type="TASK_STATE_CHANGED",
+        JobName=array,
+        TaskUID="array-uid-group0-0",
+        NewTaskState="SUCCEEDED",
+    )
+    still_active = asyncio.run(check(active))
+    assert client.list_calls == 2
+    assert [j.aux["task_index"] for j in still_active] == [1]
+    assert executor.report_job_success.call_args.args[0].aux["task_index"] == 0
+    assert not executor.notifications.has_changed(f"{group}/tasks/0")
+
+
+def test_notifications_during_a_check_are_kept(tmp_path):
+    executor, subscriber = make_notified_executor(tmp_path)
+    client = FakeBatchAsyncClient(latency=0)
+    executor.async_batch = client
+    get_job = client.get_job
+
+    # The job changes state again while its status is requested
+    async def get_job_and_notify(request=None, **kwargs):
+        response = await get_job(request=request, **kwargs)
+        subscriber.publish(
+            SUBSCRIPTION,
+            Type="JOB_STATE_CHANGED",
+            JobName="job-0",
+            NewJobState="SUCCEEDED",
+        )
+        return response
+
+    client.get_job = get_job_and_notify
+
+    async def check(active_jobs):
+        return [j async for j in executor.check_active_jobs(active_jobs)]
+
+    active = [FakeJobInfo("job-0")]
+    active[0].aux["batch_job"] = Job(uid="job-0")
+    asyncio.run(check(active))
+    assert client.calls == 1
+    assert executor.notifications.has_changed("job-0")
+
+    # So the next round checks it again
+    client.get_job = get_job
+    asyncio.run(check(active))
+    assert client.calls == 2
+    assert not executor.notifications.has_changed("job-0")
+
+
+def test_jobs_are_created_with_notifications(tmp_path):
+    executor, _ = make_notified_executor(tmp_path)
+    notifications = []
+    for type_ in [
+        JobNotification.Type.JOB_STATE_CHANGED,
+        JobNotification.Type.TASK_STATE_CHANGED,
+    ]:
+        notification = JobNotification()
+        notification.pubsub_topic = "projects/p/topics/jobs"
+        notification.message.type_ = type_
+        notifications.append(notification)
+
+    job = Job()
+    executor.add_notifications(job, FakeJobInfo("job").job)
+    assert list(job.notifications) == notifications
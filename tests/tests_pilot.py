@@ -0,0 +1,196 @@
+import asyncio
+import os
+import subprocess
+import threading
+import time
+from unittest.mock import MagicMock
+
+from google.api_core.exceptions import ServiceUnavailable
+from google.cloud.batch_v1.types import Job, JobStatus
+
+from snakemake_executor_plugin_googlebatch.pilot import LocalQueue, worker_script
+from tests.fake import FakeBatchAsyncClient, make_executor, make_job_request
+from tests.tests_executor import make_jobs
+
+
+def run_worker(script, **env):
+    return subprocess.run(
+        ["bash", "-c", script],
+        capture_output=True,
+        text=True,
+        timeout=30,
+        env={**os.environ, **env},
+    )
+
+
+def test_worker_runs_queued_commands(tmp_path):
+    queue = LocalQueue(str(tmp_path))
+    queue.put("job-a", "echo hello from a")
+    queue.put("job-b", "echo failing; exit 3")
+
+    # The worker runs both, then stops after being idle for a second
+    result = run_worker(worker_script(queue, "worker-1", idle_ttl=1, poll_seconds=1))
+    assert result.returncode == 0
+    assert "was idle for 1s, stopping" in result.stdout
+    assert queue.results() == {"job-a": 0, "job-b": 3}
+    assert queue.claimed_by("job-a") == "worker-1.0"
+    assert queue.read_log("job-a") == "hello from a\n"
+
+    queue.remove("job-a")
+    assert queue.results() == {"job-b": 3}
+    assert queue.claimed_by("job-a") is None
+
+
+def test_worker_stops_on_request(tmp_path):
+    queue = LocalQueue(str(tmp_path))
+    queue.stop()
+    result = run_worker(worker_script(queue, "worker-1", idle_ttl=60))
+    assert "Worker worker-1.0 was stopped" in result.stdout
+
+
+def test_retried_worker_fails_its_stale_claims(tmp_path):
+    queue = LocalQueue(str(tmp_path))
+    queue.put("job-a", "echo hello from a")
+    queue.put("job-b", "echo hello from b")
+
+    # The first attempt claimed job-a and was preempted while running it
+    with open(queue.path("claims", "job-a"), "w") as fd:
+        fd.write("worker-1.0\n")
+
+    script = worker_script(queue, "worker-1", idle_ttl=0, poll_seconds=1)
+    result = run_worker(script, BATCH_TASK_RETRY_ATTEMPT="1")
+    assert result.returncode == 0
+    assert queue.results() == {"job-a": 1, "job-b": 0}
+    assert "was retried while running Snakemake job job-a" in queue.read_log("job-a")
+    assert queue.claimed_by("job-b") == "worker-1.1"
+
+
+def make_pilot_executor(tmp_path, **settings):
+    settings.setdefault("pilot_workers", 2)
+    executor = make_executor(tmp_path, pilot_queue=str(tmp_path / "queue"), **settings)
+    executor.build_job_request = lambda job: make_job_request(
+        job,
+        command=f"echo running {job.name}" + ("; exit 2" if "bad" in job.name else ""),
+    )
+    executor.get_param = lambda job, param: {
+        "image_family": "batch-centos",
+        "work_tasks": 1,
+    }.get(param)
+    executor.report_job_submission = MagicMock()
+    executor.report_job_success = MagicMock()
+    executor.report_job_error = MagicMock()
+    executor.created = []
+
+    def create_job(request, **kwargs):
+        executor.created.append(request)
+        return Job(name=f"projects/p/locations/r/jobs/{request.job_id}")
+
+    executor.batch.create_job.side_effect = create_job
+    executor.async_batch = FakeBatchAsyncClient(latency=0)
+    return executor
+
+
+async def check(executor, active_jobs):
+    return [j async for j in executor.check_active_jobs(active_jobs)]
+
+
+def test_executor_runs_jobs_on_warm_workers(tmp_path):
+    executor = make_pilot_executor(tmp_path)
+    executor.run_jobs(make_jobs(["job-0", "job-1", "job-bad"]))
+
+    # Three jobs of the same kind share two workers
+    assert len(executor.created) == 2
+    assert all(r.job_id.startswith("snakemake-pilot-") for r in executor.created)
+    runnables = executor.created[0].job.task_groups[0].task_spec.runnables
+    assert [r.script.text for r in runnables[:2]] == ["setup", "snakefile"]
+    assert "queue_claim" in runnables[-1].script.text
+    active = [c.args[0] for c in executor.report_job_submission.call_args_list]
+    assert len(active) == 3
+    for j in active:
+        j.aux["logfile"] = str(tmp_path / f"{j.job.name}.log")
+
+    # Nothing ran yet
+    assert len(asyncio.run(check(executor, active))) == 3
+
+    pilot = next(iter(executor.pilots.values()))
+    script = runnables[-1].script.text.replace("idle_ttl=300", "idle_ttl=0")
+    assert run_worker(script).returncode == 0
+
+    assert asyncio.run(check(executor, active)) == []
+    executor.log_harvester.pool.shutdown(wait=True)
+    assert executor.report_job_success.call_count == 2
+    assert executor.report_job_error.call_args.args[0].job.name == "job-bad"
+    assert (tmp_path / "job-0.log").read_text() == "running job-0\n"
+    assert pilot.queue.results() == {}
+
+    # No workers are added while none are needed
+    assert len(executor.created) == 2
+
+
+def test_executor_fails_jobs_of_stopped_workers(tmp_path):
+    executor = make_pilot_executor(tmp_path, pilot_workers=1)
+    executor.run_jobs(make_jobs(["job-0", "job-1"]))
+    active = [c.args[0] for c in executor.report_job_submission.call_args_list]
+    for j in active:
+        j.aux["logfile"] = str(tmp_path / f"{j.job.name}.log")
+    pilot = next(iter(executor.pilots.values()))
+    worker_name, worker = next(iter(pilot.workers.items()))
+
+    # The worker claimed the first job and was preempted
+    with open(pilot.queue.path("claims", active[0].aux["task"]), "w") as fd:
+        fd.write(f"{worker}.0")
+    executor.async_batch.add_job(worker_name, JobStatus.State.FAILED)
+
+    still_active = asyncio.run(check(executor, active))
+    assert [j.job.name for j in still_active] == ["job-1"]
+    assert executor.report_job_error.call_args.args[0].job.name == "job-0"
+
+    # A new worker is started for the remaining job
+    assert len(executor.created) == 2
+    assert worker_name not in pilot.workers
+    assert len(pilot.workers) == 1
+
+
+def test_queue_errors_keep_jobs_active(tmp_path):
+    executor = make_pilot_executor(tmp_path, pilot_workers=1)
+    executor.run_jobs(make_jobs(["job-0", "job-1"]))
+    active = [c.args[0] for c in executor.report_job_submission.call_args_list]
+    pilot = next(iter(executor.pilots.values()))
+
+    # The queue cannot be read while a worker stops
+    pilot.queue.results = MagicMock(side_effect=ServiceUnavailable("queue"))
+    worker_name = next(iter(pilot.workers))
+    executor.async_batch.add_job(worker_name, JobStatus.State.FAILED)
+
+    assert asyncio.run(check(executor, active)) == active
+    assert executor.report_job_error.call_count == 0
+    assert len(pilot.tasks) == 2
+
+    # A new worker is started for the queued jobs
+    assert len(executor.created) == 2
+    assert worker_name not in pilot.workers
+
+
+def test_pilots_scale_once_from_both_threads(tmp_path):
+    executor = make_pilot_executor(tmp_path, pilot_workers=2)
+    executor.run_jobs(make_jobs(["job-0"]))
+    pilot = next(iter(executor.pilots.values()))
+    create_job = executor.batch.create_job.side_effect
+
+    # Workers are created slowly, while both threads see tasks to run
+    def slow_create_job(request, **kwargs):
+        time.sleep(0.05)
+        return create_job(request, **kwargs)
+
+    executor.batch.create_job.side_effect = slow_create_job
+    with pilot.lock:
+        pilot.tasks.update(["task-1", "task-2"])
+    threads = [
+        threading.Thread(target=executor.scale_pilot, args=(pilot,)) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(executor.created) == 2
+    assert len(pilot.workers) == 2
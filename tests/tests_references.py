@@ -0,0 +1,54 @@
+import pytest
+from snakemake_interface_common.exceptions import WorkflowError
+
+from snakemake_executor_plugin_googlebatch.references import (
+    content_digest,
+    disk_size_gb,
+    marker_url,
+    parse_references,
+)
+from snakemake_executor_plugin_googlebatch.volumes import (
+    attached_disks,
+    mount_options,
+    task_volumes,
+)
+
+
+def test_parse_references():
+    hg38, mm10 = parse_references(
+        "gs://refs/genomes/hg38/:/mnt/hg38, gs://refs/mm10:/mnt/mm10:200"
+    )
+    assert (hg38.url, hg38.mount_path, hg38.size_gb) == (
+        "gs://refs/genomes/hg38",
+        "/mnt/hg38",
+        None,
+    )
+    assert (mm10.size_gb, mm10.device_name) == (200, "snakemake-reference-1")
+
+    with pytest.raises(WorkflowError):
+        parse_references("refs/hg38:/mnt/hg38")
+
+
+def test_content_digest_and_size():
+    objects = [("hg38/genome.fa", "abc==", 3 * 1024**3), ("hg38/genome.fai", "d", 10)]
+    assert content_digest(objects) == content_digest(objects[::-1])
+    assert content_digest(objects) != content_digest(objects[:1])
+    assert disk_size_gb(objects) == 14
+    assert (
+        marker_url("gs://refs/genomes/hg38", "snakemake-ref-1")
+        == "gs://refs/.snakemake-references/snakemake-ref-1"
+    )
+
+
+def test_reference_disks_are_read_only():
+    (reference,) = parse_references("gs://refs/hg38:/mnt/hg38:50")
+    reference.image = "projects/p/global/images/snakemake-ref-1"
+
+    (disk,) = attached_disks([reference])
+    assert disk.new_disk.image == reference.image
+    assert disk.new_disk.size_gb == 50
+    (mount,) = task_volumes([reference])
+    assert list(mount.mount_options) == ["ro"]
+
+    # Caches are not written to reference disks
+    assert "--cache-dir=/tmp/gcsfuse-cache" in mount_options("read-heavy", [reference])
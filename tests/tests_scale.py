@@ -0,0 +1,83 @@
+import tracemalloc
+
+from tests.fake import FakeBatchService, FakeWorkflowRun
+
+
+def test_run_to_completion(tmp_path):
+    service = FakeBatchService()
+    run = FakeWorkflowRun(tmp_path, service)
+    run.submit(run.make_jobs(1000))
+    assert len(run.active) == 1000
+    assert service.calls["create_job"] == 1000
+
+    run.finish()
+    assert len(run.succeeded) == 1000
+    assert not run.failed
+
+    # Queued, scheduled and running take 80 seconds, checked every 10
+    assert run.cycles == 8
+    assert service.calls["get_job"] == 8000
+
+    # Logs of jobs finished in the same check are fetched 50 jobs per query
+    assert service.logging.list_calls == 20
+    logfile = tmp_path / "logs" / "rule-7.log"
+    assert logfile.read_text().count(" line ") == 3
+
+
+def test_list_mode_requests_per_cycle(tmp_path):
+    service = FakeBatchService()
+    run = FakeWorkflowRun(tmp_path, service, status_mode="list")
+    run.submit(run.make_jobs(1200))
+    run.finish()
+
+    # One list request with two further pages per cycle instead of 1200 gets
+    assert len(run.succeeded) == 1200
+    assert service.calls["get_job"] == 0
+    assert service.list_calls == 3 * run.cycles
+
+
+def test_job_arrays_are_checked_by_task_group(tmp_path):
+    service = FakeBatchService()
+    run = FakeWorkflowRun(tmp_path, service, array_size=100)
+    run.submit(run.make_jobs(250))
+    assert len(run.active) == 250
+    assert service.calls["create_job"] == 3
+
+    run.finish()
+    assert len(run.succeeded) == 250
+    assert service.calls["list_tasks"] == 3 * run.cycles
+    assert service.calls["get_job"] == 0
+    logfile = tmp_path / "logs" / "rule-249.log"
+    assert logfile.read_text().count(" line ") == 3
+
+
+def test_quota_errors_and_preemptions(tmp_path):
+    service = FakeBatchService(quota_error_rate=0.1, preempt_rate=0.1)
+    run = FakeWorkflowRun(tmp_path, service)
+    run.submit(run.make_jobs(300))
+    assert len(run.active) == 300
+    run.finish()
+
+    # Quota errors are retried, preempted jobs fail
+    assert service.quota_errors > 0
+    assert len(run.failed) == len(service.preempted) > 0
+    assert len(run.succeeded) + len(run.failed) == 300
+    assert len(list((tmp_path / "logs").glob("*.log"))) == 300
+
+
+def test_memory_per_active_job(tmp_path):
+    service = FakeBatchService()
+    run = FakeWorkflowRun(tmp_path, service)
+    jobs = run.make_jobs(500)
+
+    tracemalloc.start()
+    try:
+        run.submit(jobs)
+        run.poll()
+        memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    run.finish()
+
+    # About 12 KiB per job (mostly the Batch job as created)
+    assert memory / 500 < 64 * 1024
@@ -0,0 +1,238 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from google.api_core.exceptions import (
+    DeadlineExceeded,
+    NotFound,
+    PermissionDenied,
+    RetryError,
+)
+from google.cloud.batch_v1.types import Job, JobStatus, TaskStatus
+
+from snakemake_executor_plugin_googlebatch.status import (
+    PollScheduler,
+    StatusIndex,
+    StatusPoller,
+)
+from tests.fake import FakeBatchAsyncClient, FakeJobInfo, make_executor
+
+
+def test_poller_limits_requests_in_flight():
+    client = FakeBatchAsyncClient(latency=0.01)
+    poller = StatusPoller(client, max_concurrency=5)
+    names = [f"job-{i}" for i in range(40)]
+    responses = asyncio.run(poller.get_jobs(names))
+
+    assert client.calls == 40
+    assert client.max_in_flight == 5
+    assert [responses[n].name for n in names] == names
+    assert responses["job-0"].status.state == JobStatus.State.RUNNING
+
+
+def test_poller_returns_exceptions_per_job():
+    class FlakyClient(FakeBatchAsyncClient):
+        async def get_job(self, request=None, **kwargs):
+            if request.name == "job-1":
+                raise PermissionDenied("not allowed")
+            return await super().get_job(request=request)
+
+    poller = StatusPoller(FlakyClient(latency=0), max_concurrency=2)
+    responses = asyncio.run(poller.get_jobs(["job-0", "job-1", "job-2"]))
+    assert isinstance(responses["job-1"], PermissionDenied)
+    assert responses["job-0"].name == "job-0"
+    assert responses["job-2"].name == "job-2"
+
+
+def test_index_lists_run_jobs_by_page():
+    client = FakeBatchAsyncClient(latency=0)
+    for region in ["us-central1", "us-east1"]:
+        parent = f"projects/p/locations/{region}"
+        for i in range(600):
+            client.add_job(f"{parent}/jobs/job-{i}", labels={"snakemake-run": "a"})
+    client.add_job(
+        "projects/p/locations/us-central1/jobs/other", labels={"snakemake-run": "b"}
+    )
+
+    index = StatusIndex(client, "snakemake-run", "a", page_size=250)
+    parents = ["projects/p/locations/us-central1", "projects/p/locations/us-east1"]
+    asyncio.run(index.refresh(parents + parents))
+
+    # Three pages per parent instead of 1200 get_job requests
+    assert client.list_calls == 6
+    assert client.calls == 0
+    assert len(index.jobs) == 1200
+    assert index.get("projects/p/locations/us-central1/jobs/other") is None
+    job = index.get("projects/p/locations/us-east1/jobs/job-3")
+    assert job.status.state == JobStatus.State.RUNNING
+
+
+def test_list_mode_requests_unlisted_jobs(tmp_path):
+    executor = make_executor(tmp_path, status_mode="list")
+    client = FakeBatchAsyncClient(latency=0)
+    executor.async_batch = client
+
+    parent = "projects/p/locations/us-central1"
+    labels = {"snakemake-run": executor.run_id}
+    client.add_job(f"{parent}/jobs/a", JobStatus.State.SUCCEEDED, labels)
+    active = [FakeJobInfo(f"{parent}/jobs/a"), FakeJobInfo(f"{parent}/jobs/b")]
+    responses = asyncio.run(executor.get_job_statuses(active))
+
+    assert client.list_calls == 1
+    assert client.calls == 1
+    assert responses[f"{parent}/jobs/a"].status.state == JobStatus.State.SUCCEEDED
+    assert responses[f"{parent}/jobs/b"].status.state == JobStatus.State.RUNNING
+
+
+@pytest.mark.parametrize(
+    "error",
+    [RetryError("gave up", DeadlineExceeded("slow")), PermissionDenied("no list")],
+)
+def test_list_mode_requests_all_jobs_when_listing_fails(tmp_path, error):
+    executor = make_executor(tmp_path, status_mode="list")
+    client = FakeBatchAsyncClient(latency=0)
+    executor.async_batch = client
+
+    parent = "projects/p/locations/us-central1"
+    labels = {"snakemake-run": executor.run_id}
+    job = client.add_job(f"{parent}/jobs/a", JobStatus.State.RUNNING, labels)
+    active = [FakeJobInfo(f"{parent}/jobs/a")]
+    asyncio.run(executor.get_job_statuses(active))
+    assert client.calls == 0
+
+    # The job finished, but the listing fails, so the last one is not used
+    job.status.state = JobStatus.State.SUCCEEDED
+    list_jobs = client.list_jobs
+    client.list_jobs = MagicMock(side_effect=error)
+    responses = asyncio.run(executor.get_job_statuses(active))
+    assert client.calls == 1
+    assert responses[f"{parent}/jobs/a"].status.state == JobStatus.State.SUCCEEDED
+
+    client.list_jobs = list_jobs
+    asyncio.run(executor.get_job_statuses(active))
+    assert client.calls == 1
+
+
+def test_check_keeps_jobs_active_on_transient_errors(tmp_path):
+    executor = make_executor(tmp_path)
+    executor.report_job_error = MagicMock()
+    executor.log_harvester = MagicMock()
+    responses = {
+        "job-slow": RetryError("gave up", DeadlineExceeded("slow")),
+        "job-gone": NotFound("no such job"),
+        "job-done": Job(status=JobStatus(state=JobStatus.State.FAILED)),
+    }
+
+    async def get_job_statuses(active_jobs):
+        return responses
+
+    async def check(active_jobs):
+        return [j async for j in executor.check_active_jobs(active_jobs)]
+
+    executor.get_job_statuses = get_job_statuses
+    active = [FakeJobInfo(name) for name in responses]
+    for j in active:
+        j.aux["batch_job"] = Job(uid=j.external_jobid)
+    still_active = asyncio.run(check(active))
+
+    assert [j.external_jobid for j in still_active] == ["job-slow"]
+    errors = [c.args[0].external_jobid for c in executor.report_job_error.mock_calls]
+    assert errors == ["job-gone", "job-done"]
+
+
+def test_scheduler_backs_off_running_jobs():
+    scheduler = PollScheduler(interval=10, max_interval=60)
+    assert scheduler.is_due("job", 0)
+
+    scheduler.update("job", "rule", "QUEUED", 0)
+    assert not scheduler.is_due("job", 5)
+    assert scheduler.is_due("job", 10)
+
+    # Running jobs are checked after 10, 20, 40, 60, 60 seconds
+    now, waits = 10, []
+    for _ in range(5):
+        scheduler.update("job", "rule", "RUNNING", now)
+        waits.append(scheduler.next_check["job"] - now)
+        now = scheduler.next_check["job"]
+    assert waits == [10, 20, 40, 60, 60]
+
+
+def test_scheduler_checks_near_expected_finish():
+    scheduler = PollScheduler(interval=10, max_interval=600)
+    scheduler.update("a", "rule", "RUNNING", 0)
+    scheduler.finish("a", "rule", 100)
+    assert scheduler.durations == {"rule": 100}
+    assert "a" not in scheduler.next_check
+
+    scheduler.update("b", "rule", "RUNNING", 0)
+    for now in [10, 30, 70]:
+        scheduler.update("b", "rule", "RUNNING", now)
+    # Next check would be at 150, but jobs of the rule took 100 seconds
+    assert scheduler.next_check["b"] == 100
+
+    # Jobs of other rules back off as usual
+    scheduler.update("c", "other", "RUNNING", 0)
+    scheduler.update("c", "other", "RUNNING", 10)
+    assert scheduler.next_check["c"] == 30
+
+
+def test_adaptive_check_skips_jobs_not_due(tmp_path):
+    executor = make_executor(tmp_path, adaptive_polling=True)
+    assert executor.poll_scheduler.interval == 10
+    client = FakeBatchAsyncClient(latency=0)
+    executor.async_batch = client
+
+    async def check(active_jobs):
+        return [j async for j in executor.check_active_jobs(active_jobs)]
+
+    active = [FakeJobInfo(f"job-{i}") for i in range(3)]
+    for j in active:
+        j.aux["batch_job"] = Job(uid=j.external_jobid)
+    assert len(asyncio.run(check(active))) == 3
+    assert client.calls == 3
+
+    # Nothing is due right after the first check
+    assert len(asyncio.run(check(active))) == 3
+    assert client.calls == 3
+
+
+def test_check_reports_array_tasks(tmp_path):
+    executor = make_executor(tmp_path)
+    executor.report_job_error = MagicMock()
+    executor.report_job_success = MagicMock()
+    executor.log_harvester = MagicMock()
+    client = FakeBatchAsyncClient(latency=0)
+    executor.async_batch = client
+
+    group = "projects/p/locations/r/jobs/array/taskGroups/group0"
+    states = [
+        TaskStatus.State.SUCCEEDED,
+        TaskStatus.State.FAILED,
+        TaskStatus.State.RUNNING,
+        TaskStatus.State.UNEXECUTED,
+    ]
+    for index, state in enumerate(states):
+        client.add_task(group, index, state)
+
+    # The last task is not listed yet
+    active = []
+    for index in range(5):
+        j = FakeJobInfo(f"{group}/tasks/{index}")
+        j.aux.update(
+            batch_job=Job(uid="uid"), array="array", task_group=group, task_index=index
+        )
+        active.append(j)
+
+    async def check(active_jobs):
+        return [j async for j in executor.check_active_jobs(active_jobs)]
+
+    still_active = asyncio.run(check(active))
+    assert client.list_calls == 1
+    assert client.calls == 0
+    assert [j.aux["task_index"] for j in still_active] == [2, 4]
+    assert executor.report_job_success.call_args.args[0].aux["task_index"] == 0
+    errors = [c.args[0].aux["task_index"] for c in executor.report_job_error.mock_calls]
+    assert errors == [1, 3]
+    saved = [c.args[0] for c in executor.log_harvester.submit.mock_calls]
+    assert saved == ["uid/0", "uid/1", "uid/3"]
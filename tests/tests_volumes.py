@@ -0,0 +1,105 @@
+import pytest
+from snakemake_interface_common.exceptions import WorkflowError
+
+from snakemake_executor_plugin_googlebatch.volumes import (
+    attached_disks,
+    mount_options,
+    parse_volumes,
+    raid0_steps,
+    scratch_path,
+    task_volumes,
+)
+
+
+def test_parse_volumes():
+    volumes = parse_volumes(
+        "local-ssd:2:/mnt/ssd:raid0, hyperdisk-balanced:200:/mnt/data,"
+        "gcs:refs/hg38:/mnt/refs"
+    )
+    ssd, data, refs = volumes
+    assert (ssd.kind, ssd.size_gb, ssd.raid0) == ("local-ssd", 750, True)
+    assert ssd.device_names == ["snakemake-disk-0-0", "snakemake-disk-0-1"]
+    assert (data.kind, data.size_gb, data.device_name) == (
+        "hyperdisk-balanced",
+        200,
+        "snakemake-disk-1",
+    )
+    assert (refs.is_disk, refs.remote_path) == (False, "refs/hg38")
+
+    # A single local SSD needs no striping
+    assert not parse_volumes("local-ssd:1:/mnt/ssd:raid0")[0].raid0
+    assert parse_volumes(None) == []
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        "local-ssd:0:/mnt/ssd",
+        "local-ssd:2:/mnt/ssd:raid5",
+        "pd-balanced:big:/mnt/data",
+        "nfs:server:/mnt/share",
+        "gcs:bucket",
+        "gcs:bucket:/mnt/share:fast",
+        "pd-ssd:10:/mnt/a,pd-standard:10:/mnt/a",
+    ],
+)
+def test_invalid_volumes(spec):
+    with pytest.raises(WorkflowError):
+        parse_volumes(spec)
+
+
+def test_disks_and_task_volumes():
+    volumes = parse_volumes(
+        "local-ssd:2:/mnt/ssd:raid0,pd-balanced:500:/mnt/data,gcs:refs:/mnt/refs"
+    )
+    disks = attached_disks(volumes)
+    assert [(d.device_name, d.new_disk.type_, d.new_disk.size_gb) for d in disks] == [
+        ("snakemake-disk-0-0", "local-ssd", 375),
+        ("snakemake-disk-0-1", "local-ssd", 375),
+        ("snakemake-disk-1", "pd-balanced", 500),
+    ]
+
+    # Striped local SSDs are mounted by a step, not by Batch
+    mounts = task_volumes(volumes)
+    assert [(m.mount_path, m.device_name, m.gcs.remote_path) for m in mounts] == [
+        ("/mnt/data", "snakemake-disk-1", ""),
+        ("/mnt/refs", "", "refs"),
+    ]
+    (step,) = raid0_steps(volumes)
+    assert "--raid-devices=2" in step
+    assert "snakemake-disk-0-0 snakemake-disk-0-1" in step
+    assert "mount /dev/md/snakemake-disk-0 /mnt/ssd" in step
+
+
+def test_scratch_is_fastest_disk():
+    assert scratch_path(parse_volumes("pd-standard:10:/a,pd-ssd:10:/b")) == "/b"
+    assert scratch_path(parse_volumes("pd-ssd:10:/a,local-ssd:1:/b")) == "/b"
+    assert scratch_path(parse_volumes("gcs:bucket:/a")) is None
+
+
+def test_mount_options():
+    assert mount_options("default") == []
+
+    # Without a disk, the file cache is on the boot disk
+    options = mount_options("read-heavy")
+    assert "--cache-dir=/tmp/gcsfuse-cache" in options
+    assert "--file-cache-max-size-mb=4096" in options
+
+    # Striped SSDs are mounted after buckets, so they hold no cache
+    volumes = parse_volumes("local-ssd:2:/mnt/ssd:raid0,pd-balanced:10:/mnt/data")
+    options = mount_options("read-heavy", volumes)
+    assert "--cache-dir=/mnt/data/gcsfuse-cache" in options
+    assert "--file-cache-max-size-mb=5120" in options
+    assert "--temp-dir=/mnt/data/gcsfuse-temp" in mount_options("write-heavy", volumes)
+
+    (mount,) = task_volumes(parse_volumes("gcs:refs:/mnt/refs:streaming"))
+    assert "--sequential-read-size-mb=200" in mount.mount_options
+
+
+def test_nfs_shares_are_mounted_first():
+    volumes = parse_volumes("gcs:refs:/mnt/share/refs,nfs:10.0.0.2:/share:/mnt/share")
+    share, refs = task_volumes(volumes)
+    assert (share.nfs.server, share.nfs.remote_path) == ("10.0.0.2", "/share")
+    assert share.mount_path == "/mnt/share"
+    assert refs.gcs.remote_path == "refs"
+    assert attached_disks(volumes) == []